@@ -1,4 +1,5 @@
-from tfl_project.database_creation import bp_lookups_from_tfl, journey_data_to_sql, station_data_to_sql, station_meta_to_sql
+from tfl_project.database_creation import bp_lookups_from_tfl, journey_aggregates_to_sql, journey_data_to_sql, \
+    station_data_to_sql, station_meta_to_sql
 from tfl_project.cycle_journey_prep import clean_combined_cycle_data
 
 # This currently assumes you'll run script directly with tfl_project as the working directory
@@ -16,4 +17,6 @@ if __name__ == '__main__':
     clean_combined_cycle_data.main()
     print("Creating indexed journeys table (will take a while)")
     journey_data_to_sql.main()
+    print("Creating pre-aggregated journey tables for simulation parameters (will take a while)")
+    journey_aggregates_to_sql.main()
     print("Database creation complete.")
@@ -0,0 +1,92 @@
+import sqlite3
+from pathlib import Path
+
+from tfl_project.database_creation.station_data_to_sql import table_exists
+
+# This script should no longer be run interactively. It is meant to be called by tfl_project.create_sqlite_database.py
+# It is intended to be run AFTER journey_data_to_sql.py
+# It summarises the journeys table at the finest grain the simulation parameters are taken at, so that LondonCreator
+# can roll demand and destinations up from these small tables rather than grouping tens of millions of journeys.
+
+database = Path('tfl_project/data/bike_db.db')
+od_table = 'journey_od_counts'
+days_table = 'station_days_in_action'
+# Journeys are counted per MINUTE_BUCKET minutes of the day, so these tables serve any minute_interval which is a
+# multiple of it
+MINUTE_BUCKET = 5
+# Journeys starting on or before this (as LondonCreator's exclude_covid filter compares it) are flagged pre_covid
+COVID_CUTOFF = '2020-03-15'
+
+
+def main(db_path=database):
+    if table_exists(od_table, db_path):
+        print(f"{od_table} table already exists. This is a slow step so will be skipped. Manually drop table if desired")
+        return
+
+    db = sqlite3.connect(db_path)
+    # End stations which are unrecognised or missing are kept as -1: they still count towards demand
+    db.execute(f"""CREATE TABLE {od_table} (
+                   "start_id" INTEGER NOT NULL
+                   ,"weekday_ind" INTEGER NOT NULL CHECK(weekday_ind IN (0,1))
+                   ,"year" INTEGER NOT NULL
+                   ,"pre_covid" INTEGER NOT NULL CHECK(pre_covid IN (0,1))
+                   ,"minute_bucket" INTEGER NOT NULL
+                   ,"end_id" INTEGER NOT NULL
+                   ,"journeys" INTEGER NOT NULL
+                   ,PRIMARY KEY (start_id, weekday_ind, year, pre_covid, minute_bucket, end_id)
+                   ) WITHOUT ROWID;
+                """)
+    # A date falls in a single year, weekday_ind and pre_covid group, so days can be summed across groups
+    db.execute(f"""CREATE TABLE {days_table} (
+                   "start_id" INTEGER NOT NULL
+                   ,"weekday_ind" INTEGER NOT NULL CHECK(weekday_ind IN (0,1))
+                   ,"year" INTEGER NOT NULL
+                   ,"pre_covid" INTEGER NOT NULL CHECK(pre_covid IN (0,1))
+                   ,"days_in_action" INTEGER NOT NULL
+                   ,PRIMARY KEY (start_id, weekday_ind, year, pre_covid)
+                   ) WITHOUT ROWID;
+                """)
+    print(f"summarising journeys into {od_table} (will take a while)")
+    db.execute(f"""
+        INSERT INTO {od_table}
+        SELECT
+            "StartStation Id"
+            ,weekday_ind
+            ,year
+            ,"Start Date" <= '{COVID_CUTOFF}'
+            ,(minute_of_day / {MINUTE_BUCKET}) * {MINUTE_BUCKET}
+            ,IFNULL("EndStation Id", -1)
+            ,COUNT(*)
+        FROM
+            journeys
+        WHERE
+            "StartStation Id" != -1
+            AND "StartStation Id" NOT NULL
+        GROUP BY
+            1,2,3,4,5,6
+        """)
+    print(f"counting days in action into {days_table}")
+    db.execute(f"""
+        INSERT INTO {days_table}
+        SELECT
+            "StartStation Id"
+            ,weekday_ind
+            ,year
+            ,"Start Date" <= '{COVID_CUTOFF}'
+            ,COUNT(DISTINCT DATE("Start Date"))
+        FROM
+            journeys
+        WHERE
+            "StartStation Id" != -1
+            AND "StartStation Id" NOT NULL
+        GROUP BY
+            1,2,3,4
+        """)
+    db.commit()
+    db.close()
+
+    print("journey aggregates finished")
+
+
+if __name__ == '__main__':
+    main()
@@ -23,17 +23,15 @@ def read_format_station_csv(station_csv):
     return df
 
 
-def table_exists(table):
+def table_exists(table, db_path=database):
     """Check if station table exists already"""
-    db = sqlite3.connect(database)
+    db = sqlite3.connect(db_path)
     c = db.cursor()
     c.execute(f''' SELECT count(name) FROM sqlite_master WHERE type='table' AND name='{table}' ''')
-    if c.fetchone()[0] == 1:
-        c.close()
-        return True
-    else:
-        c.close()
-        return False
+    exists = c.fetchone()[0] == 1
+    c.close()
+    db.close()
+    return exists
 
 
 def create_station_table():
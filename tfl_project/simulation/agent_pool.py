@@ -0,0 +1,157 @@
+from heapq import heappop, heappush
+
+import numpy
+
+
+class AgentPool:
+    def __init__(self, capacity=1024):
+        """
+        In-flight agents, held as parallel arrays rather than one object per journey. Each agent occupies a slot of
+        the arrays:
+            due: when the agent arrives, measured on its city's travel clock
+            number: the order in which agents set off, which is the order same-time arrivals are resolved in
+            dest, last: indices of the station being travelled to and the station last departed
+            orig_start, orig_end: indices of the stations the journey was originally between
+            reroute: whether the agent failed to dock and is waiting for a new destination
+
+        When an agent finishes, its slot goes on a free list and is reused by the next agent to set off. The arrays
+        double in size whenever the free list runs out, so adding agents never copies the pool.
+
+        Agents are also filed by when they are due, so that arriving() only touches the agents arriving, and
+        rerouting() only those waiting. So due, dest and reroute should be changed through redirect() and strand()
+        rather than directly.
+        """
+        self._n_created = 0
+        self._allocate(capacity)
+        # floor(due - 0.5) -> [(slots, numbers)] of agents due then, and a heap of those keys
+        self._due_buckets = dict()
+        self._due_keys = []
+        # slots of agents which may be waiting for a new destination
+        self._stranded = []
+
+    def _allocate(self, capacity):
+        self.due = numpy.zeros(capacity, dtype=float)
+        self.number = numpy.zeros(capacity, dtype=numpy.int64)
+        self.dest = numpy.zeros(capacity, dtype=numpy.int32)
+        self.last = numpy.zeros(capacity, dtype=numpy.int32)
+        self.orig_start = numpy.zeros(capacity, dtype=numpy.int32)
+        self.orig_end = numpy.zeros(capacity, dtype=numpy.int32)
+        self.reroute = numpy.zeros(capacity, dtype=bool)
+        self.active = numpy.zeros(capacity, dtype=bool)
+        # a stack of free slots, the lowest on top
+        self._free = numpy.arange(capacity - 1, -1, -1, dtype=numpy.int64)
+        self._n_free = capacity
+
+    def _grow(self, min_capacity):
+        old_capacity = len(self.active)
+        capacity = max(2 * old_capacity, min_capacity)
+        old = {name: getattr(self, name) for name in
+               ('due', 'number', 'dest', 'last', 'orig_start', 'orig_end', 'reroute', 'active')}
+        old_free = self._free[:self._n_free]
+        self._allocate(capacity)
+        for name, values in old.items():
+            getattr(self, name)[:old_capacity] = values
+        n_new = capacity - old_capacity
+        self._free[:n_new] = numpy.arange(capacity - 1, old_capacity - 1, -1)
+        self._free[n_new:n_new + len(old_free)] = old_free
+        self._n_free = n_new + len(old_free)
+
+    def __len__(self):
+        return len(self.active) - self._n_free
+
+    @property
+    def capacity(self):
+        return len(self.active)
+
+    @property
+    def n_created(self):
+        """Number of agents ever added to the pool"""
+        return self._n_created
+
+    def add(self, due, dest, last, orig_start, orig_end):
+        """Adds agents, numbered in the order given, and returns their slots. Arguments are equal-length arrays, or
+        scalars to add a single agent."""
+        n = len(numpy.atleast_1d(dest))
+        if n > self._n_free:
+            self._grow(len(self) + n)
+        slots = self._free[self._n_free - n:self._n_free][::-1].copy()
+        self._n_free -= n
+        self.due[slots] = due
+        self.number[slots] = numpy.arange(self._n_created, self._n_created + n)
+        self._n_created += n
+        self.dest[slots] = dest
+        self.last[slots] = last
+        self.orig_start[slots] = orig_start
+        self.orig_end[slots] = orig_end
+        self.reroute[slots] = False
+        self.active[slots] = True
+        self._schedule(slots)
+        return slots
+
+    def _schedule(self, slots):
+        """Files the agents in slots under the key of when they are due"""
+        if not len(slots):
+            return
+        keys = numpy.floor(self.due[slots] - 0.5).astype(numpy.int64)
+        if len(slots) > 1:
+            order = numpy.argsort(keys, kind='stable')
+            slots, keys = slots[order], keys[order]
+        starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+        for key, group in zip(keys[starts].tolist(), numpy.split(slots, starts[1:])):
+            if key not in self._due_buckets:
+                self._due_buckets[key] = []
+                heappush(self._due_keys, key)
+            self._due_buckets[key].append((group, self.number[group]))
+
+    def remove(self, slots):
+        """Frees the given slots for reuse"""
+        if not len(slots):
+            return
+        self.active[slots] = False
+        self._free[self._n_free:self._n_free + len(slots)] = slots
+        self._n_free += len(slots)
+
+    def _in_number_order(self, slots):
+        return slots[numpy.argsort(self.number[slots], kind='stable')]
+
+    def arriving(self, clock):
+        """Slots of travelling agents due to arrive by the given time, in the order they set off. Each agent is only
+        returned once per journey: it is expected to be removed or stranded."""
+        # an agent is due when due - clock < 0.5, so everything under a key below clock - 1 is due, and agents under
+        # the key just below clock may be
+        groups = []
+        while self._due_keys and self._due_keys[0] < clock:
+            groups.extend(self._due_buckets.pop(heappop(self._due_keys)))
+        if not groups:
+            return numpy.zeros(0, dtype=numpy.int64)
+        slots = numpy.concatenate([group for group, _ in groups])
+        numbers = numpy.concatenate([number for _, number in groups])
+        # agents which have finished, or been redirected since they were filed, are filed elsewhere if at all
+        current = self.active[slots] & ~self.reroute[slots] & (self.number[slots] == numbers)
+        slots = slots[current]
+        due = self.due[slots] - clock < 0.5
+        if not due.all():
+            self._schedule(slots[~due])
+        return self._in_number_order(slots[due])
+
+    def rerouting(self):
+        """Slots of agents waiting for a new destination, in the order they set off"""
+        if not self._stranded:
+            return numpy.zeros(0, dtype=numpy.int64)
+        slots = numpy.unique(numpy.concatenate(self._stranded))
+        slots = slots[self.active[slots] & self.reroute[slots]]
+        self._stranded = [slots]
+        return self._in_number_order(slots)
+
+    def strand(self, slots):
+        """Flags the agents in slots as waiting for a new destination"""
+        self.reroute[slots] = True
+        self._stranded.append(slots)
+
+    def redirect(self, slots, dest, due):
+        """The agents in slots set off from their current destination for dest, arriving when due"""
+        self.last[slots] = self.dest[slots]
+        self.dest[slots] = dest
+        self.due[slots] = due
+        self.reroute[slots] = False
+        self._schedule(slots)
@@ -0,0 +1,299 @@
+import numpy
+
+from tfl_project.simulation.city import City, generator_from_state, substreams
+from tfl_project.simulation.event_log import FAILED_END, FAILED_START, FINISHED_JOURNEY, station_id_array
+from tfl_project.simulation.parameter_bundle import ParameterBundle
+
+# How many of the nearest stations _nearest_available checks for a free dock before looking further
+NEAREST_CANDIDATES = 8
+
+
+def occurrence_rank(a):
+    """For each element of a, returns how many earlier elements of a share its value.
+    E.g. [3, 1, 3, 3] -> [0, 0, 1, 2]. Used to decide which of several same-station requests get served first."""
+    order = numpy.argsort(a, kind='stable')
+    sorted_a = a[order]
+    starts = numpy.flatnonzero(numpy.r_[True, sorted_a[1:] != sorted_a[:-1]])
+    counts = numpy.diff(numpy.r_[starts, len(a)])
+    rank = numpy.empty(len(a), dtype=numpy.int64)
+    rank[order] = numpy.arange(len(a)) - numpy.repeat(starts, counts)
+    return rank
+
+
+class ArrayCity(City):
+    def __init__(self, city, seed=None):
+        """
+        An alternative simulation engine which behaves like the City it is built from, but keeps station, warehouse
+        and rider state in NumPy arrays. Each time period draws the Poisson demand for every station in one call, and
+        undocking, docking and rerouting are resolved with array operations rather than Station and User method calls.
+
+        The ArrayCity takes a snapshot of city when it is instantiated: the Station objects are shared (and never
+        modified), so later changes to the city's stations will not be seen unless a new ArrayCity is made. Similarly
+        the Station objects' ._docked attributes do not reflect the progress of an ArrayCity simulation.
+
+        WarehousedStations share their warehouse with others, so the order in which they are served matters. These
+        are resolved one request at a time, in the same order as City would resolve them.
+
+        :param city: a populated City, e.g. LondonCreator.london, or a ParameterBundle of one. An ArrayCity built from
+            a memory-mapped bundle shares its parameters with every other process using the same bundle, and has no
+            Station objects.
+        :param seed: seed for the numpy Generators which drive all random draws
+        """
+        if isinstance(city, ParameterBundle):
+            bundle = city
+            super().__init__(interval_size=bundle.interval_size)
+        else:
+            bundle = ParameterBundle.from_city(city)
+            super().__init__(interval_size=city._interval_size)
+            # Stations are not added with add_station as that would re-assign their ._city
+            self._stations = city.stations
+            self._warehouses = city.warehouses
+        self._seed(seed)
+
+        self._station_ids = list(bundle.station_ids)
+        self._station_index = {st_id: i for i, st_id in enumerate(self._station_ids)}
+        self._st_ids = station_id_array(self._station_ids)
+        self._n_stations = len(self._station_ids)
+
+        self._capacity = bundle.capacity
+        self._docked_init = bundle.docked_init
+        self._latitude = bundle.latitude
+        self._longitude = bundle.longitude
+        self._wh_capacity = bundle.wh_capacity
+        self._wh_docked_init = bundle.wh_docked_init
+        self._st_warehouse = bundle.st_warehouse
+        self._is_warehoused = self._st_warehouse >= 0
+        self._nearest_order = self._nearest_station_order()
+
+        self._interval_rows = {interval: row for row, interval in enumerate(bundle.intervals)}
+        self._demand = bundle.demand
+        # Each interval's destinations, as views of the bundle's flat arrays
+        self._dest_indptr = []
+        self._dest_idx = []
+        self._dest_cum = []
+        for indptr in bundle.dest_indptr:
+            start, stop = indptr[0], indptr[-1]
+            self._dest_indptr.append(indptr - start)
+            self._dest_idx.append(bundle.dest_idx[start:stop])
+            self._dest_cum.append(bundle.dest_cum[start:stop])
+        self._dur_indptr = bundle.dur_indptr
+        self._dur_keys = bundle.dur_keys
+        self._dur_loc = bundle.dur_loc
+        self._dur_scale = bundle.dur_scale
+        self.reset()
+
+    def _seed(self, seed):
+        """Demand and rerouting draw from separate Generators. Demand draws never depend on the state of the city, so
+        two cities seeded alike see the same demand however differently their riders fare."""
+        if not isinstance(seed, numpy.random.SeedSequence):
+            seed = numpy.random.SeedSequence(seed)
+        demand_seed, reroute_seed = substreams(seed, 2)
+        self._rng = numpy.random.default_rng(demand_seed)
+        self._reroute_rng = numpy.random.default_rng(reroute_seed)
+
+    def reset(self, seed=None):
+        """Returns the city to the state it was in when the ArrayCity was created, ready for another simulation.
+        If a seed is given the random Generators are also re-seeded."""
+        if seed is not None:
+            self._seed(seed)
+        self.clear_run_state()
+        self._docked = numpy.array(self._docked_init)
+        self._wh_docked = numpy.array(self._wh_docked_init)
+
+    def _docked_state(self):
+        return self._docked.copy(), self._wh_docked.copy()
+
+    def _restore_docked(self, docked_state):
+        self._docked, self._wh_docked = (docked.copy() for docked in docked_state)
+
+    def _random_state(self):
+        return dict(demand=self._rng.bit_generator.state, reroute=self._reroute_rng.bit_generator.state)
+
+    def _restore_random_state(self, random_state):
+        self._rng = generator_from_state(random_state['demand'])
+        self._reroute_rng = generator_from_state(random_state['reroute'])
+
+    def move_agents(self, t):
+        """Riders proceed with their journeys. Those who arrive try to dock, in the order they set off."""
+        self._travel_clock += t
+        if not len(self._agents):
+            return
+        arriving = self._agents.arriving(self._travel_clock)
+        if not len(arriving):
+            return
+        agents = self._agents
+        docked = self._dock(agents.dest[arriving])
+        self.log_events(
+            numpy.where(docked, FINISHED_JOURNEY, FAILED_END)
+            , start_st=agents.last[arriving]
+            , end_st=agents.dest[arriving]
+            , orig_start_st=agents.orig_start[arriving]
+            , orig_end_st=agents.orig_end[arriving]
+        )
+        agents.strand(arriving[~docked])
+        agents.remove(arriving[docked])
+
+    def request_demand(self, interval, t):
+        """Draws the number of journeys starting at every station in one Poisson call, then samples all of their
+        destinations and durations together"""
+        row = self._interval_rows.get(interval)
+        if row is None:
+            return
+        n_journeys = self._rng.poisson(self._demand[row] * t)
+        if not n_journeys.any():
+            return
+        origins = numpy.repeat(numpy.arange(self._n_stations), n_journeys)
+        dests = self._sample_destinations(row, interval, origins)
+        durations = self._sample_durations(origins, dests, self._rng)
+        self._start_journeys(origins, dests, durations)
+
+    def call_for_new_destinations(self):
+        """Riders who failed to dock are sent to the nearest station that is not full"""
+        agents = self._agents
+        rerouting = agents.rerouting()
+        if not len(rerouting):
+            return
+        current = agents.dest[rerouting]
+        new_dests = self._nearest_available(current)
+        agents.redirect(rerouting, new_dests,
+                        self._travel_clock + self._sample_durations(current, new_dests, self._reroute_rng))
+
+    def generate_journey(self, start_st, dest_st, duration: int):
+        """Equivalent to City.generate_journey, for a single journey between two of the city's Stations"""
+        self._start_journeys(
+            numpy.array([self._station_index[start_st.get_id()]])
+            , numpy.array([self._station_index[dest_st.get_id()]])
+            , numpy.array([duration], dtype=numpy.int64)
+        )
+
+    def _start_journeys(self, origins, dests, durations):
+        """Attempts to undock a bike for each journey: those at empty stations are failed starts, the rest become
+        riders"""
+        undocked = self._undock(origins)
+        failed = ~undocked
+        if failed.any():
+            self.log_events(
+                FAILED_START
+                , start_st=origins[failed]
+                , end_st=dests[failed]
+                , orig_start_st=origins[failed]
+                , orig_end_st=dests[failed]
+            )
+        if undocked.any():
+            origins, dests = origins[undocked], dests[undocked]
+            self._agents.add(self._travel_clock + durations[undocked], dests, origins, origins, dests)
+
+    def _undock(self, origins):
+        """Returns a boolean array of which requests (in order) successfully undock a bike"""
+        success = numpy.zeros(len(origins), dtype=bool)
+        plain = ~self._is_warehoused[origins]
+        o = origins[plain]
+        ok = occurrence_rank(o) < self._docked[o]
+        success[plain] = ok
+        self._docked -= numpy.bincount(o[ok], minlength=self._n_stations)
+        for pos in numpy.flatnonzero(~plain):
+            success[pos] = self._warehoused_give(origins[pos])
+        return success
+
+    def _dock(self, dests):
+        """Returns a boolean array of which arrivals (in order) successfully dock a bike"""
+        success = numpy.zeros(len(dests), dtype=bool)
+        plain = ~self._is_warehoused[dests]
+        d = dests[plain]
+        ok = occurrence_rank(d) < (self._capacity[d] - self._docked[d])
+        success[plain] = ok
+        self._docked += numpy.bincount(d[ok], minlength=self._n_stations)
+        for pos in numpy.flatnonzero(~plain):
+            success[pos] = self._warehoused_take(dests[pos])
+        return success
+
+    def _warehoused_give(self, s):
+        """Array equivalent of WarehousedStation.give_bike, preceded by City's is_empty check"""
+        if self._docked[s] == 0:
+            return False
+        if self._docked[s] == 1:
+            w = self._st_warehouse[s]
+            if self._wh_docked[w] > 0:
+                self._wh_docked[w] -= 1
+                self._docked[s] += 1
+        self._docked[s] -= 1
+        return True
+
+    def _warehoused_take(self, s):
+        """Array equivalent of WarehousedStation.take_bike, preceded by User's is_full check"""
+        if self._docked[s] == self._capacity[s]:
+            return False
+        if self._docked[s] == self._capacity[s] - 1:
+            w = self._st_warehouse[s]
+            if self._wh_docked[w] < self._wh_capacity[w]:
+                self._wh_docked[w] += 1
+                self._docked[s] -= 1
+        self._docked[s] += 1
+        return True
+
+    def _sample_destinations(self, row, interval, origins):
+        indptr = self._dest_indptr[row]
+        dests = numpy.empty(len(origins), dtype=numpy.int64)
+        known = indptr[origins + 1] > indptr[origins]
+        u = self._rng.random(known.sum())
+        dests[known] = self._dest_idx[row][numpy.searchsorted(self._dest_cum[row], origins[known] + u, side='right')]
+        if not known.all():
+            for i in numpy.unique(origins[~known]):
+                print(f"Warning: Station {self._st_ids[i]} was asked to generate unprecedented demand for interval "
+                      f"{interval}")
+            dests[~known] = self._rng.integers(self._n_stations, size=(~known).sum())
+        return dests
+
+    def _sample_durations(self, origins, dests, rng):
+        """Samples gumbel_r durations for each (origin, destination) pair. Unprecedented pairs use the parameters of
+        a randomly chosen destination from the same origin, as in Station.pick_duration"""
+        keys = origins * self._n_stations + dests
+        pos = numpy.searchsorted(self._dur_keys, keys)
+        found = pos < len(self._dur_keys)
+        found[found] = self._dur_keys[pos[found]] == keys[found]
+        if not found.all():
+            missing = numpy.flatnonzero(~found)
+            starts = self._dur_indptr[origins[missing]]
+            counts = self._dur_indptr[origins[missing] + 1] - starts
+            if not counts.all():
+                st_id = self._st_ids[origins[missing][counts == 0][0]]
+                raise ValueError(f"Station {st_id} has no duration parameters to choose from")
+            for i, j in zip(origins[missing], dests[missing]):
+                print(f"Warning: Station {self._st_ids[i]} was asked to generate unprecedented duration for "
+                      f"destination {self._st_ids[j]}")
+            pos[missing] = starts + rng.integers(counts)
+        durations = numpy.rint(rng.gumbel(self._dur_loc[pos], self._dur_scale[pos]))
+        return numpy.maximum(durations, 1).astype(numpy.int64)
+
+    def _nearest_station_order(self):
+        """Row i lists every station index by distance from station i, as City.nearest_stations orders them: ties go
+        to the station added to the city first, and stations without co-ordinates come last"""
+        order = numpy.empty((self._n_stations, self._n_stations), dtype=numpy.int32)
+        for i in range(self._n_stations):
+            dist = numpy.sqrt((self._latitude[i] - self._latitude) ** 2 + (self._longitude[i] - self._longitude) ** 2)
+            # a stable argsort places nan distances last
+            order[i] = numpy.argsort(dist, kind='stable')
+        return order
+
+    def _nearest_available(self, current):
+        """For each station index in current, finds the nearest station which is not full. Ties go to the station
+        added to the city first, and stations without co-ordinates are only chosen if nothing else is available."""
+        full = self._docked == self._capacity
+        if full.all():
+            raise ValueError("Every station is full: there is nowhere to reroute to")
+        uniq, inverse = numpy.unique(current, return_inverse=True)
+        # the nearest few stations nearly always include one with a free dock, so only those are checked at first
+        candidates = self._nearest_order[uniq, :NEAREST_CANDIDATES]
+        available = ~full[candidates]
+        best = candidates[numpy.arange(len(uniq)), available.argmax(axis=1)]
+        for i in numpy.flatnonzero(~available.any(axis=1)).tolist():
+            order = self._nearest_order[uniq[i]]
+            best[i] = order[numpy.argmax(~full[order])]
+        return best[inverse]
+
+    def get_events_df(self):
+        return self._event_log['events'].to_dataframe(self._st_ids)
+
+    def docked(self, st_id):
+        """Number of bikes currently docked at a station, by station id"""
+        return int(self._docked[self._station_index[st_id]])
@@ -0,0 +1,198 @@
+"""
+Times the simulation on synthetic cities, so performance can be tracked without bike_db.db. Results are appended to a
+JSON history, and each is compared with the last comparable one. Run as a module, e.g.
+    python -m tfl_project.simulation.benchmarks.run_benchmarks --cities small medium --engines object array
+"""
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy
+
+from tfl_project.simulation.array_city import ArrayCity
+from tfl_project.simulation.benchmarks.synthetic_city import synthetic_city
+from tfl_project.simulation.sim_managment import SimulationManager
+from tfl_project.simulation.station import Station
+
+HISTORY_LOCATION = Path('tfl_project/simulation/files/benchmarks/history.json')
+
+CITIES = dict(
+    small=dict(n_stations=50, destinations_per_station=10, journeys_per_station=40)
+    , medium=dict(n_stations=300, destinations_per_station=40, journeys_per_station=40)
+    , london=dict(n_stations=800, destinations_per_station=150, journeys_per_station=50)
+    , warehoused=dict(n_stations=300, destinations_per_station=40, journeys_per_station=40, warehouse_share=0.5)
+)
+BENCHMARKS = ('phases', 'day', 'sweep')
+
+
+def prepare(city, engine, seed=0):
+    """The city instance to simulate with the given engine, seeded"""
+    if engine == 'array':
+        return ArrayCity(city, seed=seed)
+    Station.rng = numpy.random.default_rng(seed)
+    return city
+
+
+def run_day(city_instance, minutes=1440):
+    for _ in range(minutes):
+        city_instance.main_elapse_time(1)
+
+
+def run_sweep(city, engine, n_simulations, workers):
+    sm = SimulationManager(city=city, n_simulations=n_simulations, simulation_id='BENCHMARK', engine=engine,
+                           workers=workers, seed=0)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sm.run_simulations()
+
+
+def run_benchmark(city_params, engine, benchmark, minutes=1440, n_simulations=4, workers=1, trace_allocations=True):
+    """
+    Runs one benchmark and returns its results. Run this in a fresh process (as main() does) for peak_rss_mb to
+    describe this benchmark alone.
+    :param city_params: keyword arguments for synthetic_city
+    :param benchmark: 'phases' times each phase of main_elapse_time (see City.instrument), 'day' times whole days
+        and 'sweep' times a SimulationManager running n_simulations days across workers processes
+    :param trace_allocations: repeat the benchmark under tracemalloc, to record the peak memory allocated by Python.
+        This is done separately as tracing slows everything down.
+    """
+    if benchmark not in BENCHMARKS:
+        raise ValueError(f"benchmark must be one of {BENCHMARKS}. {benchmark} was given")
+    start = time.perf_counter()
+    city = synthetic_city(**city_params)
+    results = dict(build_seconds=time.perf_counter() - start)
+
+    def workload():
+        if benchmark == 'sweep':
+            run_sweep(city, engine, n_simulations, workers)
+            return None
+        city_instance = prepare(city, engine)
+        if engine == 'object':
+            city.save_initial_state()
+        city_instance.instrument(benchmark == 'phases')
+        run_day(city_instance, minutes)
+        results['journeys'] = sum(city_instance._event_log['totals'].values())
+        phases = None
+        if benchmark == 'phases':
+            phases = city_instance.get_phase_df().drop(columns='hour').sum().to_dict()
+            city_instance.instrument(False)
+        if engine == 'object':
+            city.reset()
+        return phases
+
+    start = time.perf_counter()
+    phases = workload()
+    results['seconds'] = time.perf_counter() - start
+    if benchmark == 'sweep':
+        results['simulations_per_second'] = n_simulations / results['seconds']
+    else:
+        results['ticks_per_second'] = minutes / results['seconds']
+    if phases is not None:
+        results['phases'] = {key: float(value) for key, value in phases.items()}
+    results['peak_rss_mb'] = peak_rss_mb()
+    if trace_allocations and benchmark != 'sweep':
+        tracemalloc.start()
+        workload()
+        results['peak_allocated_mb'] = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return results
+
+
+def peak_rss_mb():
+    """The peak resident memory of this process and its children, or None where the resource module (Unix only)
+    isn't available"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = [resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    # ru_maxrss is in kilobytes on Linux, but bytes on macOS
+    return max(usage) / (2**20 if platform.system() == 'Darwin' else 1024)
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        commit=commit
+        , python=platform.python_version()
+        , numpy=numpy.__version__
+        , machine=platform.machine()
+        , processor=platform.processor()
+        , node=platform.node()
+    )
+
+
+def load_history(location=HISTORY_LOCATION):
+    location = Path(location)
+    if not location.exists():
+        return []
+    with open(location) as f:
+        return json.load(f)
+
+
+def previous_result(history, record):
+    """The most recent record in history for the same benchmark, on the same machine"""
+    for old in reversed(history):
+        if all(old[key] == record[key] for key in ('city', 'city_params', 'engine', 'benchmark', 'settings')) \
+                and old['environment']['node'] == record['environment']['node']:
+            return old
+    return None
+
+
+def save_history(history, location=HISTORY_LOCATION):
+    location = Path(location)
+    if not location.parent.exists():
+        location.parent.mkdir(parents=True)
+    with open(location, 'w') as f:
+        json.dump(history, f, indent=1)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the simulation on synthetic cities')
+    parser.add_argument('--cities', nargs='+', default=['small', 'medium'], choices=list(CITIES))
+    parser.add_argument('--engines', nargs='+', default=['object', 'array'], choices=['object', 'array'])
+    parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS), choices=BENCHMARKS)
+    parser.add_argument('--minutes', type=int, default=1440, help='simulated minutes for phases and day')
+    parser.add_argument('--simulations', type=int, default=4, help='simulations in each sweep')
+    parser.add_argument('--workers', type=int, default=1, help='worker processes for each sweep')
+    parser.add_argument('--no-allocations', action='store_true', help='skip the tracemalloc pass')
+    parser.add_argument('--history', default=HISTORY_LOCATION, type=Path)
+    args = parser.parse_args(args)
+
+    history = load_history(args.history)
+    env = environment()
+    timestamp = datetime.now().isoformat(timespec='seconds')
+    for city_name in args.cities:
+        for engine in args.engines:
+            for benchmark in args.benchmarks:
+                settings = dict(minutes=args.minutes) if benchmark != 'sweep' else \
+                    dict(n_simulations=args.simulations, workers=args.workers)
+                # a fresh process for each benchmark, so that peak RSS is its own
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    results = pool.submit(run_benchmark, CITIES[city_name], engine, benchmark,
+                                          trace_allocations=not args.no_allocations, **settings).result()
+                record = dict(timestamp=timestamp, city=city_name, city_params=CITIES[city_name], engine=engine,
+                              benchmark=benchmark, settings=settings, environment=env, results=results)
+                previous = previous_result(history, record)
+                change = '' if previous is None else \
+                    f" ({results['seconds'] / previous['results']['seconds'] - 1:+.0%} on {previous['timestamp']})"
+                rss = '' if results['peak_rss_mb'] is None else f", peak RSS {results['peak_rss_mb']:.0f}MB"
+                print(f"{city_name:>10} {engine:>6} {benchmark:>6}: {results['seconds']:.2f}s{change}{rss}")
+                history.append(record)
+    save_history(history, args.history)
+    print(f"Results appended to {args.history}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import numpy
+
+from tfl_project.simulation.city import City
+from tfl_project.simulation.station import Station, Store, WarehousedStation
+
+# Roughly the area covered by London's docking stations
+LATITUDES = (51.45, 51.55)
+LONGITUDES = (-0.24, 0.0)
+
+
+def demand_profile(interval_starts):
+    """Relative demand at each time of day, with morning and evening peaks. Averages 1 over the day."""
+    minutes = numpy.asarray(interval_starts, dtype=float)
+    profile = 0.2 + numpy.exp(-((minutes - 8.5*60) / 60) ** 2) + numpy.exp(-((minutes - 17.5*60) / 75) ** 2)
+    return profile / profile.mean()
+
+
+def synthetic_city(n_stations=100, destinations_per_station=20, journeys_per_station=50, warehouse_share=0.,
+                   stations_per_warehouse=10, interval_size=20, seed=0):
+    """
+    Creates a City with randomly placed and parametrised stations, shaped like the one LondonCreator builds from
+    bike_db.db, so the simulation can be exercised without any data.
+    :param n_stations: number of stations
+    :param destinations_per_station: number of stations that journeys from each station can go to, in each interval
+    :param journeys_per_station: mean number of journeys requested at each station per day
+    :param warehouse_share: fraction of stations which are WarehousedStations
+    :param stations_per_warehouse: number of WarehousedStations sharing each warehouse
+    :param seed: the same seed always gives the same city
+    """
+    if not 0 <= warehouse_share <= 1:
+        raise ValueError(f"warehouse_share must be between 0 and 1. {warehouse_share} was given")
+    rng = numpy.random.default_rng(seed)
+    latitudes = rng.uniform(*LATITUDES, n_stations)
+    longitudes = rng.uniform(*LONGITUDES, n_stations)
+    capacities = rng.integers(10, 41, n_stations)
+    docked = rng.binomial(capacities, 0.5)
+    intervals = list(range(0, 1440, interval_size))
+    demand = journeys_per_station / 1440 * demand_profile(intervals)
+    n_destinations = min(destinations_per_station, n_stations)
+
+    n_warehoused = int(round(warehouse_share * n_stations))
+    warehoused = sorted(rng.choice(n_stations, n_warehoused, replace=False).tolist())
+    warehouse_of = {st: k // stations_per_warehouse for k, st in enumerate(warehoused)}
+    warehouses = [Store(capacity=20*stations_per_warehouse, docked_init=10*stations_per_warehouse, st_id=f'wh{i}')
+                  for i in range(-(-n_warehoused // stations_per_warehouse))]
+
+    city = City(interval_size=interval_size)
+    for warehouse in warehouses:
+        city.add_warehouse(warehouse)
+    for i in range(n_stations):
+        distances = numpy.hypot(latitudes - latitudes[i], longitudes - longitudes[i])
+        # journeys mostly go to nearby stations
+        weights = numpy.exp(-distances / 0.03)
+        destinations = rng.choice(n_stations, n_destinations, replace=False, p=weights / weights.sum())
+        dest_dict = {
+            interval: {'destinations': destinations.tolist(), 'volumes': rng.integers(1, 10, n_destinations).tolist()}
+            for interval in intervals
+        }
+        # riders who find a station full are rerouted to its nearest neighbours, so those need durations too
+        nearest = numpy.argsort(distances, kind='stable')[:10]
+        duration_dict = {
+            int(dest): (float(4 + 400 * distances[dest]), float(rng.uniform(1.5, 3)))
+            for dest in numpy.union1d(destinations, nearest)
+        }
+        kwargs = dict(
+            capacity=int(capacities[i])
+            , docked_init=int(docked[i])
+            , st_id=i
+            , demand_dict=dict(zip(intervals, demand.tolist()))
+            , dest_dict=dest_dict
+            , duration_dict=duration_dict
+            , latitude=float(latitudes[i])
+            , longitude=float(longitudes[i])
+        )
+        if i in warehouse_of:
+            city.add_station(WarehousedStation(warehouse=warehouses[warehouse_of[i]], **kwargs))
+        else:
+            city.add_station(Station(**kwargs))
+    city.compile_samplers()
+    return city
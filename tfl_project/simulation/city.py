@@ -1,9 +1,40 @@
+import pickle
+import random
+from copy import deepcopy
+from time import perf_counter
+
+import numpy
 from pandas import DataFrame
 
+from tfl_project.simulation.agent_pool import AgentPool
+from tfl_project.simulation.event_log import EventLog, EVENT_CODES, EVENT_KEYS, FAILED_END, FINISHED_JOURNEY, \
+    station_id_array
 from tfl_project.simulation.station import Station
 
 
+def substreams(seed_sequence: numpy.random.SeedSequence, n):
+    """The same children as seed_sequence.spawn(n) would give the first time, without changing seed_sequence"""
+    return [numpy.random.SeedSequence(seed_sequence.entropy, spawn_key=seed_sequence.spawn_key + (k,))
+            for k in range(n)]
+
+
+def generator_from_state(state):
+    """A numpy Generator restored from its bit_generator.state"""
+    generator = numpy.random.Generator(getattr(numpy.random, state['bit_generator'])())
+    generator.bit_generator.state = state
+    return generator
+
+
 class City:
+    # If set, a numpy Generator used for rerouted journeys' durations, keeping them out of stations' demand streams
+    reroute_rng = None
+    # Set by instrument()
+    _instrumented = False
+    PHASE_COLUMNS = (
+        'move_agents_seconds', 'request_demand_seconds', 'reroute_seconds', 'ticks', 'agents_arrived',
+        'journeys_requested', 'reroutes', 'events_logged'
+    )
+
     def __init__(self, interval_size=20):
         """
         The city class contains Agents and Stations, and has a time attribute.
@@ -16,15 +47,160 @@ class City:
         """
         self._stations = dict()
         self._warehouses = dict()
-        self._agents = []
-        self._time = 0
+        # The event log records stations by the order they were added to the city
+        self._station_index = dict()
+        self._station_ids = []
+        # Memoised by nearest_stations(): station id -> all stations, nearest first
+        self._nearest_stations = dict()
         self._interval_size = interval_size
+        # Set by save_initial_state()
+        self._initial_state = None
+        self.clear_run_state()
+
+    def clear_run_state(self):
+        """Sets up everything that changes during a simulation, apart from the bikes held by stations and warehouses.
+        Station parameters are never changed by simulating, so can be shared between simulations."""
+        # Agents' arrivals are measured on _travel_clock: the total time agents have travelled for
+        self._agents = AgentPool()
+        self._travel_clock = 0
+        self._time = 0
+        self._event_log = self.new_event_log()
+        # Filled by main_elapse_time() when instrumented: simulated hour -> PHASE_COLUMNS
+        self._phase_log = dict()
+
+    def instrument(self, enabled=True):
+        """Turns on (or off) recording of the time spent in, and the work done by, each phase of main_elapse_time(),
+        per simulated hour. See get_phase_df(). When off, this costs one attribute check per tick."""
+        self._instrumented = enabled
+
+    def save_initial_state(self):
+        """Remembers the number of bikes currently at each station and warehouse, so that reset() can return the city
+        to this state"""
+        self._initial_state = self._docked_state()
+
+    def reset(self):
+        """Returns the city to the state saved by save_initial_state(), discarding agents and the event log. This is
+        much cheaper than copying the city, because only the bikes held by each store need restoring."""
+        if self._initial_state is None:
+            raise ValueError("save_initial_state() must be called before reset()")
+        self._restore_docked(self._initial_state)
+        self.clear_run_state()
+
+    def _docked_state(self):
+        return (
+            {key: s._docked for key, s in self._stations.items()}
+            , {key: w._docked for key, w in self._warehouses.items()}
+        )
+
+    def _restore_docked(self, docked_state):
+        station_docked, warehouse_docked = docked_state
+        for key, docked in station_docked.items():
+            self._stations[key]._docked = docked
+        for key, docked in warehouse_docked.items():
+            self._warehouses[key]._docked = docked
+
+    def _random_state(self):
+        """The state of every random stream the simulation draws from. A Generator which several stations share is
+        recorded once, so that they still share it when restored."""
+        streams, stations = dict(), dict()
+        for key, s in self._stations.items():
+            if 'rng' in s.__dict__:
+                stations[key] = streams.setdefault(id(s.rng), (len(streams), s.rng.bit_generator.state))[0]
+        return dict(
+            python=random.getstate()
+            , station_class=Station.rng.bit_generator.state
+            , station_streams=[state for _, state in streams.values()]
+            , stations=stations
+            , reroute=None if self.reroute_rng is None else self.reroute_rng.bit_generator.state
+        )
+
+    def _restore_random_state(self, random_state):
+        random.setstate(random_state['python'])
+        Station.rng.bit_generator.state = random_state['station_class']
+        generators = [generator_from_state(state) for state in random_state['station_streams']]
+        for key, stream in random_state['stations'].items():
+            self._stations[key].rng = generators[stream]
+        if random_state['reroute'] is not None:
+            self.reroute_rng = generator_from_state(random_state['reroute'])
+
+    def checkpoint(self, location=None):
+        """
+        Captures everything that changes as the city is simulated: bikes at each station and warehouse, in-flight
+        agents, the state of the random streams, the time and the logs so far. restore() returns the city to this
+        point as many times as needed, so a shared stretch of simulation can be run once and several branches forked
+        from it. Station parameters are not included, so a checkpoint is only valid for the city it was taken from
+        (or a copy of it).
+        :param location: if given, the checkpoint is also pickled here, e.g. so a long simulation can be resumed
+        """
+        event_log = self._event_log
+        checkpoint = dict(
+            engine=type(self).__name__
+            , n_stations=len(self._station_ids)
+            , time=self._time
+            , travel_clock=self._travel_clock
+            , docked=deepcopy(self._docked_state())
+            , agents=deepcopy(self._agents)
+            , random_state=self._random_state()
+            , event_log=dict(
+                time_series={key: list(values) for key, values in event_log['time_series'].items()}
+                , totals=dict(event_log['totals'])
+                , events=event_log['events'].copy()
+            )
+            , phase_log=deepcopy(self._phase_log)
+        )
+        if location is not None:
+            with open(location, 'wb') as f:
+                pickle.dump(checkpoint, f)
+        return checkpoint
+
+    def restore(self, checkpoint, random_state=True):
+        """
+        Returns the city to the point captured by checkpoint().
+        :param checkpoint: a checkpoint, or the location it was pickled to
+        :param random_state: whether to restore the random streams too. If not, they carry on from where they are,
+            e.g. so that branches forked from one checkpoint can be seeded differently.
+        """
+        if not isinstance(checkpoint, dict):
+            with open(checkpoint, 'rb') as f:
+                checkpoint = pickle.load(f)
+        if checkpoint['engine'] != type(self).__name__ or checkpoint['n_stations'] != len(self._station_ids):
+            raise ValueError(f"Checkpoint of a {checkpoint['engine']} with {checkpoint['n_stations']} stations can't "
+                             f"be restored to a {type(self).__name__} with {len(self._station_ids)} stations")
+        self._restore_docked(deepcopy(checkpoint['docked']))
+        self._agents = deepcopy(checkpoint['agents'])
+        if random_state:
+            self._restore_random_state(checkpoint['random_state'])
+        self._time = checkpoint['time']
+        self._travel_clock = checkpoint['travel_clock']
+        saved_log = checkpoint['event_log']
         self._event_log = dict(
+            time_series={key: list(values) for key, values in saved_log['time_series'].items()}
+            , totals=dict(saved_log['totals'])
+            , events=saved_log['events'].copy()
+        )
+        self._phase_log = deepcopy(checkpoint['phase_log'])
+
+    @staticmethod
+    def new_event_log():
+        return dict(
             time_series=dict(time=[0], failed_starts=[0], failed_ends=[0], finished_journeys=[0])
             , totals=dict(failed_starts=0, failed_ends=0, finished_journeys=0)
-            , events=dict(time=[], start_st=[], end_st=[], orig_start_st=[], orig_end_st=[], event=[])
+            , events=EventLog()
         )
 
+    def __setstate__(self, state):
+        """Cities pickled before the station index and the agent pool existed are brought up to date"""
+        self.__dict__.update(state)
+        if '_station_index' not in state:
+            self._station_ids = list(self._stations.keys())
+            self._station_index = {key: i for i, key in enumerate(self._station_ids)}
+            self._nearest_stations = dict()
+            self._initial_state = None
+        if not isinstance(state.get('_agents'), AgentPool):
+            self.clear_run_state()
+        if '_phase_log' not in state:
+            self._phase_log = dict()
+
     def timeseries_log_append_t(self):
         """the time_series component of the event long is a dictionary of lists, which will easily convert to a
         DataFrame. Each t period the list must be extended"""
@@ -33,13 +209,50 @@ class City:
         self._event_log['time_series']['failed_ends'].append(0)
         self._event_log['time_series']['finished_journeys'].append(0)
 
+    def add_agent(self, start_st, dest_st, duration):
+        """Adds an agent setting off from start_st to the agent pool, and returns its slot. The bike is not undocked
+        here."""
+        start, dest = self._station_index[start_st.get_id()], self._station_index[dest_st.get_id()]
+        return self._agents.add(self._travel_clock + duration, dest, start, start, dest)[0]
+
+    def agent(self, slot):
+        """A User view of the in-flight agent in the given slot of the agent pool"""
+        if not self._agents.active[slot]:
+            raise KeyError(f"No agent is in slot {slot}")
+        return User.view(self, slot)
+
+    @property
+    def n_agents(self):
+        return len(self._agents)
+
     def move_agents(self, t):
         """Existing agents proceed with their journeys, potentially arriving at their destination.
-        Agents handle their own .arrival() logic as part of travel()
+        Only agents due to arrive are touched, and they arrive in the order they set off.
         In simulation conditions this is called by main_elapse_time()"""
-        for agent in self._agents:
-            agent.travel(t)
-        self.cleanup_agents()  # agents should not remove themselves whilst elapse_time is iterating over _agents
+        self._travel_clock += t
+        arriving = self._agents.arriving(self._travel_clock)
+        if len(arriving):
+            self.arrive(arriving)
+
+    def arrive(self, slots):
+        """Agents in the given slots try to dock at their destinations, in the order given. Those that dock have
+        finished and are removed from the pool, and the rest are flagged as needing a new destination."""
+        agents = self._agents
+        docked = numpy.zeros(len(slots), dtype=bool)
+        for i, dest in enumerate(agents.dest[slots].tolist()):
+            station = self._stations[self._station_ids[dest]]
+            if not station.is_full():
+                station.take_bike()
+                docked[i] = True
+        self.log_events(
+            numpy.where(docked, FINISHED_JOURNEY, FAILED_END)
+            , start_st=agents.last[slots]
+            , end_st=agents.dest[slots]
+            , orig_start_st=agents.orig_start[slots]
+            , orig_end_st=agents.orig_end[slots]
+        )
+        agents.strand(slots[~docked])
+        agents.remove(slots[docked])
 
     def request_demand(self, interval, t):
         """City asks stations to decide what journeys will originate at them, and will attempt to generate any
@@ -55,16 +268,32 @@ class City:
                 self.generate_journey(*j)
 
     def call_for_new_destinations(self):
-        """Simply instructs all agents to assign themselves a new destination if they need one"""
-        for agent in self._agents:
-            if agent.need_new_destination:
-                agent.determine_next_destination()
+        """Sends every agent who needs a new destination to the nearest available station"""
+        rerouting = self._agents.rerouting()
+        if len(rerouting):
+            self.reroute(rerouting)
+
+    def reroute(self, slots):
+        """Agents in the given slots set off for the nearest station to their current destination which is not
+        full. Agents stranded at the same station share one lookup and one call for durations."""
+        agents = self._agents
+        current = agents.dest[slots]
+        new_dests = numpy.empty_like(current)
+        durations = numpy.empty(len(slots), dtype=float)
+        for st in numpy.unique(current).tolist():
+            stranded = current == st
+            station = self._stations[self._station_ids[st]]
+            new_destination = self.nearest_available_station(station)
+            new_dests[stranded] = self._station_index[new_destination.get_id()]
+            durations[stranded] = station.pick_durations([new_destination.get_id()] * int(stranded.sum()),
+                                                         rng=self.reroute_rng)
+        agents.redirect(slots, new_dests, self._travel_clock + durations)
 
     def main_elapse_time(self, t=1):
         """
         This is where the bulk of simulation behaviour takes place.
         The phases are:
-            1. Existing agents travel(), during which they will handle their own arrival logic if they arrive at a dest.
+            1. Existing agents travel. Those arriving at a destination handle their own arrival logic.
                 City cleans-up any agents who have flagged themselves as finished (i.e. arrived)
             2. Stations decide what journeys (if any) they will request. They return journey parameters and City
                 will attempt to generate those journeys
@@ -76,10 +305,41 @@ class City:
         if self._time != 0:
             self.timeseries_log_append_t()
         current_interval = (self._time // self._interval_size) * self._interval_size
+        if self._instrumented:
+            self._instrumented_phases(current_interval, t)
+        else:
+            self.move_agents(t)
+            self.request_demand(interval=current_interval, t=t)
+            self.call_for_new_destinations()
+        self._time += t
+
+    def _instrumented_phases(self, current_interval, t):
+        """The phases of main_elapse_time(), timed and counted into the current hour's row of the phase log.
+        Counts come from the event log and agent pool rather than from within the phases, so that both engines are
+        measured the same way."""
+        totals = self._event_log['totals']
+        row = self._phase_log.setdefault(self._time // 60, dict.fromkeys(self.PHASE_COLUMNS, 0))
+        failed_starts, failed_ends, finished = totals['failed_starts'], totals['failed_ends'], \
+            totals['finished_journeys']
+        n_events, n_created = len(self._event_log['events']), self._agents.n_created
+
+        start = perf_counter()
         self.move_agents(t)
+        moved = perf_counter()
         self.request_demand(interval=current_interval, t=t)
+        requested = perf_counter()
         self.call_for_new_destinations()
-        self._time += t
+        rerouted = perf_counter()
+
+        row['move_agents_seconds'] += moved - start
+        row['request_demand_seconds'] += requested - moved
+        row['reroute_seconds'] += rerouted - requested
+        row['ticks'] += 1
+        row['agents_arrived'] += totals['failed_ends'] - failed_ends + totals['finished_journeys'] - finished
+        row['journeys_requested'] += totals['failed_starts'] - failed_starts + self._agents.n_created - n_created
+        # every agent who fails to dock is rerouted in the same tick
+        row['reroutes'] += totals['failed_ends'] - failed_ends
+        row['events_logged'] += len(self._event_log['events']) - n_events
 
     def generate_journey(self, start_st, dest_st, duration:int):
         """
@@ -89,10 +349,10 @@ class City:
             - A journey duration
         This method will attempt to generate a journey.
 
-        If the starting station is empty, the journey will count as a failed start immediately. An Agent will
-        not be instantiated in this case (as they could not even begin their journey).
+        If the starting station is empty, the journey will count as a failed start immediately. No agent is added
+        in this case (as they could not even begin their journey).
 
-        If the starting station is not empty, an Agent will be instantiated and undock a bike from the Station.
+        If the starting station is not empty, a bike is undocked from the Station and an agent added to the pool.
 
         Note: the 'demand' for journeys is generated by the stations themselves: the stations ask City
         to generate journeys on their behalf. As part of City.request_demand()
@@ -101,13 +361,8 @@ class City:
         if start_st.is_empty():
             self.log_failed_start(start_st=start_st, end_st=dest_st, orig_start_st=start_st, orig_end_st=dest_st)
         else:
-            u = User(self, dest_st, duration, start_st=start_st)
-            self._agents.append(u)
-            u.undock_bike(start_st)
-
-    def cleanup_agents(self):
-        """remove agents from the city if they are finished"""
-        self._agents = [a for a in self._agents if not a.finished]
+            self.add_agent(start_st, dest_st, duration)
+            start_st.give_bike()
 
     def add_station(self, s):
         """
@@ -123,6 +378,24 @@ class City:
 
         self._stations[key] = s
         s._city = self
+        self._station_index[key] = len(self._station_ids)
+        self._station_ids.append(key)
+        self._nearest_stations = dict()
+
+    def remove_station(self, st_id):
+        """
+        Removes the station with the given id from the city, and returns it. Stations added after it move down the
+        index which the event log and agents record stations by, so this is for setting a city up rather than for
+        use mid-simulation.
+        """
+        s = self._stations.pop(st_id)
+        s._city = None
+        self._station_ids.remove(st_id)
+        self._station_index = {key: i for i, key in enumerate(self._station_ids)}
+        self._nearest_stations = dict()
+        if self._initial_state is not None:
+            self._initial_state[0].pop(st_id, None)
+        return s
 
     def add_warehouse(self, w):
         key = w.get_id()
@@ -131,6 +404,35 @@ class City:
         self._warehouses[key] = w
         w._city = self
 
+    def compile_samplers(self, missing_only=False):
+        """Asks every station to pre-compute its destination and duration samplers. Should be called once stations
+        have been fully parametrised.
+        With missing_only, stations whose samplers are already up to date keep them, so that samplers shared with
+        other cities (e.g. by Scenario.build) are not duplicated, and parameters waiting to be loaded lazily are left
+        to be compiled when they are."""
+        for station in self._stations.values():
+            station.compile_samplers(missing_only)
+
+    def nearest_stations(self, station):
+        """Returns a list of every station in the city, ordered by distance from the given station. Equal distances
+        keep the order that stations were added to the city, and stations without co-ordinates come last.
+        The ordering is computed once per station and remembered, so it will not reflect co-ordinates changed
+        afterwards."""
+        key = station.get_id()
+        if key not in self._nearest_stations:
+            stations = list(self._stations.values())
+            distances = numpy.array([station.distance_from(st) for st in stations], dtype=float)
+            # a stable argsort places nan distances last
+            self._nearest_stations[key] = [stations[i] for i in numpy.argsort(distances, kind='stable')]
+        return self._nearest_stations[key]
+
+    def nearest_available_station(self, station):
+        """The nearest station to the given station which is not full (which may be the station itself)"""
+        for st in self.nearest_stations(station):
+            if not st.is_full():
+                return st
+        raise ValueError("Every station is full: there is nowhere to reroute to")
+
     def get_station(self, key):
         return self._stations[key]
 
@@ -140,12 +442,24 @@ class City:
     def log_event(self, event_key, start_st, end_st, orig_start_st, orig_end_st):
         self._event_log['totals'][event_key] += 1
         self._event_log['time_series'][event_key][-1] += 1
-        self._event_log['events']['time'].append(self._time)
-        self._event_log['events']['start_st'].append(start_st.get_id())
-        self._event_log['events']['end_st'].append(end_st.get_id())
-        self._event_log['events']['event'].append(event_key)
-        self._event_log['events']['orig_start_st'].append(orig_start_st.get_id())
-        self._event_log['events']['orig_end_st'].append(orig_end_st.get_id())
+        self._event_log['events'].append(
+            self._time
+            , EVENT_CODES[event_key]
+            , self._station_index[start_st.get_id()]
+            , self._station_index[end_st.get_id()]
+            , self._station_index[orig_start_st.get_id()]
+            , self._station_index[orig_end_st.get_id()]
+        )
+
+    def log_events(self, event, start_st, end_st, orig_start_st, orig_end_st):
+        """Logs a batch of events. Stations are given as index arrays, and event is either one event code or an
+        array of codes (see EVENT_KEYS)"""
+        event = numpy.broadcast_to(event, start_st.shape)
+        counts = numpy.bincount(event, minlength=len(EVENT_KEYS))
+        for code, event_key in enumerate(EVENT_KEYS):
+            self._event_log['totals'][event_key] += int(counts[code])
+            self._event_log['time_series'][event_key][-1] += int(counts[code])
+        self._event_log['events'].extend(self._time, event, start_st, end_st, orig_start_st, orig_end_st)
 
     def log_failed_end(self, start_st, end_st, orig_start_st, orig_end_st):
         self.log_event('failed_ends', start_st, end_st, orig_start_st, orig_end_st)
@@ -160,7 +474,14 @@ class City:
         return DataFrame.from_dict(self._event_log['time_series'])
 
     def get_events_df(self):
-        return DataFrame.from_dict(self._event_log['events'])
+        return self._event_log['events'].to_dataframe(station_id_array(self._station_ids))
+
+    def get_phase_df(self):
+        """Per simulated hour: cumulative wall time in each phase of main_elapse_time() and the work each did. Empty
+        unless instrument() was called before simulating."""
+        df = DataFrame.from_dict(self._phase_log, orient='index', columns=list(self.PHASE_COLUMNS))
+        df.index.name = 'hour'
+        return df.sort_index().reset_index()
 
     @property
     def stations(self):
@@ -173,73 +494,66 @@ class City:
 
 class Agent:
     def __init__(self, city: City, destination: Station, duration: int, start_st):
-        """This is the parent class / interface for Users and Trucks"""
-        self._current_destination = destination
-        self._last_departed_station = start_st
-        self._remaining_duration = duration
+        """
+        This is the parent class / interface for Users and Trucks.
+        Cities keep their agents' state in an AgentPool rather than in Agent objects: an Agent is a view onto one slot
+        of the pool, so instantiating one adds an agent to the city. A view is only valid while its agent is in
+        flight, as the slot is reused once the agent finishes.
+        """
         self._city = city
-        self.finished = False
-        self.need_new_destination = False
+        self.slot = city.add_agent(start_st, destination, duration)
 
-    def dock_bike(self):
-        pass
+    @classmethod
+    def view(cls, city: City, slot):
+        """A view onto an agent already in the city's pool"""
+        agent = cls.__new__(cls)
+        agent._city = city
+        agent.slot = slot
+        return agent
 
-    def undock_bike(self, station: Station):
-        pass
+    def _station(self, index):
+        return self._city.get_station(self._city._station_ids[index])
 
-    def determine_next_destination(self):
-        candidates = [st for st in self._city._stations.values() if not st.is_full()]
-        candidates.sort(
-            key=lambda x: x.distance_from(self._current_destination)
-        )
-        new_destination = candidates[0]
-        new_duration = self._current_destination.pick_duration(new_destination.get_id())
-        self._last_departed_station = self._current_destination
-        self._current_destination = new_destination
-        self._remaining_duration = new_duration
-        self.need_new_destination = False
-
-    def arrival(self):
-        pass
+    @property
+    def number(self):
+        return int(self._city._agents.number[self.slot])
 
-    def travel(self, t):
-        """Reduces remaining duration and calls Agent.arrival() if user has arrived"""
-        self._remaining_duration -= t
-        if self._remaining_duration < 0.5:  # TODO: check you are happy with this condition
-            self.arrival()
+    @property
+    def _current_destination(self):
+        return self._station(self._city._agents.dest[self.slot])
 
+    @property
+    def _last_departed_station(self):
+        return self._station(self._city._agents.last[self.slot])
 
-class User(Agent):
+    @property
+    def _remaining_duration(self):
+        return self._city._agents.due[self.slot] - self._city._travel_clock
 
-    def __init__(self, city, destination, duration, start_st):
-        super().__init__(city, destination, duration, start_st)
-        # Users remember their original departures and destinations, even if they encounter full stations
-        self.original_start_st = start_st
-        self.original_end_st = destination
+    @property
+    def need_new_destination(self):
+        return bool(self._city._agents.reroute[self.slot])
 
-    def arrival(self):
-        """Overrides arrival with User behaviour"""
-        if self._current_destination.is_full():
-            self._city.log_failed_end(
-                start_st=self._last_departed_station
-                , end_st=self._current_destination
-                , orig_start_st=self.original_start_st
-                , orig_end_st=self.original_end_st
-            )
-            self.need_new_destination = True
-        else:
-            self.dock_bike()
-
-    def dock_bike(self):
-        """A user is removed after docking a bike successfully"""
-        self._current_destination.take_bike()
-        self.finished = True
-        self._city.log_finished_journey(
-                start_st=self._last_departed_station
-                , end_st=self._current_destination
-                , orig_start_st=self.original_start_st
-                , orig_end_st=self.original_end_st
-            )
+    @property
+    def finished(self):
+        return not self._city._agents.active[self.slot]
 
     def undock_bike(self, station: Station):
         station.give_bike()
+
+    def determine_next_destination(self):
+        self._city.reroute(numpy.array([self.slot]))
+
+    def arrival(self):
+        self._city.arrive(numpy.array([self.slot]))
+
+
+class User(Agent):
+    @property
+    def original_start_st(self):
+        """Users remember their original departures and destinations, even if they encounter full stations"""
+        return self._station(self._city._agents.orig_start[self.slot])
+
+    @property
+    def original_end_st(self):
+        return self._station(self._city._agents.orig_end[self.slot])
@@ -0,0 +1,139 @@
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+
+class DurationCache:
+    def __init__(self, location, key):
+        """
+        Fitted gumbel_r duration parameters of many start stations, in one SQLite file. A file can hold several sets
+        of parameters side by side, one per key: a hash of the LondonCreator parameters they were fitted with (see
+        LondonCreator.parameter_key). This cache reads and writes the set of key, whose header holds those parameters.
+        A station's parameters are written in a single transaction, so a build which is interrupted (or running in
+        another process) never leaves a station half-written, and stations present in the cache are always complete.
+        Use open_cache() rather than instantiating this directly, so each file is only opened once per process.
+        """
+        self.location = Path(location)
+        self.key = key
+        self._connection = None
+        self._pid = None
+        self._header = None
+
+    def __getstate__(self):
+        # connections can't be pickled: the copy opens its own
+        return dict(location=self.location, key=self.key, _connection=None, _pid=None, _header=self._header)
+
+    @property
+    def connection(self):
+        # a connection inherited by a forked process must not be used, so each process opens its own
+        if self._connection is None or self._pid != os.getpid():
+            if not self.location.parent.exists():
+                print(f"adding new cache directory: {str(self.location.parent)}")
+                self.location.parent.mkdir(parents=True)
+            self._connection = sqlite3.connect(str(self.location), timeout=60)
+            self._pid = os.getpid()
+            # readers aren't blocked while a build writes
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            with self._connection:
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS parameter_sets (key TEXT PRIMARY KEY, parameters TEXT NOT NULL)"
+                )
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS stations (key TEXT, start_id INTEGER, PRIMARY KEY (key, start_id))"
+                )
+                self._connection.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS duration_params (
+                        key TEXT NOT NULL
+                        ,start_id INTEGER NOT NULL
+                        ,position INTEGER NOT NULL
+                        ,end_id INTEGER NOT NULL
+                        ,loc REAL NOT NULL
+                        ,scale REAL NOT NULL
+                        ,PRIMARY KEY (key, start_id, position)
+                    ) WITHOUT ROWID
+                    """
+                )
+        return self._connection
+
+    def header(self):
+        """The parameters the cache was made with, or None if it is new. Only read from the file once."""
+        if self._header is None:
+            row = self.connection.execute("SELECT parameters FROM parameter_sets WHERE key = ?", (self.key,)).fetchone()
+            if row is not None:
+                self._header = json.loads(row[0])
+        return self._header
+
+    def write_header(self, parameters: dict):
+        """Records the parameters the cache is made with, unless it already has some. Returns the cache's header."""
+        with self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO parameter_sets VALUES (?, ?)",
+                                    (self.key, json.dumps(parameters)))
+        self._header = None
+        return self.header()
+
+    def cached_ids(self):
+        """Ids of the start stations in the cache"""
+        return {row[0] for row in self.connection.execute("SELECT start_id FROM stations WHERE key = ?", (self.key,))}
+
+    def get(self, start_id):
+        """A station's {end_id: (loc, scale)} parameters. Raises KeyError if it isn't cached."""
+        rows = self.connection.execute(
+            "SELECT end_id, loc, scale FROM duration_params WHERE key = ? AND start_id = ? ORDER BY position",
+            (self.key, int(start_id))
+        ).fetchall()
+        if not rows and not self.connection.execute("SELECT 1 FROM stations WHERE key = ? AND start_id = ?",
+                                                    (self.key, int(start_id))).fetchone():
+            raise KeyError(start_id)
+        return {end_id: (loc, scale) for end_id, loc, scale in rows}
+
+    def load_all(self):
+        """Every cached station's parameters, as {start_id: {end_id: (loc, scale)}}, in one read"""
+        params = {start_id: {} for start_id in self.cached_ids()}
+        for start_id, end_id, loc, scale in self.connection.execute(
+                "SELECT start_id, end_id, loc, scale FROM duration_params WHERE key = ? ORDER BY start_id, position",
+                (self.key,)):
+            params[start_id][end_id] = (loc, scale)
+        return params
+
+    def put(self, start_id, params: dict):
+        """Caches (or replaces) a station's {end_id: (loc, scale)} parameters, atomically"""
+        self.put_many({start_id: params})
+
+    def put_many(self, params_by_station: dict):
+        """Caches several stations' parameters in one transaction"""
+        with self.connection:
+            for start_id, params in params_by_station.items():
+                start_id = int(start_id)
+                self.connection.execute("DELETE FROM duration_params WHERE key = ? AND start_id = ?",
+                                        (self.key, start_id))
+                self.connection.executemany(
+                    "INSERT INTO duration_params VALUES (?, ?, ?, ?, ?, ?)",
+                    [(self.key, start_id, position, int(end_id), float(p[0]), float(p[1]))
+                     for position, (end_id, p) in enumerate(params.items())]
+                )
+                self.connection.execute("INSERT OR IGNORE INTO stations VALUES (?, ?)", (self.key, start_id))
+
+    def import_json_directory(self, directory):
+        """Copies the stations of a cache of the older layout (a last_used_params.json, and one json per station) into
+        this one. Checking the older cache's parameters is left to the caller."""
+        directory = Path(directory)
+        params_by_station = {}
+        for json_file in directory.glob('*.json'):
+            if json_file.name != 'last_used_params.json':
+                with open(json_file) as f:
+                    params_by_station[int(json_file.stem)] = {int(k): tuple(v) for k, v in json.load(f).items()}
+        self.put_many(params_by_station)
+        print(f"imported {len(params_by_station)} stations' duration parameters from {directory} to {self.location}")
+
+
+_open_caches = dict()
+
+
+def open_cache(location, key):
+    """The DurationCache of key at location, shared by everything in this process which uses it"""
+    location = Path(location)
+    if (location.resolve(), key) not in _open_caches:
+        _open_caches[location.resolve(), key] = DurationCache(location, key)
+    return _open_caches[location.resolve(), key]
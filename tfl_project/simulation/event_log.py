@@ -0,0 +1,138 @@
+import numpy
+from pandas import DataFrame
+
+EVENT_KEYS = ('failed_starts', 'failed_ends', 'finished_journeys')
+FAILED_START, FAILED_END, FINISHED_JOURNEY = range(3)
+EVENT_CODES = {key: code for code, key in enumerate(EVENT_KEYS)}
+
+STATION_COLUMNS = ('start_st', 'end_st', 'orig_start_st', 'orig_end_st')
+COLUMN_DTYPES = dict(
+    time=numpy.int16
+    , start_st=numpy.int32
+    , end_st=numpy.int32
+    , orig_start_st=numpy.int32
+    , orig_end_st=numpy.int32
+    , event=numpy.int8
+)
+
+
+def station_id_array(st_ids):
+    """An array for looking up station ids by index: integer if the ids allow it, otherwise object"""
+    if all(isinstance(st_id, (int, numpy.integer)) for st_id in st_ids):
+        return numpy.array(st_ids, dtype=numpy.int64)
+    return numpy.array(st_ids, dtype=object)
+
+
+class EventLog:
+    MAX_TIME = numpy.iinfo(numpy.int16).max
+
+    def __init__(self, chunk_size=2**16):
+        """
+        A log of simulation events, held as typed column buffers rather than Python lists. Stations are recorded as
+        int32 indices (the caller keeps the index -> station id lookup), times as int16 minutes and events as int8
+        codes (see EVENT_KEYS).
+
+        Buffers are preallocated in chunks of chunk_size rows. A full chunk is kept as it is and a new one started, so
+        growing the log never copies what has already been written.
+        """
+        self._chunk_size = chunk_size
+        self._full_chunks = []
+        self._new_chunk()
+
+    def _new_chunk(self):
+        self._chunk = {col: numpy.empty(self._chunk_size, dtype=dtype) for col, dtype in COLUMN_DTYPES.items()}
+        self._position = 0
+
+    def __len__(self):
+        return len(self._full_chunks) * self._chunk_size + self._position
+
+    def append(self, time, event, start_st, end_st, orig_start_st, orig_end_st):
+        """Logs one event. Stations are given by index and event by code."""
+        if time > self.MAX_TIME:
+            raise OverflowError(f"The event log can only record times up to {self.MAX_TIME} minutes")
+        if self._position == self._chunk_size:
+            self._full_chunks.append(self._chunk)
+            self._new_chunk()
+        chunk, i = self._chunk, self._position
+        chunk['time'][i] = time
+        chunk['event'][i] = event
+        chunk['start_st'][i] = start_st
+        chunk['end_st'][i] = end_st
+        chunk['orig_start_st'][i] = orig_start_st
+        chunk['orig_end_st'][i] = orig_end_st
+        self._position += 1
+
+    def extend(self, time, event, start_st, end_st, orig_start_st, orig_end_st):
+        """Logs a batch of events which happened at the same time. Stations are index arrays, and event is either
+        one code or an array of codes."""
+        if time > self.MAX_TIME:
+            raise OverflowError(f"The event log can only record times up to {self.MAX_TIME} minutes")
+        columns = dict(
+            event=numpy.broadcast_to(event, numpy.shape(start_st))
+            , start_st=start_st
+            , end_st=end_st
+            , orig_start_st=orig_start_st
+            , orig_end_st=orig_end_st
+        )
+        written, n = 0, len(start_st)
+        while written < n:
+            if self._position == self._chunk_size:
+                self._full_chunks.append(self._chunk)
+                self._new_chunk()
+            size = min(n - written, self._chunk_size - self._position)
+            rows = slice(self._position, self._position + size)
+            self._chunk['time'][rows] = time
+            for col, values in columns.items():
+                self._chunk[col][rows] = values[written:written + size]
+            written += size
+            self._position += size
+
+    def copy(self):
+        """A copy of the log which can be extended independently. Full chunks are never written to again, so they are
+        shared rather than copied."""
+        log = EventLog.__new__(EventLog)
+        log._chunk_size = self._chunk_size
+        log._full_chunks = list(self._full_chunks)
+        log._chunk = {col: values.copy() for col, values in self._chunk.items()}
+        log._position = self._position
+        return log
+
+    def chunks(self):
+        """The filled part of every chunk, as dictionaries of column arrays. These are views: nothing is copied."""
+        for chunk in self._full_chunks:
+            yield chunk
+        yield {col: values[:self._position] for col, values in self._chunk.items()}
+
+    def column(self, col):
+        """A single column for the whole log. Only copied if the log spans more than one chunk."""
+        parts = [chunk[col] for chunk in self.chunks()]
+        return parts[0] if len(parts) == 1 else numpy.concatenate(parts)
+
+    def event_keys(self):
+        """The event column as EVENT_KEYS strings"""
+        return numpy.array(EVENT_KEYS, dtype=object)[self.column('event')]
+
+    def to_dataframe(self, station_ids):
+        """
+        Converts the log into the DataFrame returned by City.get_events_df.
+        :param station_ids: array such that station_ids[i] is the id of the station with index i
+        """
+        df = DataFrame({'time': self.column('time')})
+        for col in STATION_COLUMNS:
+            df[col] = station_ids[self.column(col)]
+        df['event'] = self.event_keys()
+        return df
+
+    def to_arrow(self, station_ids):
+        """As to_dataframe, but as a pyarrow Table whose columns keep the log's chunks rather than concatenating them.
+        Requires pyarrow, which is not otherwise a dependency."""
+        import pyarrow
+
+        chunks = list(self.chunks())
+        columns = {'time': pyarrow.chunked_array([chunk['time'] for chunk in chunks])}
+        for col in STATION_COLUMNS:
+            columns[col] = pyarrow.chunked_array([station_ids[chunk[col]] for chunk in chunks])
+        columns['event'] = pyarrow.chunked_array([
+            pyarrow.DictionaryArray.from_arrays(chunk['event'], list(EVENT_KEYS)) for chunk in chunks
+        ])
+        return pyarrow.table(columns)
@@ -0,0 +1,336 @@
+import json
+from contextlib import contextmanager
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import numpy
+
+from tfl_project.simulation.city import City
+from tfl_project.simulation.station import Station, Store, WarehousedStation
+
+# Increment whenever the arrays or bundle.json change, so that old bundles are rebuilt rather than misread
+FORMAT_VERSION = 1
+ARRAY_NAMES = (
+    'capacity', 'docked_init', 'latitude', 'longitude', 'st_warehouse',
+    'wh_capacity', 'wh_docked_init', 'wh_latitude', 'wh_longitude',
+    'demand', 'dest_indptr', 'dest_idx', 'dest_volumes', 'dest_cum', 'dur_indptr', 'dur_keys', 'dur_loc', 'dur_scale'
+)
+# The arrays which a Scenario can change: bikes, docks and warehouses. They are small, so they can be sent to workers
+# alongside a shared bundle of the base city rather than bundling every scenario in full (see with_state)
+STATE_ARRAY_NAMES = ('capacity', 'docked_init', 'st_warehouse', 'wh_capacity', 'wh_docked_init', 'wh_latitude',
+                     'wh_longitude')
+
+
+class IncompatibleBundleError(Exception):
+    pass
+
+
+def _json_id(st_id):
+    """Station ids as json will store them: numpy integers become ints"""
+    return int(st_id) if isinstance(st_id, numpy.integer) else st_id
+
+
+class ParameterBundle:
+    def __init__(self, arrays: dict, station_ids, warehouse_ids, intervals, interval_size, common_names=None,
+                 unpacked=None):
+        """
+        Everything an ArrayCity needs to know about a city, packed into flat NumPy arrays rather than per-station
+        dictionaries. Stations and warehouses are referred to by index, in the order of station_ids and
+        warehouse_ids.
+            capacity, docked_init, latitude, longitude: per station (latitude and longitude are nan if unknown)
+            st_warehouse: per station, the index of its warehouse, or -1 if it isn't a WarehousedStation
+            wh_capacity, wh_docked_init, wh_latitude, wh_longitude: per warehouse
+            demand: (interval x station) journeys per minute, with intervals in the order of intervals
+            dest_idx, dest_volumes, dest_cum: for each interval in turn, and within that each station in turn, the
+                possible destinations, their journey volumes and their cumulative probabilities. Station i's
+                probabilities are offset by i.
+            dest_indptr: (interval x station+1) positions in dest_idx where each station's destinations start
+            dur_keys, dur_loc, dur_scale: gumbel_r parameters of every (origin, destination) pair, keyed and sorted by
+                origin*n + destination
+            dur_indptr: positions in dur_keys where each origin's pairs start
+        The arrays only hold what can be simulated. unpacked keeps the rest of the stations' dictionaries, so that
+        to_city() gives them back as they were: demand entries of 0, _dest_dict entries which include destinations
+        that aren't stations of the city or have no volume (kept whole), and durations to destinations that aren't
+        stations of the city.
+
+        A bundle saved with save() can be loaded with load(), which memory-maps the arrays rather than reading them.
+        Several processes which load the same bundle therefore share one read-only copy of the parameters. This is
+        also how LondonCreator stores cities: to_city() turns a bundle back into a City of Station objects.
+        """
+        self.arrays = arrays
+        self.station_ids = list(station_ids)
+        self.warehouse_ids = list(warehouse_ids)
+        self.intervals = list(intervals)
+        self.interval_size = interval_size
+        self.common_names = list(common_names) if common_names is not None else [None] * len(self.station_ids)
+        self.unpacked = unpacked if unpacked is not None else dict(demand=[], destinations=[], durations=[])
+        # set when loaded from disk, so that pickling sends the location rather than the arrays
+        self.location = None
+        # set by with_state, and sent along with the location
+        self.state = None
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['arrays'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    @property
+    def nbytes(self):
+        return sum(values.nbytes for values in self.arrays.values())
+
+    @classmethod
+    def from_city(cls, city):
+        """Packs the parameters of the city's stations and warehouses"""
+        stations = list(city.stations.values())
+        st_ids = [s.get_id() for s in stations]
+        st_index = {st_id: i for i, st_id in enumerate(st_ids)}
+        arrays = dict(
+            latitude=numpy.array([numpy.nan if s._latitude is None else s._latitude for s in stations], dtype=float)
+            , longitude=numpy.array([numpy.nan if s._longitude is None else s._longitude for s in stations],
+                                    dtype=float)
+        )
+        arrays.update(cls._pack_state(city))
+        intervals = set()
+        for s in stations:
+            intervals.update(s._demand_dict.keys())
+            intervals.update(s._dest_dict.keys())
+        intervals = sorted(intervals)
+        unpacked = dict(demand=[], destinations=[], durations=[])
+        arrays.update(cls._pack_demand(stations, st_index, intervals, unpacked))
+        arrays.update(cls._pack_durations(stations, st_index, unpacked))
+        common_names = [getattr(s, '_common_name', None) for s in stations]
+        return cls(arrays, st_ids, list(city.warehouses.keys()), intervals, city._interval_size, common_names,
+                   unpacked)
+
+    @staticmethod
+    def _pack_state(city):
+        stations = list(city.stations.values())
+        wh_index = {wh_id: i for i, wh_id in enumerate(city.warehouses.keys())}
+        return dict(
+            capacity=numpy.array([s._capacity for s in stations], dtype=numpy.int64)
+            , docked_init=numpy.array([s._docked for s in stations], dtype=numpy.int64)
+            , st_warehouse=numpy.array([wh_index[s._warehouse.get_id()] if isinstance(s, WarehousedStation) else -1
+                                        for s in stations], dtype=numpy.int64)
+            , wh_capacity=numpy.array([w._capacity for w in city.warehouses.values()], dtype=numpy.int64)
+            , wh_docked_init=numpy.array([w._docked for w in city.warehouses.values()], dtype=numpy.int64)
+            , wh_latitude=numpy.array([numpy.nan if w._latitude is None else w._latitude
+                                       for w in city.warehouses.values()], dtype=float)
+            , wh_longitude=numpy.array([numpy.nan if w._longitude is None else w._longitude
+                                        for w in city.warehouses.values()], dtype=float)
+        )
+
+    def city_state(self, city):
+        """The STATE_ARRAY_NAMES arrays (and warehouse ids) of city, a variant of the bundle's city with the same
+        stations in the same order, e.g. one built by Scenario.build. Raises ValueError if the stations differ."""
+        if [s.get_id() for s in city.stations.values()] != self.station_ids:
+            raise ValueError("The city's stations differ from the bundle's")
+        state = self._pack_state(city)
+        state['warehouse_ids'] = list(city.warehouses.keys())
+        return state
+
+    def with_state(self, state: dict):
+        """A bundle which shares this one's parameter arrays, with bikes, docks and warehouses from state (see
+        city_state). A memory-mapped bundle stays memory-mapped, and pickles as its location and the small state."""
+        arrays = dict(self.arrays)
+        arrays.update((name, state[name]) for name in STATE_ARRAY_NAMES)
+        bundle = ParameterBundle(arrays, self.station_ids, state['warehouse_ids'], self.intervals, self.interval_size,
+                                 self.common_names, self.unpacked)
+        bundle.location = self.location
+        bundle.state = state
+        return bundle
+
+    @staticmethod
+    def _pack_demand(stations, st_index, intervals, unpacked):
+        n = len(stations)
+        demand = numpy.zeros((len(intervals), n))
+        dest_indptr = numpy.zeros((len(intervals), n + 1), dtype=numpy.int64)
+        idx_parts, volume_parts, cum_parts = [], [], []
+        position = 0
+        for row, interval in enumerate(intervals):
+            dest_indptr[row, 0] = position
+            for i, s in enumerate(stations):
+                demand[row, i] = s._demand_dict.get(interval, 0)
+                if interval in s._demand_dict and not demand[row, i]:
+                    unpacked['demand'].append([i, interval])
+                entry = s._dest_dict.get(interval)
+                dests, volumes = [], []
+                if entry is not None:
+                    for dest_id, volume in zip(entry['destinations'], entry['volumes']):
+                        if dest_id in st_index:
+                            dests.append(st_index[dest_id])
+                            volumes.append(volume)
+                    if len(dests) < len(entry['destinations']) or not sum(volumes) > 0:
+                        unpacked['destinations'].append([i, interval, list(entry['destinations']),
+                                                         list(entry['volumes'])])
+                if dests and sum(volumes) > 0:
+                    cum = numpy.cumsum(volumes, dtype=float) / sum(volumes)
+                    cum[-1] = 1.0
+                    idx_parts.append(numpy.array(dests, dtype=numpy.int64))
+                    volume_parts.append(numpy.array(volumes))
+                    cum_parts.append(cum + i)
+                    position += len(dests)
+                dest_indptr[row, i + 1] = position
+        return dict(
+            demand=demand
+            , dest_indptr=dest_indptr
+            , dest_idx=numpy.concatenate(idx_parts) if idx_parts else numpy.zeros(0, dtype=numpy.int64)
+            , dest_volumes=numpy.concatenate(volume_parts) if volume_parts else numpy.zeros(0, dtype=numpy.int64)
+            , dest_cum=numpy.concatenate(cum_parts) if cum_parts else numpy.zeros(0)
+        )
+
+    @staticmethod
+    def _pack_durations(stations, st_index, unpacked):
+        n = len(stations)
+        keys, locs, scales = [], [], []
+        dur_indptr = numpy.zeros(n + 1, dtype=numpy.int64)
+        for i, s in enumerate(stations):
+            entries = sorted(
+                (st_index[dest_id], params) for dest_id, params in s._duration_dict.items() if dest_id in st_index
+            )
+            unpacked['durations'].extend([i, dest_id, list(params)] for dest_id, params in s._duration_dict.items()
+                                         if dest_id not in st_index)
+            for j, params in entries:
+                keys.append(i * n + j)
+                locs.append(params[0])
+                scales.append(params[1])
+            dur_indptr[i + 1] = dur_indptr[i] + len(entries)
+        return dict(
+            dur_indptr=dur_indptr
+            , dur_keys=numpy.array(keys, dtype=numpy.int64)
+            , dur_loc=numpy.array(locs, dtype=float)
+            , dur_scale=numpy.array(scales, dtype=float)
+        )
+
+    def save(self, directory):
+        """Writes each array to directory as a .npy file, with the ids and intervals in bundle.json"""
+        directory = Path(directory)
+        if not directory.exists():
+            directory.mkdir(parents=True)
+        for name in ARRAY_NAMES:
+            numpy.save(directory / (name + '.npy'), self.arrays[name])
+        with open(directory / 'bundle.json', 'w') as f:
+            json.dump(dict(
+                version=FORMAT_VERSION
+                , station_ids=[_json_id(st_id) for st_id in self.station_ids]
+                , warehouse_ids=[_json_id(wh_id) for wh_id in self.warehouse_ids]
+                , intervals=[int(interval) for interval in self.intervals]
+                , interval_size=self.interval_size
+                , common_names=self.common_names
+                , unpacked=self.unpacked
+            ), f, default=_json_id)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Loads a bundle written by save(). With mmap, arrays are memory-mapped read-only, so they are only paged in
+        as they are used and are shared with any other process that has loaded the same bundle."""
+        directory = Path(directory)
+        with open(directory / 'bundle.json') as f:
+            meta = json.load(f)
+        if meta.get('version') != FORMAT_VERSION:
+            raise IncompatibleBundleError(f"{directory} holds a version {meta.get('version')} bundle, but version "
+                                          f"{FORMAT_VERSION} is needed. It should be rebuilt.")
+        arrays = {name: numpy.load(directory / (name + '.npy'), mmap_mode='r' if mmap else None)
+                  for name in ARRAY_NAMES}
+        # bundles saved before unpacked was kept simply lack those entries
+        bundle = cls(arrays, meta['station_ids'], meta['warehouse_ids'], meta['intervals'], meta['interval_size'],
+                     meta['common_names'], meta.get('unpacked'))
+        if mmap:
+            bundle.location = directory
+        return bundle
+
+    def to_city(self):
+        """A new City with a Station (or WarehousedStation) for every station in the bundle, with its samplers
+        compiled, ready to simulate. The stations' dictionaries are as they were in the city the bundle was made from,
+        except that duration parameters are ordered by destination station, followed by any to destinations which
+        aren't stations of the city."""
+        city = City(interval_size=self.interval_size)
+        warehouses = []
+        for w, wh_id in enumerate(self.warehouse_ids):
+            warehouses.append(Store(capacity=int(self.wh_capacity[w]), docked_init=int(self.wh_docked_init[w]),
+                                    st_id=wh_id, latitude=float(self.wh_latitude[w]),
+                                    longitude=float(self.wh_longitude[w])))
+            city.add_warehouse(warehouses[-1])
+        st_ids = self.station_ids
+        # converted to python objects once, rather than once per slice
+        demand = self.demand.tolist()
+        dest_indptr = self.dest_indptr.tolist()
+        dest_id_array = numpy.array(st_ids)[self.dest_idx]
+        dest_ids = dest_id_array.tolist()
+        dest_volumes = self.dest_volumes.tolist()
+        # every station's destination samplers are slices of one cumulative sum
+        cum_volumes = numpy.r_[0., numpy.cumsum(self.dest_volumes, dtype=float)]
+        dur_indptr = self.dur_indptr.tolist()
+        dur_ids = numpy.array(st_ids)[self.dur_keys % len(st_ids)].tolist()
+        dur_params = list(zip(self.dur_loc.tolist(), self.dur_scale.tolist()))
+        unpacked_demand = {(i, interval) for i, interval in self.unpacked['demand']}
+        unpacked_dests = {(i, interval): {'destinations': dests, 'volumes': volumes}
+                          for i, interval, dests, volumes in self.unpacked['destinations']}
+        unpacked_durations = [dict() for _ in st_ids]
+        for i, dest_id, params in self.unpacked['durations']:
+            unpacked_durations[i][dest_id] = tuple(params)
+        for i, st_id in enumerate(st_ids):
+            demand_dict, dest_dict, dest_samplers = {}, {}, {}
+            for row, interval in enumerate(self.intervals):
+                if demand[row][i] or (i, interval) in unpacked_demand:
+                    demand_dict[interval] = demand[row][i]
+                start, stop = dest_indptr[row][i], dest_indptr[row][i + 1]
+                if stop > start:
+                    dest_dict[interval] = {'destinations': dest_ids[start:stop], 'volumes': dest_volumes[start:stop]}
+                    dest_samplers[interval] = (dest_id_array[start:stop],
+                                               cum_volumes[start + 1:stop + 1] - cum_volumes[start])
+                if (i, interval) in unpacked_dests:
+                    dest_dict[interval] = unpacked_dests[i, interval]
+            start, stop = dur_indptr[i], dur_indptr[i + 1]
+            duration_dict = dict(zip(dur_ids[start:stop], dur_params[start:stop]))
+            duration_dict.update(unpacked_durations[i])
+            kwargs = dict(
+                capacity=int(self.capacity[i])
+                , docked_init=int(self.docked_init[i])
+                , st_id=st_id
+                , demand_dict=demand_dict
+                , dest_dict=dest_dict
+                , duration_dict=duration_dict
+                , latitude=float(self.latitude[i])
+                , longitude=float(self.longitude[i])
+            )
+            if self.st_warehouse[i] >= 0:
+                station = WarehousedStation(warehouse=warehouses[self.st_warehouse[i]], **kwargs)
+            else:
+                station = Station(**kwargs)
+            if self.common_names[i] is not None:
+                station._common_name = self.common_names[i]
+            # equivalent to City.compile_samplers, without re-reading the dictionaries
+            station._dest_samplers = dest_samplers
+            station.compile_duration_sampler()
+            city.add_station(station)
+        return city
+
+    def __getstate__(self):
+        if self.location is not None:
+            # re-attach to the same files rather than copying the arrays
+            return dict(location=self.location, state=self.state)
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if 'arrays' in state:
+            self.__dict__.update(state)
+        else:
+            bundle = ParameterBundle.load(state['location'])
+            if state.get('state') is not None:
+                bundle = bundle.with_state(state['state'])
+            self.__dict__.update(bundle.__dict__)
+
+
+@contextmanager
+def shared_bundle(city):
+    """A memory-mapped ParameterBundle of city, saved to a temporary directory which is removed afterwards. Pass it to
+    worker processes in place of the city: each one attaches to the same files rather than receiving its own copy.
+    A bundle that is already memory-mapped is used as it is."""
+    if isinstance(city, ParameterBundle) and city.location is not None:
+        yield city
+        return
+    bundle = city if isinstance(city, ParameterBundle) else ParameterBundle.from_city(city)
+    with TemporaryDirectory(prefix='parameter_bundle_') as directory:
+        bundle.save(directory)
+        yield ParameterBundle.load(directory)
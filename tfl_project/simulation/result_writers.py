@@ -0,0 +1,98 @@
+from pathlib import Path
+
+from pandas import DataFrame, concat
+
+TABLES = ('time_series', 'events')
+
+
+class InMemoryWriter:
+    def __init__(self, output_dir=None):
+        """Keeps every simulation's results in memory, for use in notebooks. The combined DataFrames are only built
+        (with a single concat) when they are asked for."""
+        self.output_dir = output_dir
+        self._frames = {table: [] for table in TABLES}
+        self._combined = {}
+
+    def open(self):
+        self._frames = {table: [] for table in TABLES}
+        self._combined = {}
+
+    def write(self, timeseries_df: DataFrame, event_df: DataFrame):
+        self._frames['time_series'].append(timeseries_df)
+        self._frames['events'].append(event_df)
+        self._combined = {}
+
+    def close(self):
+        pass
+
+    def combined_df(self, table):
+        if not self._frames[table]:
+            return None
+        if table not in self._combined:
+            self._combined[table] = concat(self._frames[table], ignore_index=True)
+        return self._combined[table]
+
+
+class CSVWriter:
+    def __init__(self, output_dir: Path):
+        """Appends each simulation's results to time_series.csv and events.csv in output_dir as soon as it finishes,
+        so memory use does not grow with the number of simulations"""
+        self.output_dir = Path(output_dir)
+
+    def path(self, table):
+        return self.output_dir / (table + '.csv')
+
+    def open(self):
+        if not self.output_dir.exists():
+            self.output_dir.mkdir(parents=True)
+        for table in TABLES:
+            if self.path(table).exists():
+                print(self.path(table), 'already exists. Over-writing...')
+                self.path(table).unlink()
+
+    def write(self, timeseries_df: DataFrame, event_df: DataFrame):
+        for table, df in zip(TABLES, (timeseries_df, event_df)):
+            output_file = self.path(table)
+            df.to_csv(output_file, mode='a', header=not output_file.exists(), index=False)
+
+    def close(self):
+        pass
+
+
+class ParquetWriter:
+    def __init__(self, output_dir: Path):
+        """Writes each simulation's results as a new row group of time_series.parquet and events.parquet in output_dir
+        as soon as it finishes. Requires pyarrow, which is not otherwise a dependency."""
+        self.output_dir = Path(output_dir)
+        self._writers = {}
+
+    def path(self, table):
+        return self.output_dir / (table + '.parquet')
+
+    def open(self):
+        import pyarrow.parquet  # fail early if pyarrow is missing
+        if not self.output_dir.exists():
+            self.output_dir.mkdir(parents=True)
+        for table in TABLES:
+            if self.path(table).exists():
+                print(self.path(table), 'already exists. Over-writing...')
+                self.path(table).unlink()
+        self._writers = {}
+
+    def write(self, timeseries_df: DataFrame, event_df: DataFrame):
+        import pyarrow
+        import pyarrow.parquet
+
+        for table, df in zip(TABLES, (timeseries_df, event_df)):
+            arrow_table = pyarrow.Table.from_pandas(df, preserve_index=False)
+            if table not in self._writers:
+                self._writers[table] = pyarrow.parquet.ParquetWriter(self.path(table), arrow_table.schema)
+            self._writers[table].write_table(arrow_table)
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
+
+
+WRITERS = dict(memory=InMemoryWriter, csv=CSVWriter, parquet=ParquetWriter)
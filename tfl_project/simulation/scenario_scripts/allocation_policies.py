@@ -0,0 +1,121 @@
+"""Bike and dock allocation policies, derived from the REU profiles, which can be applied to a city before simulating.
+Each modifies the city's stations in place."""
+from pathlib import Path
+
+from pandas import read_csv
+
+from tfl_project.simulation.city import City
+from tfl_project.simulation.station import WarehousedStation
+
+ideals_loc = Path('tfl_project/data/analytical_outputs/reu/bikepoint_reu_inferences.csv')
+# The REU columns used by the scenario scripts
+CONSERVATIVE_COLUMNS = dict(station_col='station', cap_col='conservative capacity needed',
+                            bike_col='conservative bikes needed')
+
+
+def apply_policy_type_a(city: City, csv_loc: Path, station_col: str, cap_col: str, bike_col: str):
+    """This function reads a CSV of preferred capacities and bike allocations and modifies stations in the city to
+    have those allocations.
+    - Will only increase capacity: does not reduce capacity.
+    - Skips WarehousedStations: their capacity is already catered-for by the warehouse!
+
+    This implementation violates encapsulation and would ideally be a class method: refactor if time permits."""
+    df = read_csv(csv_loc, usecols=[station_col, cap_col, bike_col])
+    for _, ideal in df.iterrows():
+        assert ideal[cap_col] >= ideal[bike_col]
+        st = city.get_station(ideal[station_col])
+        if isinstance(st, WarehousedStation):  # do not modify capacity for warehoused stations: overstated
+            continue
+        if ideal[cap_col] > st._capacity:
+            st._capacity = ideal[cap_col]
+        st._docked = ideal[bike_col]
+        assert st._capacity >= st._docked
+
+
+def apply_policy_type_b(city: City, csv_loc: Path, station_col: str, cap_col: str, bike_col: str):
+    """This is almost the same as apply_policy_type_a but with additional functionality:
+    - Will only increase capacity: does not reduce capacity.
+    - Skips WarehousedStations: their capacity is already catered-for by the warehouse!
+    ++ If real life has LESS capacity than needed: allocate bikes and docks in the same proportion to what the REU
+        profile suggested, to the available capacity.
+
+    This implementation violates encapsulation and would ideally be a class method: refactor if time permits."""
+    df = read_csv(csv_loc, usecols=[station_col, cap_col, bike_col])
+
+    bike_budget = sum([s._docked for s in city.stations.values()])
+    for st in city.stations.values():
+        st.spare_capacity = 0
+
+    for _, ideal in df.iterrows():
+        assert ideal[cap_col] >= ideal[bike_col]
+        st = city.get_station(ideal[station_col])
+        if isinstance(st, WarehousedStation):  # do not modify capacity for warehoused stations: overstated
+            continue
+        if ideal[cap_col] > st._capacity:
+            st._capacity = ideal[cap_col]
+        elif st._capacity > ideal[cap_col]:
+            # If the station has 'spare capacity' over what the REU profile suggested, divvy the remaining capacity
+            # between docks and bikes... giving precedence to extra bike for odd numbers
+            st.spare_capacity = st._capacity - ideal[cap_col]
+
+        st._docked = ideal[bike_col]
+        bike_budget -= ideal[bike_col]
+        assert st._capacity >= st._docked
+
+    # Pass again and allocate spare bike budget to stations in proportion to their spare capacity.
+    total_spare_docks = sum(s.spare_capacity for s in city.stations.values())
+    for st in city.stations.values():
+        spare_bike_share = st.spare_capacity / total_spare_docks
+        st._docked += round(bike_budget * spare_bike_share)
+        assert st._capacity >= st._docked
+
+
+def apply_policy_type_c(city: City, csv_loc: Path, station_col: str, cap_col: str, bike_col: str):
+    """
+    This script re-creates the allocations suggested by the REU profiles, but assumes we must make-do with existing
+    capacity.
+    - Skips WarehousedStations: their capacity is already catered-for by the warehouse!
+    + If real life has more capacity than needed: allocate any spare bikes in proportion to spare capacity.
+    ++ If real life has LESS capacity than needed: allocate bikes and docks in the same proportion to what the REU
+        profile suggested, to the available capacity.
+
+    This implementation violates encapsulation and would ideally be a class method: refactor if time permits."""
+    df = read_csv(csv_loc, usecols=[station_col, cap_col, bike_col])
+    bike_budget = sum([s._docked for s in city.stations.values()])
+    for st in city.stations.values():
+        st.spare_capacity = 0
+
+    for _, ideal in df.iterrows():
+        assert ideal[cap_col] >= ideal[bike_col]
+        st = city.get_station(ideal[station_col])
+
+        if isinstance(st, WarehousedStation):  # do not modify capacity for warehoused stations: overstated
+            continue
+
+        if ideal[cap_col] >= st._capacity:
+            desired_bike_ratio = ideal[bike_col] / ideal[cap_col]
+            new_bikes = round(st._capacity*desired_bike_ratio)
+        else:
+            # If the station has 'spare capacity' over what the REU profile suggested, note this spare capacity
+            st.spare_capacity = st._capacity - ideal[cap_col]
+            new_bikes = ideal[bike_col]
+
+        st._docked = new_bikes
+        bike_budget -= new_bikes
+        assert st._capacity >= st._docked
+
+    # Pass again and allocate spare bike budget to stations in proportion to their spare capacity.
+    total_spare_docks = sum(s.spare_capacity for s in city.stations.values())
+    for st in city.stations.values():
+        spare_bike_share = st.spare_capacity / total_spare_docks
+        st._docked += round(bike_budget * spare_bike_share)
+        assert st._capacity >= st._docked
+
+
+def conservative_policy(policy):
+    """The policy as applied by the scenario scripts: to the conservative REU ideals. Returns a function of the city
+    alone, e.g. for ScenarioSweep."""
+    def apply(city: City):
+        policy(city, ideals_loc, **CONSERVATIVE_COLUMNS)
+    apply.__name__ = policy.__name__
+    return apply
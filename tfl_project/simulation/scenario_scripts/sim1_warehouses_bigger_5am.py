@@ -35,9 +35,9 @@ def main():
             , warehoused_stations=warehoused_stations) \
         .get_or_create_london(pickle_loc='tfl_project/simulation/files/pickled_cities/london_big_warehouses')
     describe_city(base_london)
-    sm = SimulationManager(city=base_london, n_simulations=20, simulation_id='SIM1_BIG_WAREHOUSE_5AM_NO_REBAL')
+    sm = SimulationManager(city=base_london, n_simulations=20, simulation_id='SIM1_BIG_WAREHOUSE_5AM_NO_REBAL',
+                           output='csv')
     sm.run_simulations()
-    sm.output_dfs_to_csv()
 
 
 if __name__ == '__main__':
@@ -1,31 +1,7 @@
 from tfl_project.simulation.sim_managment import LondonCreator, SimulationManager
-from tfl_project.simulation.city import City
-from tfl_project.simulation.station import WarehousedStation
-from pathlib import Path
-from pandas import read_csv
+from tfl_project.simulation.scenario_scripts.allocation_policies import apply_policy_type_a, ideals_loc
 from tfl_project.simulation.scenario_scripts.describe_city import describe_city
 
-ideals_loc = Path('tfl_project/data/analytical_outputs/reu/bikepoint_reu_inferences.csv')
-
-
-def apply_policy_type_a(city: City, csv_loc: Path, station_col: str, cap_col: str, bike_col: str):
-    """This function reads a CSV of preferred capacities and bike allocations and modifies stations in the city to
-    have those allocations.
-    - Will only increase capacity: does not reduce capacity.
-    - Skips WarehousedStations: their capacity is already catered-for by the warehouse!
-
-    This implementation violates encapsulation and would ideally be a class method: refactor if time permits."""
-    df = read_csv(csv_loc, usecols=[station_col, cap_col, bike_col])
-    for _, ideal in df.iterrows():
-        assert ideal[cap_col] >= ideal[bike_col]
-        st = city.get_station(ideal[station_col])
-        if isinstance(st, WarehousedStation):  # do not modify capacity for warehoused stations: overstated
-            continue
-        if ideal[cap_col] > st._capacity:
-            st._capacity = ideal[cap_col]
-        st._docked = ideal[bike_col]
-        assert st._capacity >= st._docked
-
 
 def main():
     """
@@ -65,9 +41,9 @@ def main():
 
     describe_city(base_london)
 
-    sm = SimulationManager(city=base_london, n_simulations=20, simulation_id='SIM2.1_MORECAPACITY_TYPE_A_ALLOC')
+    sm = SimulationManager(city=base_london, n_simulations=20, simulation_id='SIM2.1_MORECAPACITY_TYPE_A_ALLOC',
+                           output='csv')
     sm.run_simulations()
-    sm.output_dfs_to_csv()
 
 
 if __name__ == '__main__':
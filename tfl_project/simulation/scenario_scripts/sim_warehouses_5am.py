@@ -30,9 +30,9 @@ def main():
             , warehoused_stations=warehoused_stations) \
         .get_or_create_london(pickle_loc='tfl_project/simulation/files/pickled_cities/london_warehouses')
     describe_city(base_london)
-    sm = SimulationManager(city=base_london, n_simulations=20, simulation_id='SIM_WAREHOUSE_5AM_NO_REBAL')
+    sm = SimulationManager(city=base_london, n_simulations=20, simulation_id='SIM_WAREHOUSE_5AM_NO_REBAL',
+                           output='csv')
     sm.run_simulations()
-    sm.output_dfs_to_csv()
 
 
 if __name__ == '__main__':
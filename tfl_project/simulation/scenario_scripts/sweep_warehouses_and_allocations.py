@@ -0,0 +1,61 @@
+import os
+
+from tfl_project.simulation.scenario_scripts.allocation_policies import apply_policy_type_a, apply_policy_type_b, \
+    apply_policy_type_c, conservative_policy
+from tfl_project.simulation.scenario_sweep import ScenarioSweep, scenario_grid
+from tfl_project.simulation.sim_managment import LondonCreator
+
+
+def main():
+    """
+    Runs the scenarios of sim0, sim_warehouses_5am, sim1, sim2.1, sim2.2 and sim3 (and the other combinations of
+    their warehouses and allocation policies) as one sweep, using every CPU. The base London is loaded once, and
+    simulation i of every scenario sees the same demand, so scenarios can be compared simulation by simulation.
+    """
+    warehouse_param_lists = {
+        'no_warehouses': None,
+        # rounded ballpark estimates
+        'warehouses': [
+            {'capacity': 300, 'docked_init': 300, 'st_id': 'WATERLOO'}
+            , {'capacity': 200, 'docked_init': 200, 'st_id': 'KINGSX'}
+            , {'capacity': 150, 'docked_init': 0, 'st_id': 'HOLBORN'}
+        ],
+        # conservative capacities suggested by the REU profiles
+        'big_warehouses': [
+            {'capacity': 520, 'docked_init': 520, 'st_id': 'WATERLOO'}
+            , {'capacity': 220, 'docked_init': 220, 'st_id': 'KINGSX'}
+            , {'capacity': 150, 'docked_init': 0, 'st_id': 'HOLBORN'}
+        ],
+    }
+    warehoused_station_maps = {
+        'no_warehoused_stations': None,
+        'central': {
+            # Waterloo Stations 1, 2, 3
+            374: 'WATERLOO',
+            361: 'WATERLOO',
+            154: 'WATERLOO',
+            # Belgrove Street, King's Cross
+            14: 'KINGSX',
+            # Holborn Circus, New Fetter, Stonecutter
+            66: 'HOLBORN',
+            546: 'HOLBORN',
+            112: 'HOLBORN',
+        },
+    }
+    allocations = {
+        'existing_allocation': None,
+        'type_a': conservative_policy(apply_policy_type_a),
+        'type_b': conservative_policy(apply_policy_type_b),
+        'type_c': conservative_policy(apply_policy_type_c),
+    }
+
+    base_london = LondonCreator(min_year=2015, minute_interval=20, exclude_covid=True)\
+        .get_or_create_london()
+    scenarios = scenario_grid(warehouse_param_lists, warehoused_station_maps, allocations)
+    sweep = ScenarioSweep(base_london, scenarios, n_simulations=20, sweep_id='SWEEP_WAREHOUSES_AND_ALLOCATIONS',
+                          workers=os.cpu_count(), seed=2020)
+    sweep.run()
+
+
+if __name__ == '__main__':
+    main()
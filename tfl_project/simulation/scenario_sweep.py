@@ -0,0 +1,204 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from copy import copy
+from itertools import product
+from pathlib import Path
+
+import numpy.random
+from pandas import DataFrame
+
+from tfl_project.simulation.city import City
+from tfl_project.simulation.event_log import EVENT_KEYS
+from tfl_project.simulation.parameter_bundle import shared_bundle
+from tfl_project.simulation.result_writers import WRITERS
+from tfl_project.simulation.sim_managment import ReplicationRunner
+from tfl_project.simulation.station import Store, WarehousedStation
+
+
+class Scenario:
+    def __init__(self, name, warehouse_param_list=None, warehoused_stations: dict = None, allocation=None):
+        """
+        A variant of a base city.
+        :param name: identifies the scenario in sweep results
+        :param warehouse_param_list: Store parameters of warehouses to add, as for LondonCreator
+        :param warehoused_stations: bikepoint ids mapping to the warehouse ids they are coupled to, as for LondonCreator
+        :param allocation: a function which modifies the city's stations in place, e.g. to re-allocate bikes. It is
+            applied after the warehouses are added.
+        """
+        self.name = name
+        self.warehouse_param_list = warehouse_param_list
+        self.warehoused_stations = warehoused_stations
+        self.allocation = allocation
+
+    def build(self, base_city: City):
+        """A new city with this scenario's warehouses and allocation. Stations are shallow copies of the base city's,
+        so their (large) demand, destination and duration parameters are shared rather than copied: only bikes and
+        docks belong to the scenario. The base city is not modified."""
+        city = City(interval_size=base_city._interval_size)
+        for params in self.warehouse_param_list or []:
+            city.add_warehouse(Store(**params))
+        warehoused = self.warehoused_stations or {}
+        for st_id, base_station in base_city.stations.items():
+            if st_id in warehoused:
+                station = WarehousedStation.__new__(WarehousedStation)
+                station.__dict__.update(base_station.__dict__)
+                station._warehouse = city.get_warehouse(warehoused[st_id])
+            else:
+                station = copy(base_station)
+            # the large parameters are shared, but dicts which stations change in place (e.g. when loading lazy
+            # parameters) must belong to each copy
+            for name in ('_lazy_loaders', '_dest_samplers'):
+                if name in base_station.__dict__:
+                    station.__dict__[name] = dict(base_station.__dict__[name])
+            city.add_station(station)
+        if self.allocation is not None:
+            self.allocation(city)
+        return city
+
+
+def scenario_grid(warehouse_param_lists: dict, warehoused_station_maps: dict, allocations: dict):
+    """
+    Every combination of the given options, as Scenarios named like 'big_warehouses/central/type_b'.
+    Each argument maps option names to values (which may be None), e.g. allocations={'none': None, 'type_a': ...}.
+    Combinations whose warehoused stations refer to warehouses that don't exist, or whose warehouses have no stations
+    coupled to them, are skipped.
+    """
+    scenarios = []
+    for (wh_name, wh_params), (map_name, st_map), (alloc_name, allocation) in product(
+            warehouse_param_lists.items(), warehoused_station_maps.items(), allocations.items()):
+        warehouse_ids = {params['st_id'] for params in wh_params or []}
+        if set((st_map or {}).values()) != warehouse_ids:
+            continue
+        scenarios.append(Scenario('/'.join((wh_name, map_name, alloc_name)), wh_params, st_map, allocation))
+    return scenarios
+
+
+def _scenario_bundle(base_bundle, city, stack: ExitStack):
+    """base_bundle with city's bikes, docks and warehouses. A city whose stations differ from the base city's (e.g.
+    because its allocation removed some) needs a bundle of its own."""
+    try:
+        return base_bundle.with_state(base_bundle.city_state(city))
+    except ValueError:
+        return stack.enter_context(shared_bundle(city))
+
+
+# Each worker process holds a ReplicationRunner per scenario, so the scenario cities are only sent once
+_sweep_runners = None
+
+
+def _init_sweep_worker(cities, engine, common_random_numbers):
+    global _sweep_runners
+    _sweep_runners = {name: ReplicationRunner(city, engine, common_random_numbers) for name, city in cities.items()}
+
+
+def _run_sweep_job(job):
+    name, sim_num, seed_sequence = job
+    return _sweep_runners[name].run(sim_num, seed_sequence)
+
+
+class ScenarioSweep:
+    def __init__(self, base_city: City, scenarios, n_simulations: int, sweep_id: str, engine='object', workers=1,
+                 seed=None, output='csv', common_random_numbers=True):
+        """
+        Simulates several scenarios of one base city, spreading every (scenario, simulation) job across a single pool
+        of worker processes, and writes all of the results together with a scenario column.
+        :param base_city: e.g. a London without warehouses. Its parameters are loaded once and shared by every scenario
+        :param scenarios: Scenario instances, with distinct names
+        :param n_simulations: Number of simulations of each scenario
+        :param sweep_id: Results are stored in tfl_project/data/simulation_outputs/<sweep_id>
+        :param seed: simulation i of every scenario is seeded alike. With common_random_numbers (see
+            SimulationManager) they also see the same demand, so scenarios can be compared pair by pair.
+        Other parameters are as for SimulationManager.
+        """
+        names = [scenario.name for scenario in scenarios]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Scenario names must be distinct. {names} were given")
+        if engine not in ('object', 'array'):
+            raise ValueError(f"engine must be 'object' or 'array'. {engine} was given")
+        if output not in WRITERS:
+            raise ValueError(f"output must be one of {list(WRITERS)}. {output} was given")
+        self.base_city = base_city
+        self.scenarios = scenarios
+        self.n_simulations = n_simulations
+        self.sweep_id = sweep_id
+        self.engine = engine
+        self.workers = workers
+        self.seed = numpy.random.SeedSequence(seed).entropy
+        self.output = output
+        self.common_random_numbers = common_random_numbers
+        self.writer = WRITERS[output](self.output_dir)
+        self._totals = []
+
+    @property
+    def output_dir(self):
+        return Path('tfl_project/data/simulation_outputs/') / self.sweep_id
+
+    @property
+    def combined_timeseries_df(self):
+        """All scenarios' time series. Only available with output='memory'"""
+        if self.output == 'memory':
+            return self.writer.combined_df('time_series')
+
+    @property
+    def combined_event_df(self):
+        """All scenarios' events. Only available with output='memory'"""
+        if self.output == 'memory':
+            return self.writer.combined_df('events')
+
+    def jobs(self):
+        seed_sequences = numpy.random.SeedSequence(self.seed).spawn(self.n_simulations)
+        return [(scenario.name, i, seed_sequences[i]) for scenario in self.scenarios for i in range(self.n_simulations)]
+
+    def run(self):
+        print(f"Building {len(self.scenarios)} scenarios -------------------")
+        cities = {scenario.name: scenario.build(self.base_city) for scenario in self.scenarios}
+        self.writer.open()
+        self._totals = []
+        jobs = self.jobs()
+        try:
+            if self.workers > 1:
+                self._run_in_workers(cities, jobs)
+            else:
+                runners = {}
+                try:
+                    for name, city in cities.items():
+                        runners[name] = ReplicationRunner(city, self.engine, self.common_random_numbers)
+                    for name, i, seed_sequence in jobs:
+                        self.store_simulation(name, i, *runners[name].run(i, seed_sequence))
+                finally:
+                    # every runner gives its city back as it was found, even if a simulation fails
+                    for runner in runners.values():
+                        runner.finish()
+        finally:
+            self.writer.close()
+        print(f"completed {len(jobs)} simulations of {len(self.scenarios)} scenarios")
+        print("-------------------------------------")
+
+    def _run_in_workers(self, cities, jobs):
+        with ExitStack() as stack:
+            if self.engine == 'array':
+                # workers attach to one memory-mapped bundle of the base city, and only receive each scenario's
+                # bikes, docks and warehouses
+                base_bundle = stack.enter_context(shared_bundle(self.base_city))
+                cities = {name: _scenario_bundle(base_bundle, city, stack) for name, city in cities.items()}
+            pool = stack.enter_context(ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_init_sweep_worker,
+                initargs=(cities, self.engine, self.common_random_numbers)))
+            # map returns results in job order, whichever worker finishes first
+            for (name, i, _), (timeseries_df, event_df) in zip(jobs, pool.map(_run_sweep_job, jobs)):
+                self.store_simulation(name, i, timeseries_df, event_df)
+
+    def store_simulation(self, scenario_name, sim_num, timeseries_df: DataFrame, event_df: DataFrame):
+        totals = event_df['event'].value_counts()
+        self._totals.append(dict(scenario=scenario_name, sim_num=sim_num,
+                                 **{key: int(totals.get(key, 0)) for key in EVENT_KEYS}))
+        for instance_df in (timeseries_df, event_df):
+            instance_df['simulation_id'] = self.sweep_id
+            instance_df['scenario'] = scenario_name
+            instance_df['sim_num'] = sim_num
+        self.writer.write(timeseries_df, event_df)
+
+    def replication_totals(self):
+        """Total failed starts, failed ends and finished journeys of each simulation, indexed by scenario and
+        sim_num"""
+        return DataFrame(self._totals, columns=['scenario', 'sim_num', *EVENT_KEYS]).set_index(['scenario', 'sim_num'])
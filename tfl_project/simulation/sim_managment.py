@@ -1,17 +1,51 @@
+import hashlib
 import pickle
+import random
 import sqlite3
 import time
-from copy import deepcopy
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from contextlib import nullcontext
+from copy import copy
+from functools import partial
+
+import numpy.random
 from pandas import read_sql
-from scipy.stats import gumbel_r
+from scipy.stats import gumbel_r, t as t_dist
 from pandas import DataFrame
 import json
+import os
 from pathlib import Path
 
-from tfl_project.simulation.city import City
+from tfl_project.database_creation.journey_aggregates_to_sql import COVID_CUTOFF, MINUTE_BUCKET, days_table, od_table
+from tfl_project.simulation.array_city import ArrayCity
+from tfl_project.simulation.city import City, substreams
+from tfl_project.simulation.duration_cache import open_cache
+from tfl_project.simulation.event_log import EVENT_KEYS
+from tfl_project.simulation.gumbel_fit import accuracy_report, fit_gumbel_groups
+from tfl_project.simulation.parameter_bundle import IncompatibleBundleError, ParameterBundle, shared_bundle
+from tfl_project.simulation.result_writers import WRITERS
 from tfl_project.simulation.station import Station, Store, WarehousedStation
 
 
+FIT_METHODS = ('scipy', 'vectorised')
+DURATION_CACHE = Path('tfl_project/simulation/files/caches/duration_params/duration_params.sqlite')
+DEMAND_CACHE = Path('tfl_project/simulation/files/caches/demand')
+DESTINATION_CACHE = Path('tfl_project/simulation/files/caches/destinations')
+CITY_STORE = Path('tfl_project/simulation/files/pickled_cities')
+# Where get_or_create_london saved the city before each set of parameters had its own directory
+LEGACY_CITY_LOCATION = CITY_STORE / 'london'
+DATABASE = Path('tfl_project/data/bike_db.db')
+COVID_FILTER = f""" AND "Start Date" <= '{COVID_CUTOFF}'"""
+# The LondonCreator parameters each cached artifact is made from. exclude_covid is part of additional_filters
+ARTIFACT_PARAMETERS = {
+    'demand': ('min_year', 'minute_interval', 'additional_filters'),
+    'destinations': ('min_year', 'minute_interval', 'additional_filters'),
+    'durations': ('min_year', 'additional_filters'),
+    'city': ('min_year', 'minute_interval', 'additional_filters', 'warehouse_param_list', 'warehoused_stations'),
+}
+
+
 class IncompatibleParamsError(Exception):
     pass
 
@@ -36,11 +70,12 @@ class LondonCreator:
         self.warehouse_param_list = warehouse_param_list
         self.warehoused_stations = warehoused_stations
         if exclude_covid:
-            self.additional_filters = additional_sql_filters + """ AND "Start Date" <= '2020-03-15'"""
+            self.additional_filters = additional_sql_filters + COVID_FILTER
+        # Set by _aggregate_filter(). Not a parameter, so left out of parameter_dict()
+        self._aggregates_exist = None
 
     def select_query_db(self, query):
-        dbpath = "tfl_project/data/bike_db.db"
-        db = sqlite3.connect(dbpath)
+        db = sqlite3.connect(DATABASE)
         c = db.cursor()
         c.execute(query)
         rows = c.fetchall()
@@ -48,8 +83,7 @@ class LondonCreator:
         return rows
 
     def df_from_sql(self, query):
-        dbpath = "tfl_project/data/bike_db.db"
-        db = sqlite3.connect(dbpath)
+        db = sqlite3.connect(DATABASE)
         try:
             df = read_sql(query, db)
         finally:
@@ -105,10 +139,73 @@ class LondonCreator:
             s._common_name = row[2]
             self.london.add_station(s)
 
-    def populate_station_demand_dicts(self):
+    def populate_station_demand_dicts(self, cache_loc=DEMAND_CACHE):
+        """Demand is fetched from the database the first time a set of its parameters is used, and from cache_loc (see
+        cached_rows) after that"""
         print(f"fetching all station demand per {self.minute_interval} minute interval")
-        all_demands = self.select_query_db(
-            f"""
+        all_demands = self.cached_rows('demand', cache_loc, [('st_id', 'i8'), ('interval', 'i8'), ('rate', 'f8')],
+                                       self._demand_query)
+        print("fetched. Assigning to stations")
+        for row in all_demands:
+            bikepoint_id, interval, journeys_p_minute = row
+            if bikepoint_id in self.london._stations:
+                self.london.get_station(bikepoint_id)._demand_dict[interval] = journeys_p_minute
+
+    def _aggregate_filter(self):
+        """The filter on the pre-aggregated journey tables (see journey_aggregates_to_sql) which selects the same
+        journeys as this LondonCreator's parameters, or None if the tables can't be used: if they don't exist, if
+        minute_interval isn't a multiple of their MINUTE_BUCKET, or if there are additional_sql_filters"""
+        if self.minute_interval % MINUTE_BUCKET:
+            return None
+        if not self.additional_filters.strip():
+            covid_filter = ""
+        elif self.additional_filters == COVID_FILTER:
+            covid_filter = "AND pre_covid = 1"
+        else:
+            return None
+        if self._aggregates_exist is None:
+            # checked once, rather than for every station whose destinations are loaded lazily
+            self._aggregates_exist = bool(
+                self.select_query_db(f"SELECT 1 FROM sqlite_master WHERE type='table' AND name='{od_table}'"))
+        if not self._aggregates_exist:
+            return None
+        return f"""year >= {self.min_year}
+                AND weekday_ind = 1
+                {covid_filter}"""
+
+    def _demand_query(self):
+        aggregate_filter = self._aggregate_filter()
+        if aggregate_filter is not None:
+            return f"""
+            SELECT
+                i.start_id
+                ,i.interval
+                ,CAST(i.interval_journeys AS REAL) / d.days_in_action / {self.minute_interval} AS avg_journeys_p_minute
+            FROM
+                (
+                    SELECT
+                        start_id
+                        ,(minute_bucket / {self.minute_interval}) * {self.minute_interval} AS interval
+                        ,SUM(journeys) AS interval_journeys
+                    FROM
+                        {od_table}
+                    WHERE
+                        {aggregate_filter}
+                    GROUP BY 1,2
+                ) AS i
+                INNER JOIN (
+                    SELECT
+                        start_id
+                        ,SUM(days_in_action) AS days_in_action
+                    FROM
+                        {days_table}
+                    WHERE
+                        {aggregate_filter}
+                    GROUP BY 1
+                ) AS d
+                    ON i.start_id = d.start_id
+            """
+        return f"""
             WITH subset AS (
                 SELECT *
                 FROM journeys
@@ -144,18 +241,51 @@ class LondonCreator:
                 ) AS d
                     ON i."StartStation Id" = d."StartStation Id"     
             """
-        )
-        print("fetched. Assigning to stations")
-        for row in all_demands:
-            bikepoint_id, interval, journeys_p_minute = row
-            if bikepoint_id in self.london._stations:
-                self.london.get_station(bikepoint_id)._demand_dict[interval] = journeys_p_minute
 
-    def populate_station_destination_dicts(self):
+    def populate_station_destination_dicts(self, lazy=False, cache_loc=DESTINATION_CACHE):
+        """With lazy, each station's destinations are only fetched (by fetch_destination_params) when it first needs
+        them: see prefetch. Otherwise they are fetched from the database the first time a set of their parameters is
+        used, and from cache_loc (see cached_rows) after that"""
+        if lazy:
+            for station in self.london._stations.values():
+                station.load_lazily(destinations=self.fetch_destination_params)
+            return
         # No Laplace smoothing
         print(f"fetching distribution of destinations per {self.minute_interval} minute interval, per station")
-        all_dests = self.select_query_db(
-            f"""
+        all_dests = self.cached_rows('destinations', cache_loc, [('st_id', 'i8'), ('dest_id', 'i8'),
+                                                                 ('interval', 'i8'), ('journeys', 'i8')],
+                                     self._destination_query)
+        print("fetched. Assigning to stations")
+        for row in all_dests:
+            bikepoint_id, destination_id, interval, journeys = row
+            if bikepoint_id in self.london._stations:
+                if destination_id in self.london._stations:
+                    self.london.get_station(bikepoint_id).add_dest_volume_parameter(
+                        interval=interval
+                        , destination_id=destination_id
+                        , journeys=journeys
+                    )
+
+    def _destination_query(self, start_id=None):
+        aggregate_filter = self._aggregate_filter()
+        if aggregate_filter is not None:
+            start_filter = f"""AND start_id = {start_id}""" if start_id is not None else ""
+            return f"""
+            SELECT
+                start_id
+                ,end_id
+                ,(minute_bucket / {self.minute_interval}) * {self.minute_interval} AS interval
+                ,SUM(journeys) AS journeys
+            FROM
+                {od_table}
+            WHERE
+                {aggregate_filter}
+                AND end_id != -1
+                {start_filter}
+            GROUP BY
+                1,2,3"""
+        start_filter = f"""AND "StartStation Id" = {start_id}""" if start_id is not None else ""
+        return f"""
             SELECT
                 "StartStation Id"
                 ,"EndStation Id"
@@ -170,59 +300,51 @@ class LondonCreator:
                 AND "StartStation Id" NOT NULL
                 AND "EndStation Id" != -1
                 AND "EndStation Id" NOT NULL
+                {start_filter}
                 {self.additional_filters}
             GROUP BY
                 1,2,3"""
-        )
-        print("fetched. Assigning to stations")
-        for row in all_dests:
-            bikepoint_id, destination_id, interval, journeys = row
-            if bikepoint_id in self.london._stations:
-                if destination_id in self.london._stations:
-                    self.london.get_station(bikepoint_id).add_dest_volume_parameter(
-                        interval=interval
-                        , destination_id=destination_id
-                        , journeys=journeys
-                    )
 
-    def get_params_from_cache(self, station_id, cache_loc):
-        compatibility_json_loc = cache_loc / 'last_used_params.json'
-        st_params_loc = cache_loc / (str(station_id) + '.json')
-        if not self.parameter_json_is_compatible(compatibility_json_loc):
-            raise IncompatibleParamsError("Cached duration parameters made by incompatible LondonCreator instance.")
-        with open(st_params_loc) as infile:
-            d = json.load(infile)
-        # cast back into original format: json gets this a bit wrong
-        d = {int(k): tuple(v) for k, v in d.items()}
+    def fetch_destination_params(self, start_id):
+        """The _dest_dict of a single station, as populate_station_destination_dicts would assign it"""
+        d = dict()
+        for _, destination_id, interval, journeys in self.select_query_db(self._destination_query(start_id)):
+            if destination_id in self.london._stations:
+                entry = d.setdefault(interval, {'destinations': [], 'volumes': []})
+                entry['destinations'].append(destination_id)
+                entry['volumes'].append(journeys)
         return d
 
-    def cache_station_params(self, station_id, dictionary, cache_loc):
-        if not cache_loc.exists():
-            print(f"adding new cache directory: {str(cache_loc)}")
-            cache_loc.mkdir(parents=True)
-        json_file = str(station_id) + '.json'
-        self.check_prepare_cache(cache_loc)
-        # cast keys to vanilla python integer type, as opposed to numpy.int64
-        dictionary = {int(k): v for k, v in dictionary.items()}
-        with open(Path(cache_loc) / json_file, 'w') as f:
-            json.dump(dictionary, f)
-
-    def check_prepare_cache(self, cache_loc: Path):
-        """Checks the cache location either has:
-            - A compatible last_used_params.json
-            - or, no last_used_params.json, in which case it adds one."""
-        compatibility_json_loc = cache_loc / 'last_used_params.json'
-        if compatibility_json_loc.exists():
-            if not self.parameter_json_is_compatible(compatibility_json_loc):
-                raise IncompatibleParamsError("Tried to cache to a location with pre-existing parameters that are "
-                                              "incompatible")
-            else:
-                return
-        else:
-            # no compatibility_json present: write our own
-            self.dump_parameter_json(compatibility_json_loc)
+    def duration_cache(self, cache_loc=DURATION_CACHE):
+        """The DurationCache in the file cache_loc of this LondonCreator's duration parameters, keyed by
+        parameter_key('durations'), so that LondonCreators which differ in anything else (e.g. warehouses) share it.
+        A new cache is labelled with the parameters, and starts with the stations of a cache of the older layout in
+        the same directory if that was made with the same ones."""
+        parameters = self.artifact_parameters('durations')
+        cache = open_cache(cache_loc, self.parameter_key('durations'))
+        header = cache.header()
+        if header is None:
+            header = cache.write_header(parameters)
+            legacy = Path(cache_loc).parent / 'last_used_params.json'
+            if legacy.exists():
+                with open(legacy) as f:
+                    legacy_parameters = json.load(f)
+                if {k: legacy_parameters.get(k) for k in parameters} == header:
+                    cache.import_json_directory(legacy.parent)
+        if not self.parameters_are_compatible(header):
+            raise IncompatibleParamsError("Cached duration parameters made by incompatible LondonCreator instance.")
+        return cache
+
+    def get_params_from_cache(self, station_id, cache_loc=DURATION_CACHE):
+        """A station's cached duration parameters. Raises KeyError if they aren't cached."""
+        return self.duration_cache(cache_loc).get(station_id)
+
+    def cache_station_params(self, station_id, dictionary, cache_loc=DURATION_CACHE):
+        self.duration_cache(cache_loc).put(station_id, dictionary)
 
-    def fetch_duration_params(self, start_id):
+    def fetch_duration_params(self, start_id, fit_method='scipy'):
+        """fit_method: 'scipy' fits each destination with scipy.stats.gumbel_r.fit. 'vectorised' fits every
+        destination together with gumbel_fit.fit_gumbel_groups"""
         d = dict()
         start_time = time.time()
         journey_df = self.df_from_sql(
@@ -245,6 +367,13 @@ class LondonCreator:
         print(f"fetched {len(journey_df)} journeys for station {start_id} in {(time.time()-start_time)} seconds")
         start_time = time.time()
         journey_df.dropna(subset=['Duration'], inplace=True)
+        if fit_method == 'vectorised':
+            journey_df.sort_values("EndStation Id", kind='mergesort', inplace=True)
+            if len(journey_df):
+                rows = numpy.column_stack((numpy.full(len(journey_df), start_id), journey_df.values.astype(float)))
+                d = fit_duration_groups(*_duration_groups(rows)[1:], fit_method=fit_method)
+            print(f"\tfitted {len(journey_df)} journeys in {(time.time()-start_time)/60} minutes")
+            return d
         for end_id in journey_df["EndStation Id"].unique():
             durations = journey_df.loc[journey_df["EndStation Id"] == end_id]['Duration'].values
             # creates a tuple of scipy.stats.gumbel_r parameters
@@ -253,31 +382,168 @@ class LondonCreator:
         print(f"\tfitted {len(journey_df)} journeys in {(time.time()-start_time)/60} minutes")
         return d
 
-    def populate_station_duration_params(self, cache_loc=Path('tfl_project/simulation/files/caches/duration_params')):
+    def populate_station_duration_params(self, cache_loc=DURATION_CACHE, lazy=False, workers=1, streaming=False,
+                                         fit_method='scipy'):
         """This is the most intensive parametrization, taking about 2 hours.
-        Therefore, this method uses a 'cache' in addition to the existing .pickle_city functionality.
+        Therefore, this method uses a 'cache' (a DurationCache) in addition to the existing .save_city functionality.
         This means we can create new LondonCreator instances (e.g. after updating source code) more flexibly without
-        doing this step from scratch every time."""
-        # This is intensive so populates one origin station at a time
+        doing this step from scratch every time.
+        With lazy, each station's parameters are only read from the cache (or fitted) when it first needs them: see
+        prefetch
+        With workers > 1 or streaming, stations missing from the cache are first fitted across that many processes,
+        from one scan of the journeys if streaming: see fit_missing_duration_params. fit_method applies to any stations
+        which are fitted: see fetch_duration_params"""
+        if workers > 1 or streaming or fit_method != 'scipy':
+            self.fit_missing_duration_params(cache_loc, workers, streaming, fit_method)
+        cache = self.duration_cache(cache_loc)
+        if lazy:
+            for station in self.london._stations.values():
+                station.load_lazily(durations=partial(self.get_duration_params, cache_loc=cache_loc))
+            return
+        cached = cache.load_all()
+        # Stations missing from the cache are intensive, so are populated one origin station at a time
         for start_id in self.london._stations.keys():
-            try:
-                d = self.get_params_from_cache(start_id, cache_loc)
-            except FileNotFoundError:
-                d = self.fetch_duration_params(start_id)
-                self.cache_station_params(start_id, d, cache_loc)
-            except IncompatibleParamsError:
-                raise NotImplementedError("I need to decide how to handle this situation if it ever arises")
+            d = cached[start_id] if start_id in cached else self.get_duration_params(start_id, cache_loc)
             # add the distribution parameters to the duration dict
             for end_id, params in d.items():
                 self.london.get_station(start_id).add_dest_duration_params(destination_id=end_id, params=params)
 
-    def create_london_from_scratch(self):
+    def fit_missing_duration_params(self, cache_loc=DURATION_CACHE, workers=4, streaming=False, fit_method='scipy'):
+        """Fits the duration parameters of every station missing from the cache, spreading stations across worker
+        processes. Each station is cached as soon as it is fitted, so an interrupted build picks up where it left off
+        when run again.
+        With streaming, journeys are read in a single scan (see stream_journey_durations) rather than one query per
+        station, and each station is fitted as soon as its journeys have been read.
+        fit_method: see fetch_duration_params"""
+        if fit_method not in FIT_METHODS:
+            raise ValueError(f"fit_method must be one of {FIT_METHODS}. {fit_method} was given")
+        cached = self.duration_cache(cache_loc).cached_ids()
+        missing = [start_id for start_id in self.london._stations.keys() if start_id not in cached]
+        if not missing:
+            return
+        print(f"fitting duration parameters of {len(missing)} stations across {workers} processes")
+        if streaming:
+            missing = set(missing)
+            fit = partial(fit_duration_groups, fit_method=fit_method)
+            jobs = ((start_id, fit, groups) for start_id, *groups in self.stream_journey_durations()
+                    if start_id in missing)
+        else:
+            # workers only need the query parameters, not the city
+            fitter = copy(self)
+            fitter.london = City(interval_size=self.minute_interval)
+            fit = partial(fitter.fetch_duration_params, fit_method=fit_method)
+            jobs = ((start_id, fit, (start_id,)) for start_id in missing)
+        n_cached = 0
+
+        def cache(start_id, d):
+            nonlocal n_cached
+            self.cache_station_params(start_id, d, cache_loc)
+            n_cached += 1
+            print(f"cached duration parameters of station {start_id} ({n_cached}/{len(missing)})")
+
+        if workers == 1:
+            for start_id, fit, args in jobs:
+                cache(start_id, fit(*args))
+            return
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for start_id, fit, args in jobs:
+                futures[pool.submit(fit, *args)] = start_id
+                # don't read far ahead of the fitting, so that few stations' journeys are held at once
+                if len(futures) >= 2 * workers:
+                    finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        cache(futures.pop(future), future.result())
+            for future in as_completed(list(futures)):
+                cache(futures.pop(future), future.result())
+
+    def stream_journey_durations(self, chunk_size=1000000):
+        """Reads the journeys which duration parameters are fitted to in a single scan, ordered by start and end
+        station so that SQLite can follow the start_end index, and yields (start_id, end_ids, offsets, durations) for
+        each start station in turn. Durations of journeys to end_ids[k] are durations[offsets[k]:offsets[k+1]], as
+        fit_duration_groups expects. Only chunk_size rows and one station's journeys are held at a time."""
+        db = sqlite3.connect(DATABASE)
+        try:
+            cursor = db.execute(
+                f"""
+                SELECT
+                    "StartStation Id"
+                    ,"EndStation Id"
+                    ,Duration / 60 AS Duration
+                FROM
+                    journeys
+                WHERE
+                    year >= {self.min_year}
+                    AND weekday_ind = 1
+                    AND "StartStation Id" != -1
+                    AND "StartStation Id" NOT NULL
+                    AND "EndStation Id" != -1
+                    AND "EndStation Id" NOT NULL
+                    AND Duration NOT NULL
+                    {self.additional_filters}
+                ORDER BY
+                    1,2
+                """
+            )
+            # rows of the start station which may continue into the next chunk
+            pending = numpy.zeros((0, 3), dtype=float)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                rows = numpy.concatenate([pending, numpy.array(rows, dtype=float)])
+                starts = numpy.flatnonzero(numpy.r_[True, rows[1:, 0] != rows[:-1, 0]])
+                for a, b in zip(starts[:-1], starts[1:]):
+                    yield _duration_groups(rows[a:b])
+                pending = rows[starts[-1]:]
+            if len(pending):
+                yield _duration_groups(pending)
+        finally:
+            db.close()
+
+    def duration_fit_report(self, start_ids=None, sample_size=200, seed=0):
+        """gumbel_fit.accuracy_report of the vectorised fit against scipy, for a sample of the (start, end) pairs
+        starting at start_ids (by default, every station), with start_id and end_id columns"""
+        start_ids = set(self.london._stations.keys() if start_ids is None else start_ids)
+        pairs, durations, offsets = [], [], [0]
+        for start_id, end_ids, group_offsets, group_durations in self.stream_journey_durations():
+            if start_id in start_ids:
+                pairs.extend((start_id, int(end_id)) for end_id in end_ids)
+                durations.append(group_durations)
+                offsets.extend(offsets[-1] + group_offsets[1:])
+        if not durations:
+            raise ValueError("There are no journeys from the given stations to report on")
+        report = accuracy_report(numpy.concatenate(durations), offsets, sample_size, seed)
+        report.insert(0, 'start_id', [pairs[k][0] for k in report['group']])
+        report.insert(1, 'end_id', [pairs[k][1] for k in report['group']])
+        return report.drop(columns='group')
+
+    def get_duration_params(self, start_id, cache_loc=DURATION_CACHE):
+        """A station's duration parameters from the cache, which are fetched and cached first if they are missing"""
+        try:
+            d = self.get_params_from_cache(start_id, cache_loc)
+        except KeyError:
+            d = self.fetch_duration_params(start_id)
+            self.cache_station_params(start_id, d, cache_loc)
+        return d
+
+    def prefetch(self):
+        """Loads every station's parameters which were populated lazily, e.g. before a full simulation run"""
+        for station in self.london._stations.values():
+            station.load_parameters()
+
+    def create_london_from_scratch(self, lazy=False, workers=1):
+        """With lazy, destination and duration parameters are only loaded for stations which need them, which is
+        much quicker for exploratory work. Call prefetch before saving the city or simulating all of it.
+        workers: number of processes to fit missing duration parameters across"""
         print("Creating City using fresh data pulls")
         self.populate_warehouses()
         self.populate_tfl_stations()
         self.populate_station_demand_dicts()
-        self.populate_station_destination_dicts()
-        self.populate_station_duration_params()
+        self.populate_station_destination_dicts(lazy=lazy)
+        self.populate_station_duration_params(lazy=lazy, workers=workers)
+        if not lazy:
+            self.london.compile_samplers()
         print("Done!")
         print(".london attribute has been populated using fresh SQL pulls")
 
@@ -309,14 +575,58 @@ class LondonCreator:
         print(f".london attribute has been loaded from {in_dir}")
         if not self.london._stations:
             print("Warning. No stations in loaded city")
+        # cities pickled before samplers existed won't have them, so they are always re-compiled
+        self.london.compile_samplers()
+
+    def save_city(self, out_dir='tfl_project/simulation/files/pickled_cities/london/'):
+        """Saves the city to the specified directory as a ParameterBundle: a .npy file per parameter array, which
+        load_city and load_city_bundle can memory-map rather than unpickle. Also saves a parameter json for future
+        compatibility checks"""
+        out_dir = Path(out_dir)
+        ParameterBundle.from_city(self.london).save(out_dir)
+        self.dump_parameter_json(out_dir / 'last_used_params.json')
+        print(f'City saved in {out_dir} for future use. Use load_city to use it again')
+
+    def load_city_bundle(self, in_dir='tfl_project/simulation/files/pickled_cities/london/'):
+        """The memory-mapped ParameterBundle saved by save_city, after checking its compatibility. This takes
+        milliseconds, and can be simulated with SimulationManager(engine='array') without building any Stations."""
+        json_loc = Path(in_dir) / 'last_used_params.json'
+        if not self.parameter_json_is_compatible(json_loc):
+            raise IncompatibleParamsError(f"{json_loc} indicates that the city in {in_dir} has incompatible parameters")
+        return ParameterBundle.load(in_dir)
+
+    def load_city(self, in_dir='tfl_project/simulation/files/pickled_cities/london/'):
+        """Loads a city saved by save_city into the .london attribute"""
+        self.london = self.load_city_bundle(in_dir).to_city()
+        print(f".london attribute has been loaded from {in_dir}")
+        if not self.london._stations:
+            print("Warning. No stations in loaded city")
+
+    def city_location(self):
+        """Where get_or_create_london saves this LondonCreator's city by default: a directory of CITY_STORE named by
+        parameter_key('city'), so that cities of different parameters sit side by side"""
+        return CITY_STORE / f"city_{self.parameter_key('city')}"
 
-    def get_or_create_london(self, pickle_loc='tfl_project/simulation/files/pickled_cities/london'):
+    def get_or_create_london(self, pickle_loc=None):
+        """Loads the city saved in pickle_loc, or creates and saves it there if there isn't one. By default
+        pickle_loc is city_location(), so each set of parameters has its own city. A city saved in
+        LEGACY_CITY_LOCATION with exactly these parameters is used instead, if city_location() doesn't have one yet"""
+        if pickle_loc is None:
+            pickle_loc = self.city_location()
+            if not (pickle_loc / 'last_used_params.json').exists() and self.legacy_city_is_compatible():
+                print(f"using the city previously saved in {LEGACY_CITY_LOCATION}")
+                pickle_loc = LEGACY_CITY_LOCATION
         try:
-            self.load_pickled_city(in_dir=pickle_loc)
+            try:
+                self.load_city(in_dir=pickle_loc)
+            except (FileNotFoundError, IncompatibleBundleError):
+                # directories written before save_city existed hold a pickled city, which is converted
+                self.load_pickled_city(in_dir=pickle_loc)
+                self.save_city(out_dir=pickle_loc)
         except FileNotFoundError:
-            print('existing pickled London not found: creating from scratch.')
+            print('existing saved London not found: creating from scratch.')
             self.create_london_from_scratch()
-            self.pickle_city(out_dir=pickle_loc)
+            self.save_city(out_dir=pickle_loc)
         except IncompatibleParamsError:
             error_string = 'Previously pickled city is incompatible with your current LondonCreator parameters.\n' \
                     'Pass the location of either: a blank directory, or the location of a compatible pickled city.'
@@ -324,13 +634,67 @@ class LondonCreator:
             raise
         return self.london
 
+    def legacy_city_is_compatible(self):
+        """Whether LEGACY_CITY_LOCATION holds a city made with this LondonCreator's city parameters. Unlike
+        parameter_json_is_compatible, a json lacking any of them doesn't match: it may predate warehouses"""
+        json_loc = LEGACY_CITY_LOCATION / 'last_used_params.json'
+        if not json_loc.exists():
+            return False
+        with open(json_loc) as f:
+            d = json.load(f)
+        return all(k in d for k in ARTIFACT_PARAMETERS['city']) and self.parameters_are_compatible(d)
+
+    def artifact_parameters(self, artifact):
+        """The parameters which the cached artifact ('demand', 'destinations', 'durations' or 'city') is made from"""
+        return {k: self.__dict__[k] for k in ARTIFACT_PARAMETERS[artifact]}
+
+    def parameter_key(self, artifact='city'):
+        """A stable hash of exactly the parameters the artifact is made from, which names it in its cache. Changing
+        any other parameter (e.g. warehouses, for anything but the city) leaves the key, and the cached artifact,
+        as they were"""
+        return parameter_key(self.artifact_parameters(artifact))
+
+    def cached_rows(self, artifact, cache_loc, dtype, query):
+        """The rows returned by query(), which the artifact is made from. They are saved in cache_loc as a .npy file
+        named by parameter_key(artifact) and database_fingerprint() (next to a json of both), and only fetched from
+        the database if that file doesn't exist yet. So rows are fetched again whenever the database is refreshed.
+        dtype: the numpy dtype of a row"""
+        cache_loc = Path(cache_loc)
+        parameters = dict(self.artifact_parameters(artifact), database=self.database_fingerprint())
+        key = parameter_key(parameters)
+        rows_loc = cache_loc / f'{key}.npy'
+        if rows_loc.exists():
+            print(f"loading {artifact} rows from {rows_loc}")
+            return numpy.load(rows_loc).tolist()
+        rows = self.select_query_db(query())
+        if not cache_loc.exists():
+            print(f"adding new cache directory: {str(cache_loc)}")
+            cache_loc.mkdir(parents=True)
+        with open(cache_loc / f'{key}.json', 'w') as f:
+            json.dump(parameters, f)
+        # written under another name first, so that an interrupted save is never loaded
+        with open(cache_loc / f'{key}.tmp', 'wb') as f:
+            numpy.save(f, numpy.array(rows, dtype=dtype))
+        os.replace(cache_loc / f'{key}.tmp', rows_loc)
+        return rows
+
+    @staticmethod
+    def database_fingerprint():
+        """The modification time and size of the database, or None if there isn't one"""
+        if not DATABASE.exists():
+            return None
+        stat = DATABASE.stat()
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def parameter_dict(self):
+        # careful not to include the actual london attribute, or private state
+        return {k: v for k, v in vars(self).items() if k != 'london' and not k.startswith('_')}
+
     def dump_parameter_json(self, out_f='tfl_project/simulation/files/last_used_params.json'):
         """This saves the current LondonCreator parameters to a JSON so that cached simulation parameters can be
         checked for 'compatibility' with future LondonCreator instances"""
-        d = vars(self).copy()  # careful not to delete the actual london attribute from self!
-        del d['london']
         with open(Path(out_f), 'w') as outfile:
-            json.dump(d, outfile)
+            json.dump(self.parameter_dict(), outfile)
 
     def parameter_json_is_compatible(self, in_f):
         """Checks attributes of this LondonCreator against a previously-saved parameter json and returns true if it
@@ -341,6 +705,10 @@ class LondonCreator:
         cached duration parameters can also be used by 'warehoused london'"""
         with open(Path(in_f)) as infile:
             d = json.load(infile)
+        return self.parameters_are_compatible(d)
+
+    def parameters_are_compatible(self, d: dict):
+        """As parameter_json_is_compatible, for parameters which have already been read from json"""
         for k, v in d.items():
             # This block looks a bit messy now and stems from the fact that json converts integer dict keys to strings.
             # After adding the LondonCreator.warehoused_stations attribute I had to do this workaround.
@@ -361,47 +729,256 @@ class LondonCreator:
         return True
 
 
+def parameter_key(parameters: dict):
+    """A short hash of parameters which doesn't depend on their order, or on whether they have been through json"""
+    canonical = json.dumps(json.loads(json.dumps(parameters)), sort_keys=True)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:16]
+
+
+def _duration_groups(rows):
+    """(start_id, end_ids, offsets, durations) of one start station's (start, end, duration) rows, sorted by end"""
+    ends = rows[:, 1]
+    starts = numpy.flatnonzero(numpy.r_[True, ends[1:] != ends[:-1]])
+    return int(rows[0, 0]), ends[starts].astype(numpy.int64), numpy.r_[starts, len(rows)], rows[:, 2]
+
+
+def fit_duration_groups(end_ids, offsets, durations, fit_method='scipy'):
+    """A duration parameter dictionary, as fetch_duration_params returns, of gumbel_r parameters fitted to each group
+    of durations: those of journeys to end_ids[k] are durations[offsets[k]:offsets[k+1]]"""
+    if fit_method == 'vectorised':
+        locs, scales = fit_gumbel_groups(durations, offsets)
+        return {int(end_id): (float(loc), float(scale)) for end_id, loc, scale in zip(end_ids, locs, scales)}
+    if fit_method not in FIT_METHODS:
+        raise ValueError(f"fit_method must be one of {FIT_METHODS}. {fit_method} was given")
+    return {int(end_id): gumbel_r.fit(durations[a:b]) for end_id, a, b in zip(end_ids, offsets[:-1], offsets[1:])}
+
+
+def station_stream(seed_sequence: numpy.random.SeedSequence, st_id):
+    """The child of seed_sequence belonging to station st_id. It depends only on the station's id, so a station
+    gets the same stream whichever scenario it appears in."""
+    key = st_id if isinstance(st_id, int) and st_id >= 0 else zlib.crc32(str(st_id).encode())
+    return numpy.random.SeedSequence(seed_sequence.entropy, spawn_key=seed_sequence.spawn_key + (key,))
+
+
+class ReplicationRunner:
+    def __init__(self, city: City, engine='object', common_random_numbers=False, checkpoint=None):
+        """Runs single 24-hour replications of a base city. One of these lives in each SimulationManager worker.
+        Replications are run on the base city itself, which is reset to its current state before each one: call
+        .finish() to restore it afterwards.
+        With common_random_numbers, each station draws its demand from its own stream and rerouting draws from another,
+        so that a replication's demand does not depend on anything else that happens in the city.
+        With a checkpoint (see City.checkpoint), replications start from it rather than from midnight, and are only
+        seeded from that point on."""
+        self.base_city = city
+        self.engine = engine
+        self.common_random_numbers = common_random_numbers
+        self.checkpoint = checkpoint
+        if engine == 'array':
+            self.array_city = ArrayCity(city)
+        else:
+            # restored by finish()
+            self._found_state = city.checkpoint()
+            self._found_initial_state = city._initial_state
+            city.save_initial_state()
+            if common_random_numbers:
+                # searchsorted samplers draw from the station's Generator; the fallback uses the random module
+                city.compile_samplers(missing_only=True)
+
+    def run(self, sim_num, seed_sequence: numpy.random.SeedSequence):
+        """Simulates 24 hours, with every source of randomness seeded from seed_sequence, and returns the
+        resulting time series and event DataFrames"""
+        print(f"Simulation {sim_num} -----------")
+        python_seed, reroute_seed, generator_seed = substreams(seed_sequence, 3)
+        random.seed(int(python_seed.generate_state(1)[0]))
+        if self.engine == 'array':
+            # ArrayCity always keeps demand and rerouting draws on separate streams
+            city_instance = self.array_city
+            city_instance.reset(seed=generator_seed)
+        else:
+            city_instance = self.base_city
+            city_instance.reset()
+            if self.common_random_numbers:
+                for st_id, station in city_instance.stations.items():
+                    station.rng = numpy.random.default_rng(station_stream(generator_seed, st_id))
+                city_instance.reroute_rng = numpy.random.default_rng(reroute_seed)
+            else:
+                # the city's stations share one stream, which is the replication's own
+                generator = numpy.random.default_rng(generator_seed)
+                for station in city_instance.stations.values():
+                    station.rng = generator
+        if self.checkpoint is not None:
+            city_instance.restore(self.checkpoint, random_state=False)
+        for t in range(city_instance._time, 60*24):
+            # Each run simulates 24 hours, by minute
+            city_instance.main_elapse_time(1)
+            if t % 60 == 0:
+                print(f"simulation: {sim_num} \t hour: {t//60}")
+        return city_instance.get_timeseries_df(), city_instance.get_events_df()
+
+    def finish(self):
+        """Leaves the base city as it was found"""
+        if self.engine == 'object':
+            for station in self.base_city.stations.values():
+                station.__dict__.pop('rng', None)
+            if self.common_random_numbers:
+                self.base_city.__dict__.pop('reroute_rng', None)
+            # this also gives back any streams of the city's own
+            self.base_city.restore(self._found_state)
+            self.base_city._initial_state = self._found_initial_state
+
+
+# Each worker process holds its own ReplicationRunner, so the base city is only sent to each worker once
+_worker_runner = None
+
+
+def _init_worker(city, engine, common_random_numbers, checkpoint):
+    global _worker_runner
+    _worker_runner = ReplicationRunner(city, engine, common_random_numbers, checkpoint)
+
+
+def _run_in_worker(sim_num, seed_sequence):
+    return _worker_runner.run(sim_num, seed_sequence)
+
+
 class SimulationManager:
-    def __init__(self, city: City, n_simulations: int, simulation_id: str):
+    def __init__(self, city: City, n_simulations: int, simulation_id: str, engine='object', workers=1, seed=None,
+                 output='memory', common_random_numbers=False, target_half_width: dict = None, confidence=0.95,
+                 min_simulations=5, checkpoint=None):
         """
-        :param city: Pass a City instance which will undergo 24 simulation-hours, n times
-        :param n_simulations: Number of times to repeat the simulation.
+        :param city: Pass a City instance which will undergo 24 simulation-hours, n times. For engine='array' this
+            may instead be a ParameterBundle of one.
+        :param n_simulations: Number of times to repeat the simulation, or the most times if target_half_width is given.
         :param simulation_id: A string which should uniquely identify this set of simulations.
             The CSVs resulting from the simulation will be stored in tfl_project/data/simulation_outputs/<simulation_id>
+        :param engine: 'object' simulates the City's own Station and User objects. 'array' converts the city to an
+            ArrayCity, which gives the same outputs but is much faster for large cities.
+        :param workers: Number of processes to spread the simulations across.
+        :param seed: Each simulation gets an independent random stream spawned from this seed, so results are
+            reproducible regardless of the number of workers. If None, a seed is chosen and kept in .seed
+        :param output: 'memory' keeps all results in .combined_timeseries_df and .combined_event_df (e.g. for
+            notebooks), to be saved with output_dfs_to_csv(). 'csv' or 'parquet' instead write each simulation's
+            results to the output directory as soon as it finishes, so memory use stays flat.
+        :param common_random_numbers: Give each station its own random stream, so that simulation i of two scenarios run
+            with the same seed sees the same demand. Differences between the scenarios can then be estimated from far
+            fewer simulations, using paired_differences().
+        :param target_half_width: e.g. {'failed_starts': 50}. Keep running simulations (at least min_simulations, at
+            most n_simulations) until the confidence interval on the mean total of each of these events is no wider than
+            plus or minus the given amount. Events are keys of EVENT_KEYS.
+        :param confidence: confidence level of those intervals
+        :param checkpoint: start every simulation from this City.checkpoint() rather than from midnight, e.g. to share
+            the hours before a scenario's intervention. Simulations are seeded at the checkpoint, so they share its
+            history and diverge afterwards. Take it from city itself for engine='object', or from an ArrayCity of city
+            for engine='array'.
         """
+        if engine not in ('object', 'array'):
+            raise ValueError(f"engine must be 'object' or 'array'. {engine} was given")
+        if isinstance(city, ParameterBundle) and engine != 'array':
+            raise ValueError("A ParameterBundle can only be simulated with engine='array'")
+        if output not in WRITERS:
+            raise ValueError(f"output must be one of {list(WRITERS)}. {output} was given")
+        if target_half_width is not None and not set(target_half_width) <= set(EVENT_KEYS):
+            raise ValueError(f"target_half_width can only be given for {EVENT_KEYS}. {target_half_width} was given")
         self.base_city = city
+        self.engine = engine
         self.n_simulations = n_simulations
         self.simulation_id = simulation_id
-        self.combined_timeseries_df = None
-        self.combined_event_df = None
+        self.workers = workers
+        self.seed = numpy.random.SeedSequence(seed).entropy
+        self.output = output
+        self.writer = WRITERS[output](self.output_dir)
+        self.common_random_numbers = common_random_numbers
+        self.target_half_width = target_half_width
+        self.confidence = confidence
+        self.min_simulations = max(min_simulations, 2)
+        self.checkpoint = checkpoint
+        self._totals = []
+
+    @property
+    def output_dir(self):
+        return Path('tfl_project/data/simulation_outputs/') / self.simulation_id
+
+    @property
+    def combined_timeseries_df(self):
+        """All simulations' time series. Only available with output='memory'"""
+        if self.output == 'memory':
+            return self.writer.combined_df('time_series')
+
+    @property
+    def combined_event_df(self):
+        """All simulations' events. Only available with output='memory'"""
+        if self.output == 'memory':
+            return self.writer.combined_df('events')
 
     def run_simulations(self):
         print("Begin simulations -------------------")
-        for i in range(self.n_simulations):
-            print(f"Simulation {i} -----------")
-            city_instance = deepcopy(self.base_city)
-            for t in range(60*24):
-                # Each run simulates 24 hours, by minute
-                city_instance.main_elapse_time(1)
-                if t % 60 == 0:
-                    print(f"simulation: {i} \t hour: {t//60}")
-            # This feels clunky...
-            self.combined_timeseries_df = self.append_to_combined_df(self.combined_timeseries_df, self.simulation_id, i, city_instance.get_timeseries_df())
-            self.combined_event_df = self.append_to_combined_df(self.combined_event_df, self.simulation_id, i, city_instance.get_events_df())
-        print(f"completed {self.n_simulations} simulations ")
+        self.writer.open()
+        self._totals = []
+        seed_sequences = numpy.random.SeedSequence(self.seed).spawn(self.n_simulations)
+        try:
+            if self.workers > 1:
+                self._run_in_workers(seed_sequences)
+            else:
+                runner = ReplicationRunner(self.base_city, self.engine, self.common_random_numbers, self.checkpoint)
+                try:
+                    for i in range(self.n_simulations):
+                        if self.precise_enough():
+                            break
+                        self.store_simulation(i, *runner.run(i, seed_sequences[i]))
+                finally:
+                    # the base city is given back as it was found, even if a simulation fails
+                    runner.finish()
+        finally:
+            self.writer.close()
+        if self.target_half_width and not self.precise_enough():
+            print(f"Warning: target_half_width was not reached within {self.n_simulations} simulations")
+        print(f"completed {len(self._totals)} simulations ")
         print("-------------------------------------")
 
-    def append_to_combined_df(self, combined_df: DataFrame, simulation_id: str, sim_num: int, instance_df: DataFrame):
-        instance_df['simulation_id'] = simulation_id
-        instance_df['sim_num'] = sim_num
-        if combined_df is None:
-            combined_df = instance_df
-        else:
-            combined_df = combined_df.append(instance_df.copy(), ignore_index=True)
-        return combined_df
+    def _run_in_workers(self, seed_sequences):
+        # with a target, simulations are launched a batch at a time so that precision can be checked in between
+        batch_size = self.workers if self.target_half_width else self.n_simulations
+        with self._worker_city() as worker_city, \
+                ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                    initargs=(worker_city, self.engine, self.common_random_numbers,
+                                              self.checkpoint)) as pool:
+            sim_num = 0
+            while sim_num < self.n_simulations and not self.precise_enough():
+                batch = range(sim_num, min(sim_num + batch_size, self.n_simulations))
+                # map returns results in sim_num order, whichever worker finishes first
+                results = pool.map(_run_in_worker, batch, seed_sequences[batch.start:batch.stop])
+                for i, (timeseries_df, event_df) in zip(batch, results):
+                    self.store_simulation(i, timeseries_df, event_df)
+                sim_num = batch.stop
+
+    def _worker_city(self):
+        """What to send each worker: for the array engine, a memory-mapped ParameterBundle which all of the workers
+        share, rather than a copy of the city each"""
+        if self.engine == 'array':
+            return shared_bundle(self.base_city)
+        return nullcontext(self.base_city)
+
+    def store_simulation(self, sim_num, timeseries_df: DataFrame, event_df: DataFrame):
+        totals = event_df['event'].value_counts()
+        self._totals.append(dict(sim_num=sim_num, **{key: int(totals.get(key, 0)) for key in EVENT_KEYS}))
+        for instance_df in (timeseries_df, event_df):
+            instance_df['simulation_id'] = self.simulation_id
+            instance_df['sim_num'] = sim_num
+        self.writer.write(timeseries_df, event_df)
+
+    def replication_totals(self):
+        """Total failed starts, failed ends and finished journeys of each simulation, indexed by sim_num. Available
+        whatever the output mode."""
+        return DataFrame(self._totals, columns=['sim_num', *EVENT_KEYS]).set_index('sim_num')
+
+    def precise_enough(self):
+        """Whether the simulations so far meet target_half_width. Always False if there is no target."""
+        if not self.target_half_width or len(self._totals) < self.min_simulations:
+            return False
+        half_widths = confidence_half_widths(self.replication_totals(), self.confidence)
+        return all(half_widths[key] <= target for key, target in self.target_half_width.items())
 
     def output_df_to_csv(self, df, descriptor=''):
-        output_dir = Path('tfl_project/data/simulation_outputs/') / self.simulation_id
+        output_dir = self.output_dir
         if not output_dir.exists():
             output_dir.mkdir()
         output_file = output_dir / (descriptor + '.csv')
@@ -411,5 +988,42 @@ class SimulationManager:
         df.to_csv(output_file, index=False)
 
     def output_dfs_to_csv(self):
+        if self.output != 'memory':
+            print(f"Results were written to {self.output_dir} as the simulations ran")
+            return
         self.output_df_to_csv(self.combined_timeseries_df, 'time_series')
         self.output_df_to_csv(self.combined_event_df, 'events')
+
+
+def confidence_half_widths(totals: DataFrame, confidence=0.95):
+    """Half-width of the Student's t confidence interval on the mean of each column of totals"""
+    n = len(totals)
+    return t_dist.ppf((1 + confidence) / 2, n - 1) * totals.std(ddof=1) / n ** 0.5
+
+
+def paired_differences(baseline: SimulationManager, scenario: SimulationManager, confidence=0.95):
+    """
+    Compares the event totals of two sets of simulations, replication by replication. Both should have been run with
+    common_random_numbers and the same seed, so that simulation i of each saw the same demand: the noise in the
+    paired differences is then much smaller than in either set of totals.
+    :return: DataFrame indexed by event with the mean of each set, the mean and standard deviation of the
+        differences (scenario - baseline), and the half-width of a confidence interval for the mean difference
+    """
+    if baseline.seed != scenario.seed:
+        raise IncompatibleParamsError("Paired simulations must be run with the same seed")
+    if not (baseline.common_random_numbers and scenario.common_random_numbers):
+        print("Warning: simulations were not run with common_random_numbers, so pairing them reduces little noise")
+    base_totals, scenario_totals = baseline.replication_totals().align(scenario.replication_totals(), join='inner')
+    differences = scenario_totals - base_totals
+    n = len(differences)
+    if n < 2:
+        raise IncompatibleParamsError("At least two paired simulations are needed")
+    summary = DataFrame({
+        'baseline_mean': base_totals.mean()
+        , 'scenario_mean': scenario_totals.mean()
+        , 'mean_difference': differences.mean()
+        , 'sd_difference': differences.std(ddof=1)
+        , 'ci_half_width': confidence_half_widths(differences, confidence)
+    })
+    summary['n'] = n
+    return summary
@@ -3,7 +3,6 @@ from random import choices, choice
 
 import numpy.random
 from numpy import nan
-from scipy.stats import gumbel_r
 
 
 class BikeUnderflowException(Exception):
@@ -71,6 +70,11 @@ class Store:
 
 
 class Station(Store):
+    # Generator for all of a station's random draws. Shared by all stations unless an instance is given its own
+    rng = numpy.random.default_rng()
+    # Attributes which can be loaded on first use (see load_lazily), and the parameters which provide them
+    LAZY_ATTRIBUTES = {'_dest_dict': 'destinations', '_dest_samplers': 'destinations', '_duration_dict': 'durations'}
+
     def __init__(self, capacity, docked_init, st_id=None, demand_dict=None, dest_dict=None, duration_dict=None,
                  latitude=0, longitude=0):
         """
@@ -102,6 +106,51 @@ class Station(Store):
         else:
             self._duration_dict = {}
 
+        # Compiled from _dest_dict by compile_destination_samplers(). Intervals without one fall back to _dest_dict
+        self._dest_samplers = {}
+        # Compiled from _duration_dict by compile_duration_sampler() when durations are first picked
+        self._duration_index = None
+        self._duration_params = None
+
+    def load_lazily(self, destinations=None, durations=None):
+        """
+        Defers loading the station's destination and/or duration parameters until they are first used, so that
+        stations no journey starts from never need theirs. Loaded parameters are kept.
+        :param destinations: a function of the station's id which returns its _dest_dict. Samplers are compiled from
+            it when it is loaded.
+        :param durations: a function of the station's id which returns its _duration_dict
+        """
+        loaders = self.__dict__.setdefault('_lazy_loaders', {})
+        if destinations is not None:
+            loaders['destinations'] = destinations
+            self.__dict__.pop('_dest_dict', None)
+            self.__dict__.pop('_dest_samplers', None)
+        if durations is not None:
+            loaders['durations'] = durations
+            self.__dict__.pop('_duration_dict', None)
+            self._duration_index = None
+
+    def load_parameters(self):
+        """Loads any parameters still waiting to be loaded: see load_lazily"""
+        for kind in list(self.__dict__.get('_lazy_loaders', {})):
+            self._load(kind)
+
+    def _load(self, kind):
+        loader = self.__dict__['_lazy_loaders'].pop(kind)
+        if kind == 'destinations':
+            self._dest_dict = loader(self._id)
+            self.compile_destination_samplers()
+        else:
+            self._duration_dict = loader(self._id)
+
+    def __getattr__(self, name):
+        # Only called for attributes which are missing, such as parameters waiting to be loaded
+        kind = Station.LAZY_ATTRIBUTES.get(name)
+        if kind is None or kind not in self.__dict__.get('_lazy_loaders', {}):
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        self._load(kind)
+        return self.__dict__[name]
+
     def decide_journey_demand(self, interval, elapsing=1):
         """
         The station will decide what journeys will start at it during the elapsing time period, including destinations
@@ -116,38 +165,113 @@ class Station(Store):
         else:
             demand_p_min = 0
         # number of journeys is sampled from poisson process based on current demand per minute
-        n_journeys = numpy.random.poisson(lam=demand_p_min*elapsing)
-
-        for i in range(n_journeys):
-            if interval in self._dest_dict:
-                # destinations sampled from multinomial distribution based on previous destinations at this interval
-                dest_id = choices(
-                    population=self._dest_dict[interval]['destinations']
-                    , weights=self._dest_dict[interval]['volumes']
-                    , k=1
-                )[0]
-                destination = self._city.get_station(dest_id)
+        n_journeys = self.rng.poisson(lam=demand_p_min*elapsing)
+        if n_journeys == 0:
+            return journey_demand
+
+        # destinations sampled from multinomial distribution based on previous destinations at this interval
+        if interval in self._dest_samplers:
+            dest_ids = self.sample_destinations(interval, n_journeys)
+        elif interval in self._dest_dict:
+            dest_ids = choices(
+                population=self._dest_dict[interval]['destinations']
+                , weights=self._dest_dict[interval]['volumes']
+                , k=n_journeys
+            )
+        else:
+            dest_ids = [None] * n_journeys
+
+        destinations = []
+        for i, dest_id in enumerate(dest_ids):
+            if dest_id is not None:
+                destinations.append(self._city.get_station(dest_id))
             else:
                 print(f"Warning: Station {self._id} was asked to generate unprecedented demand for interval {interval}")
-                destination = choice(list(self._city._stations.values()))
-                dest_id = destination.get_id()
-            # decide duration using gumbel_r distribution
-            duration = self.pick_duration(dest_id)
+                destinations.append(choice(list(self._city._stations.values())))
+                dest_ids[i] = destinations[-1].get_id()
+        # decide durations using gumbel_r distribution
+        durations = self.pick_durations(dest_ids)
+        for destination, duration in zip(destinations, durations):
             journey_demand.append((self, destination, duration))
         return journey_demand
 
-    def pick_duration(self, dest_id):
-        """Randomly pick a duration based on the gumbel_r distribution for durations from self to destination station.
-        If an unprecendented destination is selected, a random gumbel is picked from self"""
-        if dest_id in self._duration_dict:
-            duration = round(gumbel_r(*self._duration_dict[dest_id]).rvs(1)[0])
-        else:
-            print(f"Warning: Station {self._id} was asked to generate unprecedented duration for destination {dest_id}")
-            duration = round(gumbel_r(*choice(list(self._duration_dict.values()))).rvs(1)[0])
-        duration = max(duration, 1)
-        return int(duration)
+    def compile_duration_sampler(self):
+        """Stores the gumbel_r (loc, scale) pairs in _duration_dict as one array, with an index from destination id
+        to row, so that many durations can be drawn in a single call"""
+        self._duration_index = {dest_id: i for i, dest_id in enumerate(self._duration_dict)}
+        self._duration_params = numpy.array([params[:2] for params in self._duration_dict.values()], dtype=float)\
+            .reshape(-1, 2)
+
+    def pick_durations(self, dest_ids, rng=None):
+        """Randomly pick a duration for each destination based on the gumbel_r distribution for durations from self to
+        that destination station. If an unprecendented destination is given, a random gumbel is picked from self.
+        Durations are rounded and are at least 1 minute.
+        rng: a numpy Generator to draw from instead of the station's own"""
+        if rng is None:
+            rng = self.rng
+        if self._duration_index is None:
+            self.compile_duration_sampler()
+        rows = [self._duration_index.get(dest_id, -1) for dest_id in dest_ids]
+        for i, row in enumerate(rows):
+            if row == -1:
+                print(f"Warning: Station {self._id} was asked to generate unprecedented duration for destination "
+                      f"{dest_ids[i]}")
+                if not len(self._duration_params):
+                    raise ValueError(f"Station {self._id} has no duration parameters to choose from")
+                rows[i] = rng.integers(len(self._duration_params))
+        params = self._duration_params[rows]
+        # Generator.gumbel draws by inverse-CDF, and has the same distribution as scipy.stats.gumbel_r
+        durations = numpy.rint(rng.gumbel(params[:, 0], params[:, 1]))
+        return numpy.maximum(durations, 1).astype(int).tolist()
+
+    def pick_duration(self, dest_id, rng=None):
+        """Randomly pick a single duration: see pick_durations"""
+        return self.pick_durations([dest_id], rng)[0]
+
+    def compile_destination_samplers(self):
+        """Pre-computes, for every interval in _dest_dict, an array of destinations and their cumulative volumes. This
+        means a batch of destinations can be drawn with one searchsorted, rather than rebuilding the cumulative
+        weights for every journey."""
+        self._dest_samplers = {
+            interval: (numpy.array(entry['destinations']), numpy.cumsum(entry['volumes'], dtype=float))
+            for interval, entry in self._dest_dict.items()
+            if entry['destinations'] and sum(entry['volumes']) > 0
+        }
+
+    def samplers_compiled(self):
+        """Whether compile_destination_samplers and compile_duration_sampler are up to date with the parameters.
+        Parameters still waiting to be loaded (see load_lazily) count as compiled, as they are compiled once loaded,
+        and checking doesn't load them."""
+        return self._duration_sampler_compiled() and self._destination_samplers_compiled()
+
+    def _duration_sampler_compiled(self):
+        return 'durations' in self.__dict__.get('_lazy_loaders', {}) or self._duration_index is not None
+
+    def _destination_samplers_compiled(self):
+        if 'destinations' in self.__dict__.get('_lazy_loaders', {}):
+            return True
+        return self._dest_samplers.keys() == {
+            interval for interval, entry in self._dest_dict.items()
+            if entry['destinations'] and sum(entry['volumes']) > 0
+        }
+
+    def compile_samplers(self, missing_only=False):
+        """Compiles the destination and duration samplers. With missing_only, those which samplers_compiled() counts
+        as compiled are left as they are, so parameters waiting to be loaded stay unloaded."""
+        if not (missing_only and self._destination_samplers_compiled()):
+            self.compile_destination_samplers()
+        if not (missing_only and self._duration_sampler_compiled()):
+            self.compile_duration_sampler()
+
+    def sample_destinations(self, interval, n):
+        """Draws n destination ids for journeys starting in the given interval, using the compiled sampler"""
+        destinations, cum_volumes = self._dest_samplers[interval]
+        picks = numpy.searchsorted(cum_volumes, self.rng.random(n) * cum_volumes[-1], side='right')
+        return destinations[picks].tolist()
 
     def add_dest_volume_parameter(self, interval, destination_id, journeys):
+        # any compiled sampler for this interval is now out of date
+        self._dest_samplers.pop(interval, None)
         if interval not in self._dest_dict:
             self._dest_dict[interval] = {'destinations': [], 'volumes': []}
         interval_entry = self._dest_dict[interval]
@@ -156,6 +280,8 @@ class Station(Store):
 
     def add_dest_duration_params(self, destination_id, params):
         self._duration_dict[destination_id] = params
+        # any compiled sampler is now out of date
+        self._duration_index = None
 
 
 class WarehousedStation(Station):
@@ -12,11 +12,11 @@ def main():
     # filter to only stations for testing
     for i in list(lc.london._stations.keys()):
         if i not in [1, 6, 14, 98, 393]:
-            lc.london._stations.pop(i)
-    lc.populate_station_demand_dicts()
-    lc.populate_station_destination_dicts()
-    lc.populate_station_duration_params(Path('tfl_project/simulation/tests/files/caches/duration_params'))
-    lc.pickle_city('tfl_project/simulation/tests/files/')
+            lc.london.remove_station(i)
+    lc.populate_station_demand_dicts(Path('tfl_project/simulation/tests/files/caches/demand'))
+    lc.populate_station_destination_dicts(cache_loc=Path('tfl_project/simulation/tests/files/caches/destinations'))
+    lc.populate_station_duration_params(Path('tfl_project/simulation/tests/files/caches/duration_params/duration_params.sqlite'))
+    lc.save_city('tfl_project/simulation/tests/files/')
 
 
 if __name__ == "__main__":
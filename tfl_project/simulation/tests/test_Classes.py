@@ -1,18 +1,40 @@
 import pytest
-from random import seed
+import sqlite3
+from contextlib import closing
+from datetime import datetime, timedelta
+from random import Random, seed
 from math import isclose
+import json
 import os.path
+import pickle
 from os import remove
 from pathlib import Path
-from numpy import nan
+from numpy import nan, arange, array, concatenate, isfinite, rint
+from numpy.random import default_rng
+from scipy.stats import gumbel_r
 
-from tfl_project.simulation.city import City
+from tfl_project.database_creation import journey_aggregates_to_sql
+from tfl_project.simulation.agent_pool import AgentPool
+from tfl_project.simulation.city import City, User
+from tfl_project.simulation.array_city import ArrayCity
+from tfl_project.simulation.parameter_bundle import IncompatibleBundleError, ParameterBundle
+from tfl_project.simulation.duration_cache import DurationCache, open_cache
+from tfl_project.simulation.gumbel_fit import accuracy_report, fit_gumbel_groups
+from tfl_project.simulation.event_log import EventLog, FAILED_START, FAILED_END, FINISHED_JOURNEY
 from tfl_project.simulation.station import Store, Station, WarehousedStation, BikeUnderflowException,BikeOverflowException
-from tfl_project.simulation.sim_managment import LondonCreator, SimulationManager, IncompatibleParamsError
+from tfl_project.simulation.benchmarks.run_benchmarks import run_benchmark
+from tfl_project.simulation.benchmarks.synthetic_city import synthetic_city
+from tfl_project.simulation.scenario_sweep import Scenario, ScenarioSweep, scenario_grid
+from tfl_project.simulation import array_city, sim_managment
+from tfl_project.simulation.sim_managment import LondonCreator, SimulationManager, IncompatibleParamsError, \
+    ReplicationRunner, fit_duration_groups, paired_differences, parameter_key
 
 # A small version of London is pre-populated for some testing
 test_london_location = 'tfl_project/simulation/tests/files/'
-city_loc = Path(test_london_location) / 'london.pickle'
+city_loc = Path(test_london_location) / 'bundle.json'
+test_duration_cache = Path('tfl_project/simulation/tests/files/caches/duration_params/duration_params.sqlite')
+test_demand_cache = Path('tfl_project/simulation/tests/files/caches/demand')
+test_destination_cache = Path('tfl_project/simulation/tests/files/caches/destinations')
 if city_loc.exists():
     remove(city_loc)
     remove(Path(test_london_location) / 'last_used_params.json')
@@ -41,12 +63,15 @@ def nrly_empty_stn():
     return Station(capacity=16, docked_init=1)
 
 
+# additional SQL filters needed to pass compatibility check with output of pre_populate_test_london.py
+test_london_filters = """AND "StartStation Id" IN (1, 6, 14, 98, 393)
+                AND "EndStation Id" IN (1, 6, 14, 98, 393)"""
+
+
 @pytest.fixture
 def prepop_londoncreator():
-    # additional SQL filters needed to pass compatibility check with output of pre_populate_test_london.py
-    lc = LondonCreator(additional_sql_filters="""AND "StartStation Id" IN (1, 6, 14, 98, 393)
-                AND "EndStation Id" IN (1, 6, 14, 98, 393)""")
-    lc.load_pickled_city(test_london_location)
+    lc = LondonCreator(additional_sql_filters=test_london_filters)
+    lc.load_city(test_london_location)
     return lc
 
 @pytest.fixture
@@ -160,7 +185,7 @@ class TestCity:
             start_st=basic_city.get_station(0)
             , dest_st=basic_city.get_station(1)
             , duration=3)
-        user = basic_city._agents[0]
+        user = basic_city.agent(0)
         assert user._current_destination == basic_city.get_station(1)
 
         basic_city.move_agents(3)
@@ -172,6 +197,210 @@ class TestCity:
         assert user._remaining_duration > 0
         assert not user.need_new_destination
 
+    def test_arrival_schedule(self, basic_city):
+        basic_city.get_station(1)._docked = 16
+        for duration in (5, 2):
+            basic_city.generate_journey(
+                start_st=basic_city.get_station(0)
+                , dest_st=basic_city.get_station(1)
+                , duration=duration)
+        assert len(basic_city._agents) == 2
+        basic_city.move_agents(1)
+        assert basic_city._event_log['totals']['failed_ends'] == 0
+        basic_city.move_agents(1)
+        # only the shorter journey has arrived, and it is rescheduled after rerouting
+        assert basic_city._event_log['totals']['failed_ends'] == 1
+        assert basic_city.agent(1).need_new_destination
+        assert list(basic_city._agents.rerouting()) == [1]
+        basic_city.call_for_new_destinations()
+        assert not basic_city.agent(1).need_new_destination
+        assert not len(basic_city._agents.rerouting())
+
+    def test_reset(self, basic_city):
+        with pytest.raises(ValueError):
+            basic_city.reset()
+        basic_city.get_station(1)._docked = 3
+        basic_city.save_initial_state()
+        for i in range(5):
+            basic_city.main_elapse_time(1)
+        assert basic_city._agents
+        basic_city.reset()
+        assert basic_city.get_station(0)._docked == 8
+        assert basic_city.get_station(1)._docked == 3
+        assert len(basic_city._agents) == 0
+        assert basic_city._time == 0
+        assert basic_city._event_log['totals']['finished_journeys'] == 0
+        assert len(basic_city.get_timeseries_df()) == 1
+        # simulation managers leave the base city as they found it
+        SimulationManager(city=basic_city, n_simulations=2, simulation_id='TESTSIM').run_simulations()
+        assert basic_city.get_station(1)._docked == 3
+        assert basic_city._time == 0
+        # including the state saved by save_initial_state(), even when they start from somewhere else
+        basic_city.get_station(1)._docked = 5
+        SimulationManager(city=basic_city, n_simulations=2, simulation_id='TESTSIM').run_simulations()
+        assert basic_city.get_station(1)._docked == 5
+        basic_city.reset()
+        assert basic_city.get_station(1)._docked == 3
+
+    def test_remove_station(self, basic_city):
+        basic_city.add_station(Station(16, 8, st_id=2))
+        basic_city.save_initial_state()
+        assert basic_city.nearest_stations(basic_city.get_station(2))
+        removed = basic_city.remove_station(0)
+        assert removed._city is None
+        assert list(basic_city._stations) == [1, 2]
+        assert basic_city._station_ids == [1, 2]
+        assert basic_city._station_index == {1: 0, 2: 1}
+        assert removed not in basic_city.nearest_stations(basic_city.get_station(2))
+        basic_city.reset()
+        with pytest.raises(KeyError):
+            basic_city.remove_station(0)
+
+    def test_phase_instrumentation(self, basic_city):
+        for i in range(5):
+            basic_city.main_elapse_time(1)
+        assert basic_city.get_phase_df().empty
+        basic_city.instrument()
+        basic_city.get_station(1)._docked = 16
+        for i in range(65):
+            basic_city.main_elapse_time(1)
+        df = basic_city.get_phase_df()
+        assert list(df['hour']) == [0, 1]
+        assert list(df['ticks']) == [55, 10]
+        totals = basic_city._event_log['totals']
+        assert df['events_logged'].sum() == sum(totals.values()) - len(basic_city.get_events_df().query('time < 5'))
+        assert df['reroutes'].sum() > 0
+        assert (df['move_agents_seconds'] > 0).all()
+        ac = ArrayCity(basic_city, seed=1)
+        ac.instrument()
+        for i in range(60):
+            ac.main_elapse_time(1)
+        df = ac.get_phase_df()
+        assert df['ticks'].sum() == 60
+        assert df['journeys_requested'].sum() == ac._event_log['totals']['failed_starts'] + ac._agents.n_created
+
+    def test_checkpoint(self, basic_city, tmp_path):
+        basic_city.get_station(1)._docked = 14
+        # stations sharing a Generator still share it once restored
+        shared_rng = default_rng(3)
+        for station in basic_city.stations.values():
+            station.rng = shared_rng
+        for city_instance in (basic_city, ArrayCity(basic_city, seed=1)):
+            for i in range(30):
+                city_instance.main_elapse_time(1)
+            checkpoint = city_instance.checkpoint(location=tmp_path / 'checkpoint.pkl')
+            branches = []
+            for restore_from in (None, checkpoint, tmp_path / 'checkpoint.pkl'):
+                if restore_from is not None:
+                    city_instance.restore(restore_from)
+                for i in range(30):
+                    city_instance.main_elapse_time(1)
+                branches.append((city_instance.get_events_df(), city_instance.get_timeseries_df()))
+            # each branch continues exactly as the original did
+            for events, timeseries in branches[1:]:
+                assert events.equals(branches[0][0])
+                assert timeseries.equals(branches[0][1])
+            assert len(branches[0][1]) == 60
+        assert basic_city.get_station(0).rng is basic_city.get_station(1).rng
+        with pytest.raises(ValueError):
+            basic_city.restore(checkpoint)
+
+    def test_nearest_stations(self, monkeypatch):
+        c = City()
+        coords = [(0, 0), (2, 0), (None, None), (1, 0), (nan, nan), (0, 1)]
+        for i, (lat, long) in enumerate(coords):
+            c.add_station(Station(2, 1, st_id=i, latitude=lat, longitude=long))
+        # ties keep the order stations were added, and stations without co-ordinates come last
+        assert [st.get_id() for st in c.nearest_stations(c.get_station(0))] == [0, 3, 5, 1, 2, 4]
+        # the array engine orders them the same way
+        ac = ArrayCity(c)
+        for st in c.stations.values():
+            assert list(ac._nearest_order[st.get_id()]) == [s.get_id() for s in c.nearest_stations(st)]
+        ac._docked[[0, 3]] = 2
+        for candidates in (1, 8):
+            monkeypatch.setattr(array_city, 'NEAREST_CANDIDATES', candidates)
+            assert list(ac._nearest_available(array([0, 2, 0]))) == [5, 1, 5]
+        c.get_station(0)._docked = 2
+        c.get_station(3)._docked = 2
+        assert c.nearest_available_station(c.get_station(0)) == c.get_station(5)
+        for st in c.stations.values():
+            st._docked = 2
+        with pytest.raises(ValueError):
+            c.nearest_available_station(c.get_station(0))
+
+    def test_events_df(self, basic_city):
+        basic_city.get_station(1)._docked = 16
+        basic_city.generate_journey(
+            start_st=basic_city.get_station(0)
+            , dest_st=basic_city.get_station(1)
+            , duration=1)
+        basic_city.move_agents(1)
+        df = basic_city.get_events_df()
+        assert list(df.columns) == ['time', 'start_st', 'end_st', 'orig_start_st', 'orig_end_st', 'event']
+        assert df.loc[0, 'start_st'] == 0
+        assert df.loc[0, 'end_st'] == 1
+        assert df.loc[0, 'event'] == 'failed_ends'
+        assert df['event'].dtype == object
+
+
+class TestEventLog:
+    def test_chunks(self):
+        log = EventLog(chunk_size=4)
+        for i in range(3):
+            log.append(i, FAILED_START, 0, 1, 0, 1)
+        log.extend(3, array([FINISHED_JOURNEY, FAILED_END, FINISHED_JOURNEY]), array([1, 2, 2]), array([2, 0, 0]),
+                   array([1, 1, 1]), array([2, 2, 2]))
+        log.extend(4, FAILED_START, array([2]), array([1]), array([2]), array([1]))
+        assert len(log) == 7
+        assert len(log._full_chunks) == 1
+        assert list(log.column('time')) == [0, 1, 2, 3, 3, 3, 4]
+        df = log.to_dataframe(array([10, 20, 30]))
+        assert list(df['start_st']) == [10, 10, 10, 20, 30, 30, 30]
+        assert list(df['event']) == ['failed_starts'] * 3 + ['finished_journeys', 'failed_ends', 'finished_journeys',
+                                                              'failed_starts']
+        with pytest.raises(OverflowError):
+            log.append(EventLog.MAX_TIME + 1, FAILED_START, 0, 1, 0, 1)
+
+
+class TestAgentPool:
+    def test_slot_reuse(self):
+        pool = AgentPool(capacity=2)
+        assert list(pool.add(array([5, 1]), array([1, 1]), 0, 0, 1)) == [0, 1]
+        assert list(pool.add(3, 0, 1, 1, 0)) == [2]
+        # the pool doubled rather than running out of slots
+        assert pool.capacity == 4
+        assert len(pool) == 3
+        assert list(pool.arriving(3)) == [1, 2]
+        # each agent arrives once
+        assert not len(pool.arriving(3))
+        pool.remove(array([1]))
+        assert pool.add(9, 0, 1, 1, 0)[0] == 1
+        pool.strand(array([2]))
+        assert list(pool.rerouting()) == [2]
+        # a reused slot still arrives after agents who set off earlier
+        pool.redirect(array([2]), 1, 8.7)
+        assert not len(pool.rerouting())
+        assert pool.last[2] == 0 and pool.dest[2] == 1
+        assert list(pool.arriving(8)) == [0]
+        assert list(pool.arriving(8.5)) == [2]
+        assert list(pool.arriving(9)) == [1]
+        # agents are only touched when they are due, however many are travelling
+        pool.add(arange(100, 1100), array([0] * 1000), 1, 1, 0)
+        assert not len(pool.arriving(10))
+        assert len(pool._due_buckets) == 1000
+        assert list(pool.arriving(100)) == [3]
+        assert len(pool._due_buckets) == 999
+
+    def test_user_view(self, basic_city):
+        user = User(basic_city, basic_city.get_station(1), 2, basic_city.get_station(0))
+        assert basic_city.n_agents == 1
+        assert user.original_end_st == basic_city.get_station(1)
+        assert user._remaining_duration == 2
+        basic_city.move_agents(2)
+        assert user.finished
+        with pytest.raises(KeyError):
+            basic_city.agent(user.slot)
+
 
 class TestStation:
     def test_underflow(self, nrly_empty_stn):
@@ -210,6 +439,69 @@ class TestStation:
         # assert that station 1 was picked more often
         assert 0 < n_0_picked < n_1_picked < len(picked_destinations)
 
+    def test_compiled_destination_samplers(self, basic_city):
+        basic_city.compile_samplers()
+        trial_station = basic_city.get_station(0)
+        assert 0 in trial_station._dest_samplers
+        dest_ids = trial_station.sample_destinations(interval=0, n=1000)
+        # the dummy distribution put station 1 as roughly twice as likely as station 0
+        assert 200 < dest_ids.count(0) < dest_ids.count(1)
+        demand = trial_station.decide_journey_demand(interval=0, elapsing=10)
+        assert all(d[1] in (basic_city.get_station(0), basic_city.get_station(1)) for d in demand)
+        # adding parameters invalidates the compiled sampler for that interval
+        trial_station.add_dest_volume_parameter(interval=0, destination_id=1, journeys=5)
+        assert 0 not in trial_station._dest_samplers
+
+    def test_pick_durations(self, basic_city):
+        from numpy import random, rint, maximum
+        from scipy.stats import gumbel_r, ks_2samp
+        trial_station = basic_city.get_station(0)
+        trial_station.rng = random.default_rng(16)
+        durations = trial_station.pick_durations([1] * 5000)
+        assert all(isinstance(d, int) and d >= 1 for d in durations)
+        # same distribution as the rounded and clamped scipy gumbel_r
+        reference = maximum(rint(gumbel_r(5.11, 1.85).rvs(5000, random_state=16)), 1)
+        assert ks_2samp(durations, reference).pvalue > 0.001
+        assert trial_station.pick_duration(0) >= 1
+        trial_station.add_dest_duration_params(destination_id=1, params=(100, 1))
+        assert trial_station.pick_duration(1) > 90
+
+    def test_lazy_parameters(self, basic_city):
+        eager_station = basic_city.get_station(0)
+        loaded = []
+
+        def load(d):
+            def loader(st_id):
+                loaded.append(st_id)
+                return d
+            return loader
+        lazy_station = Station(16, 8, st_id=2, demand_dict={0: 5})
+        basic_city.add_station(lazy_station)
+        lazy_station.load_lazily(destinations=load(eager_station._dest_dict),
+                                 durations=load(eager_station._duration_dict))
+        assert '_dest_dict' not in lazy_station.__dict__
+        assert '_duration_dict' not in lazy_station.__dict__
+        assert lazy_station.samplers_compiled()
+        # runners which compile missing samplers don't load parameters up front
+        ReplicationRunner(basic_city, common_random_numbers=True).finish()
+        ReplicationRunner(Scenario('a').build(basic_city), common_random_numbers=True).finish()
+        assert not loaded
+        assert '_dest_dict' not in lazy_station.__dict__
+        demand = lazy_station.decide_journey_demand(interval=0, elapsing=10)
+        assert len(demand) > 0
+        assert loaded == [2, 2]
+        # compiled on loading, so the sampler is used rather than the _dest_dict fallback
+        assert 0 in lazy_station._dest_samplers
+        lazy_station.decide_journey_demand(interval=0, elapsing=10)
+        assert loaded == [2, 2]
+        with pytest.raises(AttributeError):
+            lazy_station._not_a_parameter
+        other = Station(16, 8, st_id=3)
+        other.load_lazily(durations=load({0: (1, 1)}))
+        other.load_parameters()
+        assert other._duration_dict == {0: (1, 1)}
+        assert other._dest_dict == {}
+
     def test_distance_from(self, basic_city):
         # TODO
         pass
@@ -235,6 +527,7 @@ class TestLondonCreator:
         i = prepop_londoncreator.london.get_station(98)._dest_dict[240]
         # at 8am, there were 192 journeys from station 98 to 393 in the standard 2015 period
         assert i['volumes'][i['destinations'].index(393)] == 945
+        assert 240 in prepop_londoncreator.london.get_station(98)._dest_samplers
 
     def test_elapse_time(self, prepop_londoncreator):
         seed(16)
@@ -254,17 +547,18 @@ class TestLondonCreator:
         assert log['totals']['finished_journeys'] == sum(log['time_series']['finished_journeys'])
         assert log['totals']['failed_starts'] == sum(log['time_series']['failed_starts'])
         assert log['totals']['failed_ends'] == sum(log['time_series']['failed_ends'])
-        assert len([e for e in log['events']['event'] if e == 'finished_journeys']) == log['totals']['finished_journeys']
-        assert len([e for e in log['events']['event'] if e == 'failed_starts']) == log['totals'][
+        events = log['events'].event_keys()
+        assert len([e for e in events if e == 'finished_journeys']) == log['totals']['finished_journeys']
+        assert len([e for e in events if e == 'failed_starts']) == log['totals'][
             'failed_starts']
-        assert len([e for e in log['events']['event'] if e == 'failed_ends']) == log['totals'][
+        assert len([e for e in events if e == 'failed_ends']) == log['totals'][
             'failed_ends']
 
         df = prepop_londoncreator.london.get_timeseries_df()
         assert df.shape == (1440, 4)
         assert sum(df['finished_journeys']) == log['totals']['finished_journeys']
         df2 = prepop_londoncreator.london.get_events_df()
-        assert len(df2) == len(log['events']['event'])
+        assert len(df2) == len(log['events'])
 
     def test_next_desination(self, prepop_londoncreator):
         london = prepop_londoncreator.london
@@ -275,7 +569,7 @@ class TestLondonCreator:
         original_dest = london.get_station(98)
         original_dest._docked = original_dest._capacity
         london.main_elapse_time(1)
-        new_dest = london._agents[0]._current_destination
+        new_dest = london.agent(0)._current_destination
         assert new_dest != original_dest
         for st in london._stations.values():
             if st != original_dest and st != new_dest:
@@ -293,7 +587,7 @@ class TestLondonCreator:
             ,duration=1)
         london.get_station(98)._docked = london.get_station(98)._capacity
         london.main_elapse_time(1)
-        new_dest = london._agents[0]._current_destination
+        new_dest = london.agent(0)._current_destination
         assert new_dest != st_14
 
     def test_next_destination_w_nan(self, prepop_londoncreator):
@@ -308,7 +602,7 @@ class TestLondonCreator:
             ,duration=1)
         london.get_station(98)._docked = london.get_station(98)._capacity
         london.main_elapse_time(1)
-        new_dest = london._agents[0]._current_destination
+        new_dest = london.agent(0)._current_destination
         assert new_dest != st_14
 
     def test_parameter_json(self, prepop_londoncreator):
@@ -318,21 +612,224 @@ class TestLondonCreator:
         prepop_londoncreator.min_year = 2016
         assert not prepop_londoncreator.parameter_json_is_compatible(f_location)
         with pytest.raises(IncompatibleParamsError):
-            prepop_londoncreator.load_pickled_city(test_london_location)
+            prepop_londoncreator.load_city(test_london_location)
         with pytest.raises(IncompatibleParamsError):
             prepop_londoncreator.get_or_create_london(test_london_location)
 
+    def test_save_city(self, prepop_londoncreator, tmp_path):
+        london = prepop_londoncreator.london
+        prepop_londoncreator.save_city(tmp_path)
+        assert prepop_londoncreator.parameter_json_is_compatible(tmp_path / 'last_used_params.json')
+        prepop_londoncreator.load_city(tmp_path)
+        loaded = prepop_londoncreator.london
+        assert loaded is not london
+        assert list(loaded._stations) == list(london._stations)
+        for st_id, station in london._stations.items():
+            assert loaded.get_station(st_id)._demand_dict == station._demand_dict
+            assert loaded.get_station(st_id)._dest_dict == station._dest_dict
+            assert loaded.get_station(st_id)._duration_dict == station._duration_dict
+        assert loaded.get_station(6)._common_name == london.get_station(6)._common_name
+        bundle = prepop_londoncreator.load_city_bundle(tmp_path)
+        assert bundle.station_ids == list(london._stations)
+
+    def test_lazy_population(self, prepop_londoncreator):
+        eager = prepop_londoncreator.london
+        lc = LondonCreator(additional_sql_filters=test_london_filters)
+        lc.populate_tfl_stations()
+        for i in list(lc.london._stations.keys()):
+            if i not in eager._stations:
+                lc.london.remove_station(i)
+        lc.populate_station_demand_dicts(test_demand_cache)
+        lc.populate_station_destination_dicts(lazy=True)
+        lc.populate_station_duration_params(test_duration_cache, lazy=True)
+        assert '_duration_dict' not in lc.london.get_station(393).__dict__
+        assert lc.london.get_station(393)._duration_dict == eager.get_station(393)._duration_dict
+        assert '_dest_dict' not in lc.london.get_station(98).__dict__
+        lc.prefetch()
+        for st_id, station in eager._stations.items():
+            assert lc.london.get_station(st_id)._dest_dict == station._dest_dict
+            assert lc.london.get_station(st_id)._duration_dict == station._duration_dict
+
+    def test_parallel_duration_fitting(self, prepop_londoncreator, tmp_path):
+        lc = LondonCreator(additional_sql_filters=test_london_filters)
+        lc.london = prepop_londoncreator.london
+        cache_loc = tmp_path / 'duration_params.sqlite'
+        lc.fit_missing_duration_params(cache_loc, workers=2)
+        for st_id, station in lc.london._stations.items():
+            assert lc.get_params_from_cache(st_id, cache_loc) == station._duration_dict
+        # an interrupted build only re-fits what is missing
+        with lc.duration_cache(cache_loc).connection as connection:
+            connection.execute("DELETE FROM stations WHERE start_id = 393")
+        lc.cache_station_params(14, {}, cache_loc)
+        lc.fit_missing_duration_params(cache_loc, workers=2)
+        assert lc.get_params_from_cache(393, cache_loc) == lc.london.get_station(393)._duration_dict
+        assert lc.get_params_from_cache(14, cache_loc) == {}
+
+    def test_streamed_duration_fitting(self, tmp_path, monkeypatch):
+        database = tmp_path / 'bike_db.db'
+        monkeypatch.setattr(sim_managment, 'DATABASE', database)
+        rand = Random(3)
+        with closing(sqlite3.connect(database)) as db:
+            db.execute("""CREATE TABLE journeys ("StartStation Id" INTEGER, "EndStation Id" INTEGER, Duration REAL,
+                          "Start Date" DATETIME, year INTEGER, weekday_ind INTEGER)""")
+            journeys = []
+            for _ in range(2000):
+                start = datetime(2019, 6, 1) + timedelta(days=rand.randrange(600))
+                journeys.append((rand.choice([-1, 1, 6, 14]), rand.choice([None, -1, 1, 6, 14]),
+                                 300 + rand.expovariate(1 / 300) if rand.random() > 0.01 else None, str(start),
+                                 start.year, int(start.weekday() <= 4)))
+            db.executemany("INSERT INTO journeys VALUES (?, ?, ?, ?, ?, ?)", journeys)
+            db.commit()
+        lc = LondonCreator()
+        for st_id in (1, 6, 14):
+            lc.london.add_station(Station(10, 5, st_id=st_id))
+        # chunks far smaller than a station's journeys give the same groups
+        streamed = list(lc.stream_journey_durations(chunk_size=50))
+        assert [start_id for start_id, *_ in streamed] == [1, 6, 14]
+        for (start_id, end_ids, offsets, durations), (_, *whole) in zip(streamed, lc.stream_journey_durations()):
+            assert (end_ids == whole[0]).all() and (offsets == whole[1]).all() and (durations == whole[2]).all()
+        # and the same parameters as fitting each station from its own query
+        lc.fit_missing_duration_params(tmp_path / 'streamed.sqlite', workers=1, streaming=True)
+        lc.fit_missing_duration_params(tmp_path / 'queried.sqlite', workers=1)
+        for st_id in lc.london._stations:
+            streamed = lc.get_params_from_cache(st_id, tmp_path / 'streamed.sqlite')
+            queried = lc.get_params_from_cache(st_id, tmp_path / 'queried.sqlite')
+            assert streamed.keys() == queried.keys() == {1, 6, 14}
+            for end_id, params in streamed.items():
+                assert all(isclose(a, b, rel_tol=1e-6) for a, b in zip(params, queried[end_id]))
+
+    def test_vectorised_duration_fitting(self, prepop_londoncreator, tmp_path):
+        lc = LondonCreator(additional_sql_filters=test_london_filters)
+        lc.london = prepop_londoncreator.london
+        lc.fit_missing_duration_params(tmp_path / 'duration_params.sqlite', workers=1, fit_method='vectorised')
+        for st_id, station in lc.london._stations.items():
+            cached = lc.get_params_from_cache(st_id, tmp_path / 'duration_params.sqlite')
+            assert cached.keys() == station._duration_dict.keys()
+            for end_id, params in cached.items():
+                assert all(isclose(a, b, rel_tol=1e-3) for a, b in zip(params, station._duration_dict[end_id]))
+        report = lc.duration_fit_report(sample_size=10)
+        assert len(report) == 10
+        assert report['start_id'].isin(lc.london._stations).all()
+        with pytest.raises(ValueError):
+            lc.fit_missing_duration_params(tmp_path / 'duration_params.sqlite', fit_method='moments')
+
+    def test_fit_duration_groups(self):
+        durations = array([5., 6, 7, 9, 20, 21, 25, 22])
+        d = fit_duration_groups(array([3, 8]), array([0, 4, 8]), durations)
+        assert list(d) == [3, 8]
+        assert d[3] == gumbel_r.fit(durations[:4])
+        assert d[8] == gumbel_r.fit(durations[4:])
+
     def test_duration_cache(self, prepop_londoncreator):
-        path = Path('tfl_project/simulation/tests/files/caches/duration_params')
-        assert (path / '393.json').exists()
-        assert prepop_londoncreator.parameter_json_is_compatible(path / 'last_used_params.json')
-        prepop_londoncreator.min_year = 2016
-        with pytest.raises(NotImplementedError):
-            prepop_londoncreator.populate_station_duration_params(path)
+        path = test_duration_cache
+        assert path.exists()
+        assert 393 in prepop_londoncreator.duration_cache(path).cached_ids()
+        assert prepop_londoncreator.parameters_are_compatible(prepop_londoncreator.duration_cache(path).header())
+        # parameters the durations don't depend on share the cache; others get their own entries in it
+        lc = LondonCreator(additional_sql_filters=test_london_filters, warehoused_stations={14: 'WATERLOO'})
+        assert lc.duration_cache(path) is prepop_londoncreator.duration_cache(path)
+        lc.min_year = 2016
+        assert not lc.duration_cache(path).cached_ids()
         d = prepop_londoncreator.london.get_station(393)._duration_dict
         assert 14 in d
         assert d[14] == (9.229804969550127, 1.6579796941089833)
 
+    def test_parameter_key(self):
+        lc = LondonCreator(warehoused_stations={14: 'WATERLOO'})
+        warehoused = LondonCreator(warehoused_stations={14: 'KINGSX'})
+        assert lc.parameter_key('durations') == LondonCreator().parameter_key('durations')
+        assert lc.parameter_key('demand') == warehoused.parameter_key('demand')
+        assert lc.parameter_key('city') != warehoused.parameter_key('city')
+        assert lc.parameter_key('city') == LondonCreator(warehoused_stations={14: 'WATERLOO'}).parameter_key('city')
+        # keys survive the parameters going through json, which turns station ids into strings
+        assert parameter_key(json.loads(json.dumps(lc.artifact_parameters('city')))) == lc.parameter_key('city')
+        assert LondonCreator(minute_interval=30).parameter_key('durations') == lc.parameter_key('durations')
+        assert LondonCreator(minute_interval=30).parameter_key('destinations') != lc.parameter_key('destinations')
+        assert LondonCreator(exclude_covid=False).parameter_key('durations') != lc.parameter_key('durations')
+        assert lc.city_location().name == 'city_' + lc.parameter_key('city')
+
+    def test_cached_rows(self, tmp_path, monkeypatch):
+        database = tmp_path / 'bike_db.db'
+        database.write_bytes(b'journeys')
+        monkeypatch.setattr(sim_managment, 'DATABASE', database)
+        cache_loc = tmp_path / 'demand'
+        lc = LondonCreator()
+        lc.select_query_db = lambda query: [(1, 0, 0.5), (6, 20, 1.25)]
+        dtype = [('st_id', 'i8'), ('interval', 'i8'), ('rate', 'f8')]
+        assert lc.cached_rows('demand', cache_loc, dtype, lambda: 'SELECT') == [(1, 0, 0.5), (6, 20, 1.25)]
+        assert len(list(cache_loc.glob('*.npy'))) == 1
+        lc.select_query_db = None
+        rows = lc.cached_rows('demand', cache_loc, dtype, lambda: 'SELECT')
+        assert rows == [(1, 0, 0.5), (6, 20, 1.25)]
+        assert isinstance(rows[0][0], int)
+        # a refreshed database isn't served the rows cached from the old one
+        database.write_bytes(b'more journeys')
+        lc.select_query_db = lambda query: [(1, 0, 0.75)]
+        assert lc.cached_rows('demand', cache_loc, dtype, lambda: 'SELECT') == [(1, 0, 0.75)]
+        assert len(list(cache_loc.glob('*.npy'))) == 2
+
+    def test_legacy_city_location(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(sim_managment, 'CITY_STORE', tmp_path)
+        monkeypatch.setattr(sim_managment, 'LEGACY_CITY_LOCATION', tmp_path / 'london')
+        saver = LondonCreator()
+        saver.london = synthetic_city(n_stations=5, destinations_per_station=2)
+        saver.save_city(tmp_path / 'london')
+        lc = LondonCreator()
+        assert lc.legacy_city_is_compatible()
+        lc.select_query_db = None  # the saved city is used rather than created
+        assert list(lc.get_or_create_london()._stations) == list(saver.london._stations)
+        assert not lc.city_location().exists()
+        # a json which doesn't record the warehouses could be of a city without them
+        with open(tmp_path / 'london' / 'last_used_params.json') as f:
+            d = json.load(f)
+        del d['warehoused_stations']
+        with open(tmp_path / 'london' / 'last_used_params.json', 'w') as f:
+            json.dump(d, f)
+        assert not LondonCreator(warehoused_stations={14: 'KINGSX'}).legacy_city_is_compatible()
+
+    def test_journey_aggregates(self, tmp_path):
+        db_path = tmp_path / 'bike_db.db'
+        rand = Random(7)
+        with closing(sqlite3.connect(db_path)) as db:
+            db.execute("""CREATE TABLE journeys ("StartStation Id" INTEGER, "EndStation Id" INTEGER,
+                          "Start Date" DATETIME, year INTEGER, minute_of_day INTEGER, weekday_ind INTEGER)""")
+            journeys = []
+            for _ in range(3000):
+                start = datetime(2019, 6, 1) + timedelta(days=rand.randrange(600), minutes=rand.randrange(1440))
+                journeys.append((rand.choice([-1, 1, 6, 14]), rand.choice([None, -1, 1, 6, 14]), str(start),
+                                 start.year, start.hour * 60 + start.minute, int(start.weekday() <= 4)))
+            db.executemany("INSERT INTO journeys VALUES (?, ?, ?, ?, ?, ?)", journeys)
+            db.commit()
+
+        def query_db(query):
+            with closing(sqlite3.connect(db_path)) as db:
+                return sorted(db.execute(query).fetchall())
+
+        creators = [LondonCreator(), LondonCreator(min_year=2020, minute_interval=30, exclude_covid=False),
+                    LondonCreator(minute_interval=60)]
+        for lc in creators:
+            lc.select_query_db = query_db
+        journey_rows = [(query_db(lc._demand_query()), query_db(lc._destination_query()),
+                         query_db(lc._destination_query(6))) for lc in creators]
+        assert all(all(rows) for rows in journey_rows)
+        journey_aggregates_to_sql.main(db_path)
+        # a creator only checks for the tables once
+        assert all(lc._aggregate_filter() is None for lc in creators)
+        for lc in creators:
+            lc._aggregates_exist = None
+        for lc, rows in zip(creators, journey_rows):
+            assert lc._aggregate_filter() is not None
+            lc.select_query_db = None
+            assert lc._aggregate_filter() is not None
+            lc.select_query_db = query_db
+            assert query_db(lc._demand_query()) == rows[0]
+            assert query_db(lc._destination_query()) == rows[1]
+            assert query_db(lc._destination_query(6)) == rows[2]
+        # parameters the tables can't serve use the journeys table
+        for lc in (LondonCreator(minute_interval=7), LondonCreator(additional_sql_filters='AND month = 1')):
+            lc.select_query_db = query_db
+            assert lc._aggregate_filter() is None
+
     def test_warehouse_lc_creation(self):
 
         whpl = [
@@ -357,6 +854,70 @@ class TestLondonCreator:
 
 
 
+class TestGumbelFit:
+    def test_fit_gumbel_groups(self):
+        rng = default_rng(4)
+        groups = [rng.gumbel(loc, scale, n) for loc, scale, n in ((8, 2, 50), (30, 5, 400), (3, 0.5, 10))]
+        offsets = array([0, 50, 450, 460])
+        locs, scales = fit_gumbel_groups(concatenate(groups), offsets)
+        for x, loc, scale in zip(groups, locs, scales):
+            scipy_loc, scipy_scale = gumbel_r.fit(x)
+            assert isclose(loc, scipy_loc, rel_tol=1e-3)
+            assert isclose(scale, scipy_scale, rel_tol=1e-3)
+            # the exact maximum is at least as likely as scipy's
+            assert gumbel_r.logpdf(x, loc, scale).sum() >= gumbel_r.logpdf(x, scipy_loc, scipy_scale).sum() - 1e-6
+
+    def test_accuracy_report(self, monkeypatch):
+        rng = default_rng(5)
+        durations = rint(concatenate([rng.gumbel(10, 2, 100) for _ in range(20)]))
+        report = accuracy_report(durations, arange(0, 2001, 100), sample_size=5)
+        assert len(report) == 5
+        assert (report['n'] == 100).all()
+        assert report['loc_diff'].max() < 1e-3
+        assert report['loglik_gain'].min() > -1e-6
+        # loc_diff doesn't divide by a loc of 0
+        monkeypatch.setattr(gumbel_r, 'fit', lambda x: (0., 2.))
+        report = accuracy_report(rng.gumbel(0.5, 2, 100), array([0, 100]))
+        assert isfinite(report['loc_diff']).all()
+
+
+class TestDurationCache:
+    def test_put_get(self, tmp_path):
+        cache = DurationCache(tmp_path / 'cache' / 'duration_params.sqlite', 'a')
+        assert cache.header() is None
+        assert cache.write_header({'min_year': 2015}) == {'min_year': 2015}
+        assert cache.write_header({'min_year': 2016}) == {'min_year': 2015}
+        with pytest.raises(KeyError):
+            cache.get(1)
+        cache.put(1, {98: (9.5, 1.5), 6: (3.0, 0.5)})
+        cache.put(14, {})
+        assert list(cache.get(1).items()) == [(98, (9.5, 1.5)), (6, (3.0, 0.5))]
+        assert cache.get(14) == {}
+        cache.put(1, {6: (4.0, 0.5)})
+        assert cache.load_all() == {1: {6: (4.0, 0.5)}, 14: {}}
+        assert cache.cached_ids() == {1, 14}
+        copied = pickle.loads(pickle.dumps(cache))
+        assert copied.get(1) == {6: (4.0, 0.5)}
+
+    def test_parameter_sets(self, tmp_path):
+        cache_loc = tmp_path / 'duration_params.sqlite'
+        first, second = open_cache(cache_loc, 'a'), open_cache(cache_loc, 'b')
+        first.put(1, {6: (3.0, 0.5)})
+        assert second.cached_ids() == set()
+        assert open_cache(cache_loc, 'a') is first
+
+    def test_import_json_directory(self, tmp_path):
+        lc = LondonCreator(warehoused_stations={14: 'WATERLOO'})
+        (tmp_path / 'last_used_params.json').write_text(json.dumps(LondonCreator().parameter_dict()))
+        (tmp_path / '393.json').write_text(json.dumps({'14': [9.2, 1.6]}))
+        cache = lc.duration_cache(tmp_path / 'duration_params.sqlite')
+        assert cache.header() == lc.artifact_parameters('durations')
+        assert cache.get(393) == {14: (9.2, 1.6)}
+        # a cache of other parameters isn't imported
+        lc.min_year = 2016
+        assert not lc.duration_cache(tmp_path / 'duration_params.sqlite').cached_ids()
+
+
 class TestSimulationManager:
     def test_simulations(self, prepop_londoncreator):
         sm = SimulationManager(
@@ -370,6 +931,170 @@ class TestSimulationManager:
         assert 1 in sm.combined_timeseries_df['sim_num']
         assert len(sm.combined_event_df) > 0
 
+    def test_array_engine(self, prepop_londoncreator):
+        sm = SimulationManager(
+            city=prepop_londoncreator.london
+            , n_simulations=2
+            , simulation_id='TESTSIM'
+            , engine='array'
+        )
+        sm.run_simulations()
+        assert len(sm.combined_timeseries_df) == 2880
+        assert list(sm.combined_event_df['sim_num'].unique()) == [0, 1]
+        with pytest.raises(ValueError):
+            SimulationManager(city=prepop_londoncreator.london, n_simulations=2, simulation_id='TESTSIM', engine='x')
+
+    def test_parallel_simulations(self, basic_city):
+        def run(workers, engine):
+            sm = SimulationManager(city=basic_city, n_simulations=3, simulation_id='TESTSIM', engine=engine,
+                                   workers=workers, seed=16)
+            sm.run_simulations()
+            return sm
+        station_rng, station_rng_state = Station.rng, Station.rng.bit_generator.state
+        results = dict()
+        for engine in ('object', 'array'):
+            sequential = results[engine] = run(1, engine)
+            parallel = run(2, engine)
+            # results are merged in sim_num order and don't depend on the number of workers
+            assert list(parallel.combined_event_df['sim_num'].unique()) == [0, 1, 2]
+            assert parallel.combined_event_df.equals(sequential.combined_event_df)
+            assert parallel.combined_timeseries_df.equals(sequential.combined_timeseries_df)
+        # other cities' stations are left drawing from the Generator they had, where they left it
+        assert Station.rng is station_rng
+        assert Station.rng.bit_generator.state == station_rng_state
+        # so draws elsewhere in the process don't change the results
+        Station.rng.random(10)
+        assert run(1, 'object').combined_event_df.equals(results['object'].combined_event_df)
+        # replications have independent streams
+        events = sequential.combined_event_df
+        assert not events.loc[events['sim_num'] == 0, 'time'].reset_index(drop=True).equals(
+            events.loc[events['sim_num'] == 1, 'time'].reset_index(drop=True))
+
+    def test_failed_simulation(self, basic_city, monkeypatch):
+        basic_city.get_station(1)._docked = 3
+        basic_city.save_initial_state()
+        basic_city.get_station(1)._docked = 5
+        station_rng = Station.rng
+        closed = []
+
+        def fail(*args):
+            raise RuntimeError('failed to store simulation')
+        monkeypatch.setattr(SimulationManager, 'store_simulation', fail)
+        monkeypatch.setattr(ScenarioSweep, 'store_simulation', fail)
+        sm = SimulationManager(city=basic_city, n_simulations=2, simulation_id='TESTSIM', seed=16)
+        monkeypatch.setattr(sm.writer, 'close', lambda: closed.append(sm))
+        with pytest.raises(RuntimeError):
+            sm.run_simulations()
+        # the base city, the Station Generator and the writer are left as they would be after a successful run
+        assert closed == [sm]
+        assert basic_city.get_station(1)._docked == 5
+        assert basic_city._time == 0
+        assert len(basic_city._agents) == 0
+        assert Station.rng is station_rng
+        basic_city.reset()
+        assert basic_city.get_station(1)._docked == 3
+        sweep = ScenarioSweep(basic_city, [Scenario('a'), Scenario('b')], n_simulations=2, sweep_id='TESTSIM',
+                              seed=16, output='memory', common_random_numbers=False)
+        monkeypatch.setattr(sweep.writer, 'close', lambda: closed.append(sweep))
+        with pytest.raises(RuntimeError):
+            sweep.run()
+        assert closed == [sm, sweep]
+        assert Station.rng is station_rng
+
+    def test_common_random_numbers(self, basic_city):
+        small_city = City()
+        for st_id in (0, 1):
+            small_city.add_station(Station(
+                3, 1, st_id=st_id, demand_dict={0: 5}, dest_dict={0: {'destinations': [0, 1], 'volumes': [3, 7]}}
+                , duration_dict={0: (6.12, 2.05), 1: (5.11, 1.85)}
+            ))
+
+        def run(city, engine, crn=True):
+            sm = SimulationManager(city=city, n_simulations=3, simulation_id='TESTSIM', engine=engine, seed=16,
+                                   common_random_numbers=crn)
+            sm.run_simulations()
+            return sm
+
+        for engine in ('object', 'array'):
+            base, small = run(basic_city, engine), run(small_city, engine)
+            base_totals, small_totals = base.replication_totals(), small.replication_totals()
+            # every journey demanded either fails to start or finishes, so paired replications see the same demand
+            assert (small_totals['failed_starts'] > 0).all()
+            assert ((base_totals['failed_starts'] + base_totals['finished_journeys'])
+                    == (small_totals['failed_starts'] + small_totals['finished_journeys'])).all()
+            summary = paired_differences(base, small)
+            assert list(summary.index) == ['failed_starts', 'failed_ends', 'finished_journeys']
+            assert summary.loc['failed_starts', 'mean_difference'] > 0
+            assert (summary['n'] == 3).all()
+        # stations' own streams are removed again afterwards
+        assert 'rng' not in basic_city.stations[0].__dict__
+        with pytest.raises(IncompatibleParamsError):
+            paired_differences(base, SimulationManager(city=basic_city, n_simulations=3, simulation_id='TESTSIM'))
+
+    def test_adaptive_stopping(self, basic_city):
+        def run(target, workers=1):
+            sm = SimulationManager(city=basic_city, n_simulations=8, simulation_id='TESTSIM', seed=16, workers=workers,
+                                   target_half_width=target, min_simulations=3)
+            sm.run_simulations()
+            return sm
+        # a loose target is met as soon as there are enough simulations to judge, a tight one never is
+        assert len(run({'failed_starts': 1e6}).replication_totals()) == 3
+        assert len(run({'finished_journeys': 0}).replication_totals()) == 8
+        assert len(run({'failed_starts': 1e6}, workers=2).replication_totals()) == 4
+        sm = run(None)
+        assert len(sm.replication_totals()) == 8
+        assert not sm.precise_enough()
+        with pytest.raises(ValueError):
+            SimulationManager(city=basic_city, n_simulations=8, simulation_id='TESTSIM', target_half_width={'x': 1})
+
+    def test_checkpoint_fork(self, basic_city):
+        Station.rng = default_rng(16)
+        for i in range(10):
+            basic_city.main_elapse_time(1)
+        checkpoint = basic_city.checkpoint()
+        sm = SimulationManager(city=basic_city, n_simulations=2, simulation_id='TESTSIM', seed=16,
+                               checkpoint=checkpoint)
+        sm.run_simulations()
+        events, timeseries = sm.combined_event_df, sm.combined_timeseries_df
+        assert len(timeseries) == 2880
+        # both simulations share the history before the checkpoint, and diverge after it
+        before = [events[(events['sim_num'] == i) & (events['time'] < 10)].drop(columns='sim_num')
+                  .reset_index(drop=True) for i in (0, 1)]
+        assert len(before[0]) > 0
+        assert before[0].equals(before[1])
+        after = [events.loc[(events['sim_num'] == i) & (events['time'] >= 10), 'time'].reset_index(drop=True)
+                 for i in (0, 1)]
+        assert not after[0].equals(after[1])
+        # the base city is left at the checkpoint
+        assert basic_city._time == 10
+
+    def test_streamed_output(self, basic_city):
+        from pandas import read_csv
+        sm = SimulationManager(city=basic_city, n_simulations=2, simulation_id='TESTSIM', output='csv')
+        sm.run_simulations()
+        assert sm.combined_timeseries_df is None
+        test_dir = Path('tfl_project/data/simulation_outputs/TESTSIM')
+        timeseries = read_csv(test_dir / 'time_series.csv')
+        events = read_csv(test_dir / 'events.csv')
+        assert len(timeseries) == 2880
+        assert list(timeseries['sim_num'].unique()) == [0, 1]
+        assert set(events['event']) <= {'failed_starts', 'failed_ends', 'finished_journeys'}
+        for f in test_dir.iterdir():
+            os.remove(f)
+        os.rmdir(test_dir)
+
+    def test_parquet_output(self, basic_city):
+        pytest.importorskip('pyarrow')
+        from pandas import read_parquet
+        sm = SimulationManager(city=basic_city, n_simulations=2, simulation_id='TESTSIM', output='parquet')
+        sm.run_simulations()
+        test_dir = Path('tfl_project/data/simulation_outputs/TESTSIM')
+        assert len(read_parquet(test_dir / 'time_series.parquet')) == 2880
+        assert list(read_parquet(test_dir / 'events.parquet')['sim_num'].unique()) == [0, 1]
+        for f in test_dir.iterdir():
+            os.remove(f)
+        os.rmdir(test_dir)
+
     def test_output_to_csv(self, prepop_londoncreator):
         sm = SimulationManager(
             city=prepop_londoncreator.london
@@ -387,6 +1112,202 @@ class TestSimulationManager:
         os.rmdir(test_dir)
 
 
+class TestArrayCity:
+    def test_journey(self, basic_city):
+        ac = ArrayCity(basic_city)
+        ac.generate_journey(
+            start_st=basic_city.get_station(0)
+            , dest_st=basic_city.get_station(1)
+            , duration=3)
+        assert ac.n_agents == 1
+        assert ac.docked(0) == 7
+        ac.move_agents(1)
+        assert ac.docked(1) == 8
+        ac.move_agents(2)
+        assert ac.n_agents == 0
+        assert ac.docked(1) == 9
+        assert ac._event_log['totals']['finished_journeys'] == 1
+        # the base city is untouched
+        assert basic_city.get_station(0)._docked == 8
+
+    def test_two_at_full_and_reroute(self, basic_city):
+        basic_city.get_station(1)._docked = 15
+        ac = ArrayCity(basic_city)
+        for i in range(2):
+            ac.generate_journey(
+                start_st=basic_city.get_station(0)
+                , dest_st=basic_city.get_station(1)
+                , duration=1)
+        ac.move_agents(1)
+        assert ac.docked(1) == 16
+        assert ac.n_agents == 1
+        assert ac._event_log['totals']['finished_journeys'] == 1
+        assert ac._event_log['totals']['failed_ends'] == 1
+        ac.call_for_new_destinations()
+        # the first rider docked, so the rerouted rider is in the second slot
+        assert ac._agents.dest[1] == 0
+        assert ac._agents.last[1] == 1
+        assert ac._agents.due[1] > ac._travel_clock
+
+    def test_failed_start(self, basic_city):
+        basic_city.get_station(0)._docked = 0
+        ac = ArrayCity(basic_city)
+        ac.generate_journey(
+            start_st=basic_city.get_station(0)
+            , dest_st=basic_city.get_station(1)
+            , duration=3)
+        assert ac.n_agents == 0
+        assert ac._event_log['totals']['failed_starts'] == 1
+
+    def test_warehoused_stations(self, floating_warehouse_setup):
+        warehouse, s1, s2 = floating_warehouse_setup
+        c = City()
+        c.add_warehouse(warehouse)
+        c.add_station(s1)
+        c.add_station(s2)
+        ac = ArrayCity(c)
+        for i in range(5):
+            ac.generate_journey(start_st=s1, dest_st=s2, duration=1)
+        # s1 started with 2 bikes and drew the warehouse's 2 bikes before running out
+        assert ac._event_log['totals']['failed_starts'] == 1
+        assert ac.docked(1) == 0
+        assert ac._wh_docked[0] == 0
+        ac.move_agents(1)
+        # s2 started with 4 of 5 docks full and passed bikes to the now-empty warehouse
+        assert ac._event_log['totals']['finished_journeys'] == 4
+        assert ac.docked(2) == 4
+        assert ac._wh_docked[0] == 4
+
+    def test_main_elapse_time_and_reset(self, basic_city):
+        ac = ArrayCity(basic_city, seed=16)
+        for i in range(120):
+            ac.main_elapse_time(1)
+        assert ac._time == 120
+        assert ac._event_log['totals']['finished_journeys'] > 0
+        # bikes are neither created nor destroyed
+        assert sum(ac._docked) + ac.n_agents == 16
+        ts = ac.get_timeseries_df()
+        events = ac.get_events_df()
+        assert list(ts.columns) == list(basic_city.get_timeseries_df().columns)
+        assert list(events.columns) == list(basic_city.get_events_df().columns)
+        assert len(ts) == 120
+        assert len(events) == sum(ac._event_log['totals'].values())
+        assert sum(ts['finished_journeys']) == sum(events['event'] == 'finished_journeys')
+        ac.reset()
+        assert ac._time == 0
+        assert ac.n_agents == 0
+        assert ac.docked(0) == 8
+        assert len(ac.get_events_df()) == 0
+
+
+class TestParameterBundle:
+    def test_round_trip(self, tmp_path):
+        city = synthetic_city(n_stations=20, destinations_per_station=5, warehouse_share=0.5, stations_per_warehouse=5)
+        bundle = ParameterBundle.from_city(city)
+        bundle.save(tmp_path)
+        loaded = ParameterBundle.load(tmp_path)
+        assert loaded.station_ids == bundle.station_ids
+        assert loaded.warehouse_ids == bundle.warehouse_ids
+        assert loaded.intervals == bundle.intervals
+        for name, values in bundle.arrays.items():
+            assert (loaded.arrays[name] == values).all()
+            assert not loaded.arrays[name].flags.writeable
+        # pickling a memory-mapped bundle sends its location rather than its arrays
+        assert len(pickle.dumps(loaded)) < 1000
+        assert (pickle.loads(pickle.dumps(loaded)).dest_cum == bundle.dest_cum).all()
+
+    def test_to_city(self, tmp_path):
+        city = synthetic_city(n_stations=20, destinations_per_station=5, warehouse_share=0.5, stations_per_warehouse=5)
+        city.get_station(3)._common_name = 'Three'
+        # entries the arrays can't hold, in intervals without demand
+        station = city.get_station(4)
+        for interval in (1380, 1400, 1420):
+            station._demand_dict[interval] = 0
+        station._dest_dict[1380] = {'destinations': [], 'volumes': []}
+        station._dest_dict[1400] = {'destinations': [1, 999], 'volumes': [2, 3]}
+        station._dest_dict[1420] = {'destinations': [1, 2], 'volumes': [0, 0]}
+        station._duration_dict[999] = (5.5, 1.5)
+        city.compile_samplers()
+        ParameterBundle.from_city(city).save(tmp_path)
+        rebuilt = ParameterBundle.load(tmp_path).to_city()
+        assert list(rebuilt.stations) == list(city.stations)
+        assert list(rebuilt.warehouses) == list(city.warehouses)
+        for st_id, station in city.stations.items():
+            copy = rebuilt.get_station(st_id)
+            assert type(copy) is type(station)
+            assert copy._docked == station._docked
+            assert copy._demand_dict == station._demand_dict
+            assert copy._dest_dict == station._dest_dict
+            assert copy._duration_dict == station._duration_dict
+            if isinstance(station, WarehousedStation):
+                assert copy._warehouse is rebuilt.get_warehouse(station._warehouse.get_id())
+        assert rebuilt.get_station(3)._common_name == 'Three'
+        # both simulate alike
+        for c in (city, rebuilt):
+            Station.rng = default_rng(2)
+            seed(2)
+            for i in range(120):
+                c.main_elapse_time(1)
+        assert city.get_events_df().equals(rebuilt.get_events_df())
+
+    def test_version(self, tmp_path):
+        ParameterBundle.from_city(synthetic_city(n_stations=5, destinations_per_station=2)).save(tmp_path)
+        meta = json.loads((tmp_path / 'bundle.json').read_text())
+        meta['version'] = 0
+        (tmp_path / 'bundle.json').write_text(json.dumps(meta))
+        with pytest.raises(IncompatibleBundleError):
+            ParameterBundle.load(tmp_path)
+
+    def test_array_city_from_bundle(self, tmp_path):
+        city = synthetic_city(n_stations=20, destinations_per_station=5, warehouse_share=0.5, stations_per_warehouse=5)
+        ParameterBundle.from_city(city).save(tmp_path)
+        from_city, from_bundle = ArrayCity(city, seed=3), ArrayCity(ParameterBundle.load(tmp_path), seed=3)
+        for ac in (from_city, from_bundle):
+            for i in range(300):
+                ac.main_elapse_time(1)
+        assert from_city.get_events_df().equals(from_bundle.get_events_df())
+        assert from_bundle.docked(5) == from_city.docked(5)
+        from_bundle.reset()
+        assert from_bundle.docked(5) == city.get_station(5)._docked
+
+    def test_with_state(self, tmp_path):
+        city = synthetic_city(n_stations=20, destinations_per_station=5)
+        ParameterBundle.from_city(city).save(tmp_path)
+        base = ParameterBundle.load(tmp_path)
+
+        def empty_station_3(c):
+            c.get_station(3)._docked = 0
+        scenario = Scenario('WH', [{'capacity': 30, 'docked_init': 10, 'st_id': 'WH'}], {5: 'WH', 6: 'WH'},
+                            empty_station_3).build(city)
+        bundle = base.with_state(base.city_state(scenario))
+        # parameters are shared, and pickling sends only the location and the state
+        assert bundle.demand is base.demand
+        assert len(pickle.dumps(bundle)) < 2000
+        bundle = pickle.loads(pickle.dumps(bundle))
+        assert bundle.warehouse_ids == ['WH'] and bundle.docked_init[3] == 0
+        from_state, from_scenario = ArrayCity(bundle, seed=3), ArrayCity(scenario, seed=3)
+        for ac in (from_state, from_scenario):
+            for i in range(300):
+                ac.main_elapse_time(1)
+        assert from_state.get_events_df().equals(from_scenario.get_events_df())
+        with pytest.raises(ValueError):
+            base.city_state(synthetic_city(n_stations=10, destinations_per_station=5))
+
+    def test_simulation_manager(self, tmp_path):
+        city = synthetic_city(n_stations=20, destinations_per_station=5)
+        ParameterBundle.from_city(city).save(tmp_path)
+        results = []
+        for c, workers in ((city, 1), (ParameterBundle.load(tmp_path), 1), (city, 2)):
+            sm = SimulationManager(city=c, n_simulations=2, simulation_id='TESTSIM', engine='array', workers=workers,
+                                   seed=5)
+            sm.run_simulations()
+            results.append(sm.replication_totals())
+        assert results[0].equals(results[1])
+        assert results[0].equals(results[2])
+        with pytest.raises(ValueError):
+            SimulationManager(city=ParameterBundle.load(tmp_path), n_simulations=2, simulation_id='TESTSIM')
+
+
 class TestWarehouse:
     def test_emptying_warehouse(self, floating_warehouse_setup):
         warehouse, s1, s2 = floating_warehouse_setup
@@ -428,4 +1349,97 @@ class TestWarehouse:
         s1.give_bike()
         assert warehouse._docked == 1
         s2.give_bike()
-        assert warehouse.is_empty()
\ No newline at end of file
+        assert warehouse.is_empty()
+
+
+class TestBenchmarks:
+    def test_synthetic_city(self):
+        city = synthetic_city(n_stations=20, destinations_per_station=5, warehouse_share=0.5, stations_per_warehouse=4)
+        assert len(city.stations) == 20
+        assert sum(isinstance(s, WarehousedStation) for s in city.stations.values()) == 10
+        assert len(city.warehouses) == 3
+        assert len(city.get_station(0)._dest_dict[0]['destinations']) == 5
+        # the same seed gives the same city
+        capacities = [synthetic_city(n_stations=20).get_station(3)._capacity for i in range(2)]
+        assert capacities[0] == capacities[1]
+
+    def test_run_benchmark(self):
+        params = dict(n_stations=20, destinations_per_station=5)
+        for engine in ('object', 'array'):
+            results = run_benchmark(params, engine, 'phases', minutes=30)
+            assert results['phases']['ticks'] == 30
+            assert results['ticks_per_second'] > 0
+            assert results['peak_allocated_mb'] > 0
+        with pytest.raises(ValueError):
+            run_benchmark(params, 'object', 'x')
+
+
+class TestScenarioSweep:
+    def test_scenario_build(self, basic_city):
+        def empty_station_1(city):
+            city.get_station(1)._docked = 0
+        scenario = Scenario('WH', [{'capacity': 10, 'docked_init': 5, 'st_id': 'WH'}], {0: 'WH'}, empty_station_1)
+        city = scenario.build(basic_city)
+        assert isinstance(city.get_station(0), WarehousedStation)
+        assert city.get_station(0)._warehouse is city.get_warehouse('WH')
+        assert city.get_station(1)._docked == 0
+        # parameters are shared with the base city, which is unchanged
+        assert city.get_station(1)._demand_dict is basic_city.get_station(1)._demand_dict
+        assert basic_city.get_station(1)._docked == 8
+        assert not isinstance(basic_city.get_station(0), WarehousedStation)
+        assert city.get_station(0)._city is city
+
+    def test_scenario_build_lazy(self, basic_city):
+        dest_dict = basic_city.get_station(0)._dest_dict
+        for station in basic_city.stations.values():
+            station.load_lazily(destinations=lambda st_id: dest_dict)
+        first, second = Scenario('a').build(basic_city), Scenario('b').build(basic_city)
+        assert first.get_station(0)._dest_dict == dest_dict
+        # each copy loads its own parameters
+        assert second.get_station(0)._dest_dict == dest_dict
+        assert '_dest_dict' not in basic_city.get_station(0).__dict__
+
+    def test_scenario_shares_samplers(self, basic_city):
+        basic_city.compile_samplers()
+        city = Scenario('a').build(basic_city)
+        ReplicationRunner(city, common_random_numbers=True)
+        base_station, station = basic_city.get_station(0), city.get_station(0)
+        assert station._dest_samplers[0][1] is base_station._dest_samplers[0][1]
+        assert station._duration_params is base_station._duration_params
+
+    def test_scenario_grid(self):
+        scenarios = scenario_grid(
+            dict(none=None, small=[{'capacity': 10, 'docked_init': 5, 'st_id': 'WH'}])
+            , dict(none=None, wh=({0: 'WH'}))
+            , dict(none=None, other=lambda city: None)
+        )
+        # warehoused stations need their warehouse, and warehouses need stations
+        assert [scenario.name for scenario in scenarios] == ['none/none/none', 'none/none/other', 'small/wh/none',
+                                                             'small/wh/other']
+
+    def test_sweep(self, basic_city):
+        def empty_station_1(city):
+            city.get_station(1)._docked = 0
+        scenarios = [Scenario('base'), Scenario('empty', allocation=empty_station_1)]
+        for workers in (1, 2):
+            sweep = ScenarioSweep(basic_city, scenarios, n_simulations=2, sweep_id='TESTSIM', workers=workers,
+                                  seed=16, output='memory')
+            sweep.run()
+            assert set(sweep.combined_timeseries_df['scenario']) == {'base', 'empty'}
+            assert len(sweep.combined_timeseries_df) == 4 * 1440
+            totals = sweep.replication_totals()
+            demand = totals['failed_starts'] + totals['finished_journeys']
+            # common random numbers by default: paired simulations see the same demand
+            assert (demand['base'] == demand['empty']).all()
+            assert (totals.loc['empty', 'failed_starts'] > totals.loc['base', 'failed_starts']).all()
+        assert basic_city.get_station(1)._docked == 8
+        # the array engine's workers share one bundle of the base city, with each scenario's state laid over it
+        totals = []
+        for workers in (1, 2):
+            sweep = ScenarioSweep(basic_city, scenarios, n_simulations=2, sweep_id='TESTSIM', engine='array',
+                                  workers=workers, seed=16, output='memory')
+            sweep.run()
+            totals.append(sweep.replication_totals())
+        assert totals[0].equals(totals[1])
+        with pytest.raises(ValueError):
+            ScenarioSweep(basic_city, [Scenario('a'), Scenario('a')], n_simulations=2, sweep_id='TESTSIM')